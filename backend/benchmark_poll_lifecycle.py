@@ -0,0 +1,342 @@
+"""
+End-to-end benchmark for the poll lifecycle.
+
+Drives the real Flask app (test client, no network) through
+start_poll -> concurrent phase1-vote -> transition -> phase2-vote -> close
+for a number of teams in parallel, and reports p50/p95/p99 latency per
+endpoint plus overall requests/sec.
+
+Storage runs on the in-memory Firestore stand-in (STORAGE_BACKEND=memory) and
+the OpenAI client is replaced by a deterministic stub, so runs are repeatable
+and need no credentials.
+
+Usage:
+    python benchmark_poll_lifecycle.py --polls 20 --team-size 8
+    python benchmark_poll_lifecycle.py --save-baseline bench_baseline.json
+    python benchmark_poll_lifecycle.py --baseline bench_baseline.json --max-regression 0.25
+
+With --baseline, the exit code is 1 if any endpoint's p95 (or overall
+throughput) regressed by more than --max-regression.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional
+
+# Must be set before server is imported (it builds its storage client on import)
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark-stub")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+ENDPOINTS = ["start", "phase1-vote", "get", "phase2-vote", "close"]
+
+OCCASIONS = [
+    "team lunch",
+    "high protein lunch",
+    "light dinner",
+    "tofu night",
+    "quick noodle lunch",
+    "hearty korean dinner",
+]
+CUISINES = ["KOREAN", "JAPANESE", "CHINESE", "WESTERN", "INDIAN", "SOUTHEAST_ASIAN"]
+ALLERGIES = ["EGGS", "DAIRY", "FISH", "SHELLFISH", "PEANUTS", "SOY", "WHEAT", "SESAME"]
+DIETS = ["VEGETARIAN", "HALAL", "PESCATARIAN", "GLUTEN_FREE"]
+AVOID = ["pork", "beef", "shrimp", "cilantro", "mushroom"]
+SPICE = ["MILD", "MEDIUM", "SPICY"]
+
+
+# ============================================================================
+# DETERMINISTIC LLM STUB
+# ============================================================================
+
+class StubOpenAI:
+    """
+    Stand-in for openai.OpenAI that ranks the food IDs found in the prompt.
+
+    The ranking is a seeded shuffle of the prompt's IDs, so identical prompts
+    always get identical answers. latency_seconds simulates model latency.
+    """
+    latency_seconds = 0.0
+
+    def __init__(self, api_key: str = None, **kwargs):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model: str, messages: List[Dict[str, str]], **kwargs):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        prompt = messages[-1]["content"]
+        food_ids = list(dict.fromkeys(re.findall(r"\((F\d+)\)", prompt)))
+        random.Random(prompt).shuffle(food_ids)
+        top_k = re.search(r"Return top (\d+) meal IDs", prompt)
+        ranked = food_ids[:int(top_k.group(1))] if top_k else food_ids
+        content = json.dumps({"ranked_food_ids": ranked})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+# ============================================================================
+# FIXTURES + MEASUREMENT
+# ============================================================================
+
+def random_profile(rng: random.Random) -> Dict[str, Any]:
+    """Android-style user document with a few sparse hard constraints."""
+    return {
+        "displayName": f"user{rng.randrange(10000)}",
+        "dietaryRestrictions": rng.sample(DIETS, 1) if rng.random() < 0.15 else [],
+        "allergies": rng.sample(ALLERGIES, rng.choice([0, 0, 1])),
+        "avoidIngredients": rng.sample(AVOID, rng.choice([0, 0, 1])),
+        "favoriteCuisines": rng.sample(CUISINES, rng.randint(1, 3)),
+        "spiceTolerance": rng.choice(SPICE),
+    }
+
+
+def seed_teams(num_teams: int, team_size: int, seed: int) -> List[Dict[str, Any]]:
+    """Create teams and their members' profiles in the storage backend."""
+    rng = random.Random(seed)
+    teams = []
+    for t in range(num_teams):
+        team_id = f"bench_team_{t}"
+        members = [f"bench_user_{t}_{m}" for m in range(team_size)]
+        for user_id in members:
+            server.db.collection("users").document(user_id).set(random_profile(rng))
+        server.db.collection("teams").document(team_id).set({
+            "teamName": f"Bench Team {t}",
+            "members": members,
+            "currentlyOpenPoll": None,
+            "lastMenu": "",
+        })
+        teams.append({"teamId": team_id, "members": members, "occasion": OCCASIONS[t % len(OCCASIONS)]})
+    return teams
+
+
+class LatencyRecorder:
+    """Thread-safe per-endpoint latency samples (seconds) and error counts."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {name: [] for name in ENDPOINTS}
+        self.errors: Dict[str, int] = {name: 0 for name in ENDPOINTS}
+
+    def call(self, endpoint: str, fn, expected=(200,)):
+        started = time.perf_counter()
+        response = fn()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples[endpoint].append(elapsed)
+            if response.status_code not in expected:
+                self.errors[endpoint] += 1
+        return response
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_poll(team: Dict[str, Any], index: int, recorder: LatencyRecorder, voter_pool: ThreadPoolExecutor) -> None:
+    """One full lifecycle for a single team; member votes are cast concurrently."""
+    client = server.app.test_client()
+    members = team["members"]
+    rng = random.Random(index)
+
+    response = recorder.call("start", lambda: client.post("/polls/start", json={
+        "teamId": team["teamId"],
+        "pollTitle": f"{team['occasion']} #{index}",
+        "occasionNote": team["occasion"],
+        "durationMinutes": 5,
+        "async": False,
+    }))
+    if response.status_code != 200:
+        return
+    poll_id = response.get_json()["pollId"]
+    visible = response.get_json()["candidates"]
+
+    def phase1_vote(user_id: str):
+        approved = rng.sample(visible, min(2, len(visible)))
+        recorder.call("phase1-vote", lambda: server.app.test_client().post(
+            f"/polls/{poll_id}/phase1-vote",
+            json={"approvedCandidates": approved},
+            headers={"X-User-Id": user_id},
+        ))
+
+    list(voter_pool.map(phase1_vote, members))
+
+    poll = recorder.call("get", lambda: client.get(f"/polls/{poll_id}", headers={"X-User-Id": members[0]}))
+    payload = poll.get_json() or {}
+    if payload.get("phase") != "phase2":
+        return
+    top3 = [candidate["name"] for candidate in payload["candidates"]]
+
+    def phase2_vote(user_id: str):
+        choice = rng.choice(top3)
+        recorder.call("phase2-vote", lambda: server.app.test_client().post(
+            f"/polls/{poll_id}/phase2-vote",
+            json={"selectedCandidate": choice},
+            headers={"X-User-Id": user_id},
+        ))
+
+    list(voter_pool.map(phase2_vote, members))
+
+    # Already closed by the last phase-2 vote; measures the idempotent close path
+    recorder.call("close", lambda: client.post(f"/polls/{poll_id}/close"))
+
+
+def run_benchmark(polls: int, team_size: int, concurrency: int, seed: int, llm_latency_ms: float) -> Dict[str, Any]:
+    """Run the lifecycle for `polls` teams, `concurrency` at a time, and summarize."""
+    server.openai.OpenAI = StubOpenAI
+    StubOpenAI.latency_seconds = llm_latency_ms / 1000.0
+    server.db.reset()
+    server.TEAM_MEMBERS_CACHE.clear()
+    server.POLL_CACHE.clear()
+    server.GROUP_CONSTRAINTS.clear()
+    # Fresh in-memory ranking cache; never touch a persistent RANKING_CACHE_DB
+    server.RANKING_CACHE = server.RankingCache(
+        server.RANKING_CACHE.max_entries, server.RANKING_CACHE.ttl_seconds
+    )
+    server.load_food_database()
+
+    teams = seed_teams(polls, team_size, seed)
+    recorder = LatencyRecorder()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as poll_pool, \
+            ThreadPoolExecutor(max_workers=max(1, concurrency * team_size)) as voter_pool:
+        futures = [
+            poll_pool.submit(run_poll, team, i, recorder, voter_pool)
+            for i, team in enumerate(teams)
+        ]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - started
+
+    endpoints = {}
+    total_requests = 0
+    for name in ENDPOINTS:
+        values = sorted(recorder.samples[name])
+        total_requests += len(values)
+        endpoints[name] = {
+            "count": len(values),
+            "errors": recorder.errors[name],
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": (values[-1] * 1000) if values else 0.0,
+        }
+
+    return {
+        "config": {
+            "polls": polls,
+            "team_size": team_size,
+            "concurrency": concurrency,
+            "seed": seed,
+            "llm_latency_ms": llm_latency_ms,
+            "memory_store_latency_ms": float(os.environ.get("MEMORY_STORE_LATENCY_MS", 0)),
+        },
+        "wall_seconds": wall,
+        "requests": total_requests,
+        "requests_per_second": total_requests / wall if wall else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    config = report["config"]
+    print(f"\n📊 Poll lifecycle benchmark: {config['polls']} polls x {config['team_size']} members, "
+          f"concurrency {config['concurrency']}")
+    print(f"{'endpoint':<12} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name in ENDPOINTS:
+        row = report["endpoints"][name]
+        print(f"{name:<12} {row['count']:>6} {row['errors']:>6} {row['p50_ms']:>9.2f} "
+              f"{row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}")
+    print(f"Total: {report['requests']} requests in {report['wall_seconds']:.2f}s "
+          f"({report['requests_per_second']:.1f} req/s)")
+
+
+def compare_to_baseline(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """
+    Compare a run against a saved baseline.
+
+    Returns:
+        List of human-readable regressions (empty if the run is within budget)
+    """
+    regressions = []
+    for name in ENDPOINTS:
+        old = baseline.get("endpoints", {}).get(name)
+        new = report["endpoints"][name]
+        if new["errors"] > (old or {}).get("errors", 0):
+            regressions.append(f"{name}: {new['errors']} errors (baseline {(old or {}).get('errors', 0)})")
+        if not old or not old.get("p95_ms"):
+            continue
+        change = (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"]
+        if change > max_regression:
+            regressions.append(f"{name}: p95 {old['p95_ms']:.2f}ms -> {new['p95_ms']:.2f}ms (+{change:.0%})")
+
+    old_rps = baseline.get("requests_per_second")
+    if old_rps:
+        change = (old_rps - report["requests_per_second"]) / old_rps
+        if change > max_regression:
+            regressions.append(
+                f"throughput: {old_rps:.1f} -> {report['requests_per_second']:.1f} req/s (-{change:.0%})"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the poll lifecycle end to end.")
+    parser.add_argument("--polls", type=int, default=20, help="number of polls (one team each)")
+    parser.add_argument("--team-size", type=int, default=8, help="members per team")
+    parser.add_argument("--concurrency", type=int, default=4, help="polls running at the same time")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated LLM latency")
+    parser.add_argument("--json", dest="json_path", help="write the report as JSON")
+    parser.add_argument("--save-baseline", help="write the report as the new baseline")
+    parser.add_argument("--baseline", help="compare against a saved baseline")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="allowed relative p95/throughput regression (default 0.25)")
+    parser.add_argument("--verbose", action="store_true", help="show server logs")
+    args = parser.parse_args(argv)
+
+    if not isinstance(server.db, server.storage.MemoryFirestore):
+        print("❌ Benchmark requires STORAGE_BACKEND=memory")
+        return 2
+
+    server_logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with server_logs:
+        report = run_benchmark(args.polls, args.team_size, args.concurrency, args.seed, args.llm_latency_ms)
+
+    print_report(report)
+
+    for path in (args.json_path, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"💾 Wrote {path}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.max_regression)
+        if regressions:
+            print("❌ Regressions vs baseline:")
+            for line in regressions:
+                print(f"   - {line}")
+            return 1
+        print(f"✅ Within {args.max_regression:.0%} of baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""
+Compile a food catalogue (JSON array or JSON Lines) into the next
+memory-mapped snapshot version. The file is streamed, so catalogues larger
+than memory can be compiled.
+
+Running servers swap to the new version within CATALOGUE_RELOAD_SECONDS
+(no restart needed); snapshots are written to CATALOGUE_SNAPSHOT_DIR.
+
+Usage:
+    python compile_catalogue.py                  # compiles food_dataset.json
+    python compile_catalogue.py path/to/menu.json
+    python compile_catalogue.py path/to/menu.jsonl
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+
+if __name__ == "__main__":
+    json_path = sys.argv[1] if len(sys.argv) > 1 else server.FOOD_DATASET_PATH
+    if not server.CATALOGUE_SNAPSHOT_DIR:
+        print("❌ CATALOGUE_SNAPSHOT_DIR is empty (snapshots disabled)")
+        sys.exit(1)
+
+    version, path = server.compile_catalogue_snapshot(json_path)
+    header = server.read_catalogue_header(path)
+    print(f"✅ Compiled {header['count']} foods from {json_path} into catalogue v{version}: {path}")
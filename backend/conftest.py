@@ -0,0 +1,57 @@
+"""
+pytest setup: run the server against the in-memory store with local
+(LLM-free) ranking, and start every test from an empty store and cold caches.
+"""
+
+import os
+import sys
+
+# Must be set before server is imported (it creates its client at import time)
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["MEMORY_STORE_LATENCY_MS"] = "0"
+os.environ["OPENAI_API_KEY"] = ""  # load_dotenv() leaves it alone; ranking stays local
+sys.path.insert(0, os.path.dirname(__file__))
+
+import pytest
+
+import server
+
+
+@pytest.fixture(scope="session", autouse=True)
+def food_catalogue():
+    server.load_food_database()
+    return server.FOOD_CATALOGUE
+
+
+@pytest.fixture(autouse=True)
+def empty_store():
+    server.db.reset()
+    for cache in (
+        server.POLL_CACHE, server.TEAM_MEMBERS_CACHE, server.CLOSED_POLL_RESULTS,
+        server.BALLOT_CACHE, server.LOCKED_IN_CACHE, server.GROUP_CONSTRAINTS
+    ):
+        cache.clear()
+    yield
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.fixture
+def team():
+    """A team of four members without dietary constraints."""
+    members = [f"user_{i}" for i in range(4)]
+    for user_id in members:
+        server.db.collection("users").document(user_id).set({
+            "displayName": user_id,
+            "favoriteCuisines": ["KOREAN"],
+            "spiceTolerance": "MEDIUM"
+        })
+    server.db.collection("teams").document("team_1").set({
+        "teamName": "Team 1",
+        "members": members,
+        "currentlyOpenPoll": None
+    })
+    return {"teamId": "team_1", "members": members}
@@ -1,13 +1,38 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+import bisect
 import json
+import mmap
 import os
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
+import re
+import hashlib
+import heapq
+import itertools
+import queue
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import List, Dict, Any, Iterator, Mapping, NamedTuple, Optional, Tuple
 import random
+import numpy as np
 import openai
 from dotenv import load_dotenv
+import storage
+from storage import transactional
 
 # Load environment variables from .env if present
 load_dotenv()
@@ -33,8 +58,10 @@ else:
         print("WARNING: No Firebase credentials found. Poll functionality will be limited.")
         # Don't initialize Firebase Admin if credentials don't exist
 
+# Storage backend: Firestore by default, STORAGE_BACKEND=memory for an
+# in-process stand-in (local load testing without a Firebase project)
 try:
-    db = firestore.client()
+    db = storage.create_client()
 except Exception as e:
     print(f"WARNING: Could not connect to Firestore: {e}")
     db = None
@@ -50,12 +77,206 @@ def validate_env_on_startup() -> None:
     else:
         print("⚠️  Firebase credentials missing. Set FIREBASE_CREDENTIALS or add backend/firebase-credentials.json")
 
+    # Storage backend
+    if os.environ.get("STORAGE_BACKEND", "firestore").lower() == "memory":
+        print("ℹ️  STORAGE_BACKEND=memory: teams, users and polls live in process memory and are lost on restart.")
+
     # OpenAI (optional)
     if os.environ.get("OPENAI_API_KEY"):
         print("✅ OPENAI_API_KEY set: LLM recommendations enabled.")
     else:
         print("ℹ️  OPENAI_API_KEY not set: using dummy candidates.")
 
+# ============================================================================
+# STAGE TRACING (PROMETHEUS METRICS + SERVER-TIMING)
+# ============================================================================
+
+# Histogram buckets for stage wall time (seconds) and item counts in/out of a stage
+STAGE_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_ITEM_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000, 100000)
+
+# Attach a Server-Timing header with per-stage durations to /polls/start responses
+SERVER_TIMING_HEADER = str(os.environ.get("SERVER_TIMING_HEADER", "false")).lower() == "true"
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class HistogramMetric:
+    """Prometheus-style histogram with one series per combination of label values."""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., count above last bucket]
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: Tuple[str, ...], value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)  # First bucket with le >= value
+        with self._lock:
+            counts = self._series.get(label_values)
+            if counts is None:
+                counts = self._series[label_values] = [0] * (len(self.buckets) + 1)
+                self._sums[label_values] = 0.0
+            counts[index] += 1
+            self._sums[label_values] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((values, list(counts), self._sums[values]) for values, counts in self._series.items())
+        for values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, values)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, values)} {cumulative}")
+        return lines
+
+
+class CounterMetric:
+    """Prometheus-style counter with one series per combination of label values."""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: Tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = sorted(self._values.items())
+        for values, value in series:
+            lines.append(f"{self.name}{_format_labels(self.label_names, values)} {value:g}")
+        return lines
+
+
+STAGE_SECONDS = HistogramMetric(
+    "veato_stage_duration_seconds", "Wall time of a candidate generation / poll start stage.",
+    ("stage",), STAGE_DURATION_BUCKETS
+)
+STAGE_ITEMS_IN = HistogramMetric(
+    "veato_stage_items_in", "Items (foods, members, ...) entering a stage.", ("stage",), STAGE_ITEM_BUCKETS
+)
+STAGE_ITEMS_OUT = HistogramMetric(
+    "veato_stage_items_out", "Items left after a stage.", ("stage",), STAGE_ITEM_BUCKETS
+)
+STAGE_CACHE = CounterMetric(
+    "veato_stage_cache_total", "Cache lookups made by a stage, by result.", ("stage", "result")
+)
+METRICS = (STAGE_SECONDS, STAGE_ITEMS_IN, STAGE_ITEMS_OUT, STAGE_CACHE)
+
+
+class StageSpan:
+    """One timed run of a stage. items_out and cache_hit are filled in while it runs."""
+    __slots__ = ("stage", "items_in", "items_out", "cache_hit", "seconds")
+
+    def __init__(self, stage: str, items_in: Optional[int] = None):
+        self.stage = stage
+        self.items_in = items_in
+        self.items_out = None
+        self.cache_hit = None
+        self.seconds = 0.0
+
+
+# Per thread: stack of open spans, and the spans of the request being timed (if any)
+_trace_local = threading.local()
+
+
+@contextmanager
+def trace_stage(stage: str, items_in: Optional[int] = None) -> Iterator[StageSpan]:
+    """
+    Time a block as one stage and record it in the stage metrics:
+
+        with trace_stage("hard_filter", items_in=len(catalogue)) as span:
+            ...
+            span.items_out = len(foods)
+    """
+    span = StageSpan(stage, items_in)
+    stack = _trace_local.__dict__.setdefault("stack", [])
+    stack.append(span)
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span.seconds = time.perf_counter() - started
+        stack.pop()
+
+        STAGE_SECONDS.observe((stage,), span.seconds)
+        if span.items_in is not None:
+            STAGE_ITEMS_IN.observe((stage,), span.items_in)
+        if span.items_out is not None:
+            STAGE_ITEMS_OUT.observe((stage,), span.items_out)
+        if span.cache_hit is not None:
+            STAGE_CACHE.inc((stage, "hit" if span.cache_hit else "miss"))
+
+        request_spans = getattr(_trace_local, "request_spans", None)
+        if request_spans is not None:
+            request_spans.append(span)
+
+
+def mark_cache(hit: bool) -> None:
+    """Record a cache hit/miss on the innermost open stage of this thread (if any)."""
+    stack = getattr(_trace_local, "stack", None)
+    if stack:
+        stack[-1].cache_hit = hit
+
+
+def server_timing(spans: List[StageSpan], total_seconds: float) -> str:
+    """Server-Timing header value (durations in ms), in the order stages finished."""
+    entries = []
+    for span in spans:
+        entry = f"{span.stage};dur={span.seconds * 1000:.1f}"
+        if span.cache_hit is not None:
+            entry += ';desc="cache hit"' if span.cache_hit else ';desc="cache miss"'
+        entries.append(entry)
+    entries.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def with_server_timing(view):
+    """Route decorator: add a Server-Timing header listing the stages the view ran."""
+    @wraps(view)
+    def timed_view(*args, **kwargs):
+        if not SERVER_TIMING_HEADER:
+            return view(*args, **kwargs)
+
+        _trace_local.request_spans = spans = []
+        started = time.perf_counter()
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        finally:
+            _trace_local.request_spans = None
+        response.headers["Server-Timing"] = server_timing(spans, time.perf_counter() - started)
+        return response
+
+    return timed_view
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Stage metrics in the Prometheus text format (for this worker process)."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # ============================================================================
 # VOCABULARY MAPPING: Android App Enums → Food Database Values
 # ============================================================================
@@ -84,73 +305,1080 @@ ALLERGEN_MAP = {
     "SESAME": "sesame"
 }
 
-# Global variable to hold loaded food database
-FOOD_DATABASE = []
+def normalize_ingredient(ingredient: str) -> str:
+    """Normalize an ingredient name for constraint matching."""
+    return ingredient.strip().lower()
+
+
+def food_ingredient_text(food: 'FoodItem') -> str:
+    """Lowercased ingredient list as one string, for substring keyword matching."""
+    return ' '.join(ing.lower() for ing in food.ingredients)
+
 
 # ============================================================================
-# FOOD DATABASE LOADING
+# FOOD ITEM MODEL
 # ============================================================================
 
-def load_food_database():
-    """Load food_dataset.json at server startup"""
-    global FOOD_DATABASE
-    food_db_path = os.path.join(os.path.dirname(__file__), "food_dataset.json")
+# Shared by every food without nutrition data
+EMPTY_NUTRITION = MappingProxyType({})
+
+
+def intern_strings(values) -> Tuple[str, ...]:
+    """Tuple of interned strings, so a name repeated across foods is stored once."""
+    return tuple(sys.intern(value) for value in values)
+
+
+class FoodItem:
+    """
+    Immutable catalogue food.
+
+    Slotted (no per-instance __dict__), with interned categorical values and
+    constraint names and tuples instead of lists, so a large catalogue shares
+    most of its strings. Ranking code passes foods around by reference or by
+    food_id instead of copying them.
+    """
+
+    __slots__ = (
+        'food_id', 'name', 'cuisine', 'meal_type', 'heaviness', 'spice_level',
+        'description', 'ingredients', 'allergens', 'dietary_violations', 'nutrition'
+    )
+
+    def __init__(
+        self,
+        food_id: str,
+        name: str,
+        cuisine: str,
+        meal_type: str,
+        heaviness: str,
+        spice_level: int = 0,
+        description: str = '',
+        ingredients: Tuple[str, ...] = (),
+        allergens: Tuple[str, ...] = (),
+        dietary_violations: Tuple[str, ...] = (),
+        nutrition: Mapping[str, Any] = EMPTY_NUTRITION
+    ):
+        init = object.__setattr__
+        init(self, 'food_id', food_id)
+        init(self, 'name', name)
+        init(self, 'cuisine', cuisine)
+        init(self, 'meal_type', meal_type)
+        init(self, 'heaviness', heaviness)
+        init(self, 'spice_level', spice_level)
+        init(self, 'description', description)
+        init(self, 'ingredients', ingredients)
+        init(self, 'allergens', allergens)
+        init(self, 'dietary_violations', dietary_violations)
+        init(self, 'nutrition', nutrition)
+
+    @classmethod
+    def from_dict(cls, food: Dict[str, Any]) -> 'FoodItem':
+        """Build from a (normalized) catalogue record; missing fields get their defaults."""
+        nutrition = food.get('nutrition')
+        return cls(
+            food_id=food.get('food_id') or '',
+            name=food.get('name') or '',
+            cuisine=sys.intern(food.get('cuisine', CATEGORICAL_FIELDS['cuisine'])),
+            meal_type=sys.intern(food.get('meal_type', CATEGORICAL_FIELDS['meal_type'])),
+            heaviness=sys.intern(food.get('heaviness', CATEGORICAL_FIELDS['heaviness'])),
+            spice_level=food.get('spice_level', 0),
+            description=food.get('description', ''),
+            ingredients=intern_strings(food.get('ingredients', [])),
+            allergens=intern_strings(food.get('allergens', [])),
+            dietary_violations=intern_strings(food.get('dietary_violations', [])),
+            nutrition=MappingProxyType(
+                {sys.intern(k): v for k, v in nutrition.items()}
+            ) if nutrition else EMPTY_NUTRITION
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"FoodItem is immutable (cannot set {name!r})")
+
+    def __repr__(self) -> str:
+        return f"FoodItem({self.food_id!r}, {self.name!r})"
+
+
+# ============================================================================
+# HARD-CONSTRAINT BITSET INDEX
+# ============================================================================
+
+def mask_from_positions(positions: List[int]) -> int:
+    """Build a bitmask with one bit set per food position."""
+    if not positions:
+        return 0
+    bits = bytearray((max(positions) >> 3) + 1)
+    for pos in positions:
+        bits[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def mask_rows(mask: int, size: int) -> np.ndarray:
+    """Food positions whose bit is set in mask, in ascending order."""
+    if mask <= 0:
+        return np.empty(0, dtype=np.int64)
+    packed = np.frombuffer(mask.to_bytes((size + 7) // 8, 'little'), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, count=size, bitorder='little'))
+
+
+class FoodIndex:
+    """
+    Inverted index from constraint values to bitmasks of food positions.
+
+    Bit i of a mask refers to foods[i]. A group-constraint query is
+    then an OR over the disallowed values followed by one AND-NOT against the
+    mask of all foods, instead of building sets for every food per request.
+    """
+
+    def __init__(self, foods: List[FoodItem]):
+        self.size = len(foods)
+        self.all_mask = (1 << self.size) - 1
+
+        allergen_positions = {}
+        violation_positions = {}
+        ingredient_positions = {}
+
+        for pos, food in enumerate(foods):
+            for allergen in set(food.allergens):
+                allergen_positions.setdefault(allergen, []).append(pos)
+            for violation in set(food.dietary_violations):
+                violation_positions.setdefault(violation, []).append(pos)
+            for ingredient in set(normalize_ingredient(ing) for ing in food.ingredients):
+                ingredient_positions.setdefault(ingredient, []).append(pos)
+
+        self.allergens = {k: mask_from_positions(v) for k, v in allergen_positions.items()}
+        self.dietary_violations = {k: mask_from_positions(v) for k, v in violation_positions.items()}
+        self.ingredients = {k: mask_from_positions(v) for k, v in ingredient_positions.items()}
+
+    @classmethod
+    def from_masks(cls, size: int, allergens, dietary_violations, ingredients) -> 'FoodIndex':
+        """Index over precomputed value -> mask mappings (e.g. from a snapshot)."""
+        index = cls([])
+        index.size = size
+        index.all_mask = (1 << size) - 1
+        index.allergens = allergens
+        index.dietary_violations = dietary_violations
+        index.ingredients = ingredients
+        return index
+
+    def excluded_mask(self, hard: Dict) -> int:
+        """OR together every food that violates at least one hard constraint."""
+        excluded = 0
+        for violation in hard.get('dietary_violations', []):
+            excluded |= self.dietary_violations.get(violation, 0)
+        for allergen in hard.get('allergens', []):
+            excluded |= self.allergens.get(allergen, 0)
+        for ingredient in hard.get('ingredients', []):
+            excluded |= self.ingredients.get(normalize_ingredient(ingredient), 0)
+        return excluded
+
+    def compatible_mask(self, hard: Dict) -> int:
+        """Mask of foods with zero overlap with the group's hard constraints."""
+        return self.all_mask & ~self.excluded_mask(hard)
+
+
+class MappedMasks:
+    """
+    Read-only value -> bitmask mapping over a snapshot's mask block, where
+    row i holds the little-endian bytes of the mask for values[i]. Masks are
+    turned into ints on lookup, so only the queried values are copied out.
+    """
+
+    def __init__(self, values: List[str], block: np.ndarray):
+        self._row_of = {value: row for row, value in enumerate(values)}
+        self._block = block
+
+    def get(self, value: str, default: int = 0) -> int:
+        row = self._row_of.get(value)
+        if row is None:
+            return default
+        return int.from_bytes(self._block[row].tobytes(), 'little')
+
+    def __getitem__(self, value: str) -> int:
+        if value not in self._row_of:
+            raise KeyError(value)
+        return self.get(value)
+
+    def __contains__(self, value: str) -> bool:
+        return value in self._row_of
+
+    def __iter__(self):
+        return iter(self._row_of)
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+
+# ============================================================================
+# COLUMNAR FOOD STORE (VECTORIZED OCCASION FILTERS)
+# ============================================================================
+
+NUTRIENT_FIELDS = ['calories', 'protein', 'fat', 'carbs']
+
+# Categorical fields and the value assumed when a food omits them
+CATEGORICAL_FIELDS = {
+    'cuisine': 'unknown',
+    'meal_type': '',
+    'heaviness': 'medium'
+}
+
+
+class FoodColumns:
+    """
+    Column-oriented copy of a food list for the occasion filters.
+
+    Row i describes foods[i]. Nutrition values are float arrays (NaN when a
+    food has no value), spice level is an int array and categorical fields
+    are int codes into a sorted per-field vocabulary, so filters and sorts run
+    as NumPy masks and argsorts over row indexes instead of per-dict loops.
+    """
+
+    def __init__(self, foods: List[FoodItem]):
+        self.size = len(foods)
+        self.row_of = {food.food_id: row for row, food in enumerate(foods)}
+
+        self.nutrition = {}
+        for nutrient in NUTRIENT_FIELDS:
+            values = [food.nutrition.get(nutrient) for food in foods]
+            self.nutrition[nutrient] = np.array(
+                [np.nan if value is None else value for value in values], dtype=np.float64
+            )
+
+        self.spice_level = np.array([food.spice_level for food in foods], dtype=np.int16)
+
+        self.vocab = {}
+        self.codes = {}
+        self._code_of = {}
+        for field in CATEGORICAL_FIELDS:
+            values = [getattr(food, field) for food in foods]
+            vocab = sorted(set(values))
+            code_of = {value: code for code, value in enumerate(vocab)}
+            self.vocab[field] = vocab
+            self._code_of[field] = code_of
+            self.codes[field] = np.array([code_of[value] for value in values], dtype=np.int32)
+
+        # Lowercased ingredient text per row; keyword masks are built on first use
+        self._ingredient_text = [food_ingredient_text(food) for food in foods]
+        self._ingredient_masks = {}
+
+    @classmethod
+    def from_arrays(
+        cls,
+        food_ids: List[str],
+        nutrition: Dict[str, np.ndarray],
+        spice_level: np.ndarray,
+        vocab: Dict[str, List[str]],
+        codes: Dict[str, np.ndarray],
+        ingredient_text
+    ) -> 'FoodColumns':
+        """Store over prebuilt arrays (e.g. memory-mapped from a snapshot)."""
+        columns = cls([])
+        columns.size = len(food_ids)
+        columns.row_of = {food_id: row for row, food_id in enumerate(food_ids)}
+        columns.nutrition = nutrition
+        columns.spice_level = spice_level
+        columns.vocab = vocab
+        columns.codes = codes
+        columns._code_of = {
+            field: {value: code for code, value in enumerate(values)} for field, values in vocab.items()
+        }
+        columns._ingredient_text = ingredient_text
+        return columns
+
+    def code(self, field: str, value: str) -> int:
+        """Code of a categorical value, or -1 if no food has it."""
+        return self._code_of[field].get(value, -1)
+
+    def rows(self, foods: List[FoodItem]) -> Optional[np.ndarray]:
+        """Row indexes of foods, or None if any food is not in this store."""
+        try:
+            return np.fromiter((self.row_of[food.food_id] for food in foods), dtype=np.int64, count=len(foods))
+        except KeyError:
+            return None
+
+    def ingredient_mask(self, keyword: str) -> np.ndarray:
+        """Rows whose ingredient list contains keyword as a substring."""
+        mask = self._ingredient_masks.get(keyword)
+        if mask is None:
+            mask = np.fromiter((keyword in text for text in self._ingredient_text), dtype=bool, count=self.size)
+            self._ingredient_masks[keyword] = mask
+        return mask
+
+
+class FoodRows(list):
+    """
+    A plain list of foods that also remembers their rows in a
+    FoodColumns store, so chained filters skip the food_id -> row lookup.
+    """
+
+    def __init__(self, foods: List[FoodItem], columns: FoodColumns, rows: np.ndarray):
+        super().__init__(foods)
+        self.columns = columns
+        self.rows = rows
+
+
+def columns_for(foods: List[FoodItem]) -> Tuple[FoodColumns, np.ndarray]:
+    """
+    Columnar view of foods: their own rows for a FoodRows list, the catalogue
+    store when all foods come from FOOD_CATALOGUE, otherwise a throwaway store
+    built from foods.
+    """
+    if isinstance(foods, FoodRows) and len(foods.rows) == len(foods):
+        return foods.columns, foods.rows
+
+    columns = FOOD_CATALOGUE.columns
+    rows = columns.rows(foods)
+    if rows is None:
+        columns = FoodColumns(foods)
+        rows = np.arange(len(foods))
+    return columns, rows
+
+
+def take_rows(foods: List[FoodItem], columns: FoodColumns, rows: np.ndarray, picks: np.ndarray) -> FoodRows:
+    """Select foods[picks] (positions into foods) and keep their rows."""
+    picks = picks.tolist() if isinstance(picks, np.ndarray) else picks
+    return FoodRows([foods[i] for i in picks], columns, rows[picks])
+
+
+# ============================================================================
+# FOOD CATALOGUE SNAPSHOTS (MEMORY-MAPPED, VERSIONED)
+# ============================================================================
+
+# Compiled snapshots live here as food_catalogue.v<N>.bin; "" disables them
+CATALOGUE_SNAPSHOT_DIR = os.environ.get(
+    "CATALOGUE_SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), "catalogue")
+)
+# How often a worker looks for a newer snapshot version
+CATALOGUE_RELOAD_SECONDS = float(os.environ.get("CATALOGUE_RELOAD_SECONDS", 10))
+CATALOGUE_KEEP_VERSIONS = 3
+# Decoded food records kept per worker (the encoded records live in the mmap)
+CATALOGUE_RECORD_CACHE = int(os.environ.get("CATALOGUE_RECORD_CACHE", 4096))
+
+FOOD_DATASET_PATH = os.path.join(os.path.dirname(__file__), "food_dataset.json")
+
+CATALOGUE_MAGIC = b"VEATOCAT"
+CATALOGUE_FORMAT = 1
+SNAPSHOT_FILE_PATTERN = re.compile(r'^food_catalogue\.v(\d+)\.bin$')
+
+
+class FoodCatalogue:
+    """
+    One version of the food catalogue: the foods plus their constraint index
+    and columns.
+
+    A catalogue is never modified after it is built. Reloading builds a new one
+    and swaps the FOOD_CATALOGUE reference, so a request that took a
+    catalogue at its start keeps a consistent view while the menu changes.
+    """
+
+    _serials = itertools.count(1)
+
+    def __init__(
+        self,
+        foods,
+        version: int = 0,
+        index: FoodIndex = None,
+        columns: FoodColumns = None,
+        path: str = None,
+        name: str = ''
+    ):
+        self.foods = foods
+        self.version = version
+        self.index = index if index is not None else FoodIndex(foods)
+        self.columns = columns if columns is not None else FoodColumns(foods)
+        self.path = path
+        self.name = name  # catalogueId; '' for the default catalogue
+        self.serial = next(FoodCatalogue._serials)  # Unique per loaded catalogue in this process
+
+    def __len__(self) -> int:
+        return len(self.foods)
+
+    def get(self, food_id: str) -> Optional[FoodItem]:
+        """Food with this ID, or None if the catalogue has none."""
+        row = self.columns.row_of.get(food_id)
+        return self.foods[row] if row is not None else None
+
+
+class MappedStrings:
+    """Read-only sequence of UTF-8 strings stored as one blob plus offsets."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._blob[start:end].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class MappedFoods:
+    """
+    Read-only list of FoodItems decoded from a snapshot on access.
+
+    The encoded records stay in the shared page cache of the memory-mapped
+    file. Decoded items are kept in a bounded per-process LRU and shared
+    between callers.
+    """
+
+    def __init__(self, records: MappedStrings):
+        self._records = records
+        self._decoded = TTLCache(CATALOGUE_RECORD_CACHE, float('inf'))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("food index out of range")
+        food = self._decoded.get(i)
+        if food is None:
+            food = FoodItem.from_dict(json.loads(self._records[i]))
+            self._decoded.set(i, food)
+        return food
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_json_array(f, chunk_size: int = 1 << 16):
+    """
+    Yield the elements of a top-level JSON array one at a time, reading the
+    file in chunks so only the current element is held in memory.
+
+    Raises:
+        ValueError: input is not a well-formed JSON array
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def skip_whitespace() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or not fill():
+                return buf[pos] if pos < len(buf) else ''
+
+    if skip_whitespace() != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    if skip_whitespace() == ']':
+        return
+    while True:
+        if skip_whitespace() == '':
+            raise ValueError("Unterminated JSON array")
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof or not fill():
+                    raise
+                continue
+            # A number near the buffer end may be cut short ("-4." of "-4.5e3")
+            if len(buf) - end < 32 and not eof and fill():
+                continue
+            break
+        pos = end
+        yield item
+
+        separator = skip_whitespace()
+        pos += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(f"Expected ',' or ']' in JSON array, got {separator!r}")
+
+
+def iter_food_items(path: str) -> Iterator[Any]:
+    """
+    Stream raw items from a catalogue file: a JSON array (like
+    food_dataset.json) or JSON Lines (one object per line, .jsonl/.ndjson or
+    any file whose first character is '{').
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        first = f.read(1)
+        while first and first in ' \t\r\n':
+            first = f.read(1)
+        f.seek(0)
+
+        if first == '[':
+            yield from iter_json_array(f)
+            return
+        if first not in ('{', ''):
+            raise ValueError(f"{path} is neither a JSON array nor JSON Lines")
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from e
+
+
+def normalize_food_item(item: Any) -> Optional[Dict]:
+    """
+    Validate one catalogue item and normalize its constraint fields:
+    ingredients are stripped and lowercased, allergens and dietary
+    violations are also deduplicated (first occurrence kept).
+
+    Returns:
+        Normalized copy of the item, or None if it is unusable (no
+        food_id/name, or a field of the wrong type)
+    """
+    if not isinstance(item, dict):
+        return None
+    for field in ('food_id', 'name'):
+        if not isinstance(item.get(field), str) or not item[field].strip():
+            return None
+
+    food = dict(item)
+    for field in ('ingredients', 'allergens', 'dietary_violations'):
+        if field not in item:
+            continue
+        values = item[field]
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            return None
+        values = [normalize_ingredient(v) for v in values]
+        food[field] = values if field == 'ingredients' else list(dict.fromkeys(values))
+
+    if 'spice_level' in item:
+        spice_level = item['spice_level']
+        if isinstance(spice_level, bool) or not isinstance(spice_level, (int, float)):
+            return None
+        food['spice_level'] = int(spice_level)
+
+    nutrition = item.get('nutrition')
+    if nutrition is not None:
+        if not isinstance(nutrition, dict):
+            return None
+        for value in nutrition.values():
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                return None
+
+    for field in CATEGORICAL_FIELDS:
+        if field in item and not isinstance(item[field], str):
+            return None
+
+    return food
+
+
+class CatalogueBuilder:
+    """
+    Builds a catalogue snapshot from foods added one at a time.
+
+    Only per-food numbers (columns, offsets, index postings) stay in memory;
+    encoded records, IDs and ingredient text are spooled to temporary files,
+    so peak memory does not grow with the size of the food dicts.
+    """
+
+    STRING_SECTIONS = ('records', 'food_ids', 'ingredient_text')
+    MASK_KINDS = ('allergens', 'dietary_violations', 'ingredients')
+
+    def __init__(self, spool_dir: str = None):
+        self.size = 0
+        self._spools = {name: tempfile.TemporaryFile(dir=spool_dir) for name in self.STRING_SECTIONS}
+        self._offsets = {name: array('q', [0]) for name in self.STRING_SECTIONS}
+        self._nutrition = {nutrient: array('d') for nutrient in NUTRIENT_FIELDS}
+        self._spice_level = array('h')
+        self._codes = {field: array('i') for field in CATEGORICAL_FIELDS}
+        self._values = {field: {} for field in CATEGORICAL_FIELDS}  # value -> code in first-seen order
+        self._postings = {kind: {} for kind in self.MASK_KINDS}  # value -> array of rows
+
+    def add(self, food: Dict) -> None:
+        """Append one normalized food record (as returned by normalize_food_item)."""
+        row = self.size
+        item = FoodItem.from_dict(food)
+
+        for name, text in (
+            ('records', json.dumps(food, ensure_ascii=False, separators=(',', ':'))),
+            ('food_ids', item.food_id),
+            ('ingredient_text', food_ingredient_text(item)),
+        ):
+            encoded = text.encode('utf-8')
+            self._spools[name].write(encoded)
+            self._offsets[name].append(self._offsets[name][-1] + len(encoded))
+
+        for nutrient in NUTRIENT_FIELDS:
+            value = item.nutrition.get(nutrient)
+            self._nutrition[nutrient].append(np.nan if value is None else value)
+        self._spice_level.append(item.spice_level)
+
+        for field in CATEGORICAL_FIELDS:
+            seen = self._values[field]
+            self._codes[field].append(seen.setdefault(getattr(item, field), len(seen)))
+
+        for kind, values in (
+            ('allergens', set(item.allergens)),
+            ('dietary_violations', set(item.dietary_violations)),
+            ('ingredients', set(normalize_ingredient(ing) for ing in item.ingredients)),
+        ):
+            postings = self._postings[kind]
+            for value in values:
+                postings.setdefault(value, array('I')).append(row)
+
+        self.size += 1
+
+    def write(self, path: str, version: int, source: Dict[str, str]) -> None:
+        """
+        Write the snapshot as one binary file.
+
+        Layout: magic, header length (uint64), JSON header, then 8-byte
+        aligned raw arrays described by header["sections"]. The file is
+        written under a temporary name and hard-linked into place, so readers
+        never see a partial snapshot and two writers cannot claim the same
+        version.
+
+        Raises:
+            FileExistsError: path already exists (another process won the version)
+        """
+        # name -> (dtype, shape, chunk writer)
+        sections = {}
+
+        def spool_chunks(name):
+            def chunks():
+                spool = self._spools[name]
+                spool.seek(0)
+                yield from iter(lambda: spool.read(1 << 20), b'')
+            return chunks
+
+        for name in self.STRING_SECTIONS:
+            offsets = np.frombuffer(self._offsets[name], dtype=np.int64)
+            sections[name] = (np.dtype(np.uint8), [int(offsets[-1])], spool_chunks(name))
+            sections[name + '.offsets'] = (offsets.dtype, [len(offsets)], lambda a=offsets: [a.tobytes()])
+
+        for nutrient in NUTRIENT_FIELDS:
+            values = np.frombuffer(self._nutrition[nutrient], dtype=np.float64)
+            sections['nutrition.' + nutrient] = (values.dtype, [self.size], lambda a=values: [a.tobytes()])
+        spice_level = np.frombuffer(self._spice_level, dtype=np.int16)
+        sections['spice_level'] = (spice_level.dtype, [self.size], lambda: [spice_level.tobytes()])
+
+        # Codes were assigned in first-seen order; remap to the sorted vocabulary
+        vocab = {}
+        for field in CATEGORICAL_FIELDS:
+            seen = self._values[field]
+            vocab[field] = sorted(seen)
+            sorted_code = {value: code for code, value in enumerate(vocab[field])}
+            remap = np.array([sorted_code[value] for value in seen], dtype=np.int32)
+            codes = remap[np.frombuffer(self._codes[field], dtype=np.int32)] if self.size else remap[:0]
+            sections['codes.' + field] = (codes.dtype, [self.size], lambda a=codes: [a.tobytes()])
+
+        # One row of ceil(size / 8) bytes per constraint value, written row by row
+        mask_bytes = (self.size + 7) // 8
+        mask_values = {}
+        for kind in self.MASK_KINDS:
+            postings = self._postings[kind]
+            values = sorted(postings)
+            mask_values[kind] = values
+
+            def mask_rows(postings=postings, values=values):
+                for value in values:
+                    rows = np.frombuffer(postings[value], dtype=np.uint32)
+                    row_mask = np.zeros(mask_bytes, dtype=np.uint8)
+                    np.bitwise_or.at(row_mask, rows >> 3, (1 << (rows & 7)).astype(np.uint8))
+                    yield row_mask.tobytes()
+
+            sections['masks.' + kind] = (np.dtype(np.uint8), [len(values), mask_bytes], mask_rows)
+
+        layout = {}
+        offset = 0
+        for name, (dtype, shape, _) in sections.items():
+            layout[name] = {'offset': offset, 'dtype': dtype.str, 'shape': shape}
+            offset += -(-int(np.prod(shape)) * dtype.itemsize // 8) * 8
+
+        header = json.dumps({
+            'format': CATALOGUE_FORMAT,
+            'version': version,
+            'count': self.size,
+            'source': source,
+            'createdAt': datetime.utcnow().isoformat() + "Z",
+            'vocab': vocab,
+            'maskValues': mask_values,
+            'sections': layout
+        }, ensure_ascii=False).encode('utf-8')
+        prefix = CATALOGUE_MAGIC + len(header).to_bytes(8, 'little') + header
+        data_start = -(-len(prefix) // 8) * 8
+
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(prefix.ljust(data_start, b'\0'))
+                for name, (_, _, chunks) in sections.items():
+                    f.seek(data_start + layout[name]['offset'])
+                    for chunk in chunks():
+                        f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(tmp_path, path)
+        finally:
+            os.unlink(tmp_path)
+
+    def close(self) -> None:
+        for spool in self._spools.values():
+            spool.close()
+
+
+def write_catalogue_snapshot(foods, path: str, version: int, source: Dict[str, str]) -> None:
+    """Write an iterable of (already normalized) foods as a snapshot file."""
+    builder = CatalogueBuilder(spool_dir=os.path.dirname(path) or None)
     try:
-        with open(food_db_path, 'r', encoding='utf-8') as f:
-            FOOD_DATABASE = json.load(f)
-        print(f"✅ Loaded {len(FOOD_DATABASE)} food items from database")
+        for food in foods:
+            builder.add(food)
+        builder.write(path, version, source)
+    finally:
+        builder.close()
+
+
+def read_catalogue_header(path: str) -> Dict[str, Any]:
+    with open(path, 'rb') as f:
+        if f.read(len(CATALOGUE_MAGIC)) != CATALOGUE_MAGIC:
+            raise ValueError(f"{path} is not a food catalogue snapshot")
+        header_len = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(header_len))
+
+
+def open_catalogue_snapshot(path: str, name: str = '') -> FoodCatalogue:
+    """
+    Memory-map a snapshot. Columns and index masks are zero-copy views of the
+    mapping, so worker processes opening the same version share its pages.
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[:len(CATALOGUE_MAGIC)] != CATALOGUE_MAGIC:
+        raise ValueError(f"{path} is not a food catalogue snapshot")
+    header_len = int.from_bytes(mapped[len(CATALOGUE_MAGIC):len(CATALOGUE_MAGIC) + 8], 'little')
+    header_end = len(CATALOGUE_MAGIC) + 8 + header_len
+    header = json.loads(mapped[len(CATALOGUE_MAGIC) + 8:header_end])
+    if header.get('format') != CATALOGUE_FORMAT:
+        raise ValueError(f"Unsupported catalogue format {header.get('format')} in {path}")
+    data_start = -(-header_end // 8) * 8
+
+    def section(name: str) -> np.ndarray:
+        spec = header['sections'][name]
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape))
+        if count == 0:
+            return np.empty(shape, dtype=spec['dtype'])
+        array = np.frombuffer(mapped, dtype=spec['dtype'], count=count, offset=data_start + spec['offset'])
+        return array.reshape(shape)
+
+    def strings(name: str) -> MappedStrings:
+        return MappedStrings(section(name), section(name + '.offsets'))
+
+    size = header['count']
+    index = FoodIndex.from_masks(size, **{
+        kind: MappedMasks(header['maskValues'][kind], section('masks.' + kind))
+        for kind in ('allergens', 'dietary_violations', 'ingredients')
+    })
+    columns = FoodColumns.from_arrays(
+        food_ids=list(strings('food_ids')),
+        nutrition={nutrient: section('nutrition.' + nutrient) for nutrient in NUTRIENT_FIELDS},
+        spice_level=section('spice_level'),
+        vocab=header['vocab'],
+        codes={field: section('codes.' + field) for field in CATEGORICAL_FIELDS},
+        ingredient_text=strings('ingredient_text')
+    )
+    return FoodCatalogue(MappedFoods(strings('records')), header['version'], index, columns, path, name)
+
+
+def list_catalogue_snapshots(directory: str) -> List[Tuple[int, str]]:
+    """(version, path) of every snapshot in directory, oldest first."""
+    try:
+        names = os.listdir(directory)
     except FileNotFoundError:
-        print(f"⚠️  food_dataset.json not found at {food_db_path}")
-        FOOD_DATABASE = []
-    except Exception as e:
-        print(f"❌ Error loading food database: {e}")
-        FOOD_DATABASE = []
+        return []
+    snapshots = []
+    for name in names:
+        match = SNAPSHOT_FILE_PATTERN.match(name)
+        if match:
+            snapshots.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(snapshots)
+
+
+def compile_catalogue_snapshot(json_path: str, directory: str = None) -> Tuple[int, str]:
+    """
+    Compile a food catalogue file (JSON array or JSON Lines) into the next
+    snapshot version. Items are validated and normalized one at a time;
+    invalid items are skipped.
+
+    Returns:
+        (version, path) of the new snapshot
+    """
+    directory = directory or CATALOGUE_SNAPSHOT_DIR
+    source = {'name': os.path.basename(json_path), 'sha256': file_sha256(json_path)}
+    os.makedirs(directory, exist_ok=True)
+
+    # Stream items into the builder; the parsed catalogue is never held as one list
+    builder = CatalogueBuilder(spool_dir=directory)
+    skipped = 0
+    try:
+        for item in iter_food_items(json_path):
+            food = normalize_food_item(item)
+            if food is None:
+                skipped += 1
+                continue
+            builder.add(food)
+        if skipped:
+            print(f"⚠️ Skipped {skipped} invalid food items in {json_path}", flush=True)
+
+        while True:
+            snapshots = list_catalogue_snapshots(directory)
+            version = snapshots[-1][0] + 1 if snapshots else 1
+            path = os.path.join(directory, f"food_catalogue.v{version}.bin")
+            try:
+                builder.write(path, version, source)
+                break
+            except FileExistsError:
+                continue  # Another process compiled this version first; take the next
+    finally:
+        builder.close()
+
+    # Workers still mapping a pruned version keep reading it until they swap
+    for _, old_path in list_catalogue_snapshots(directory)[:-CATALOGUE_KEEP_VERSIONS]:
+        try:
+            os.unlink(old_path)
+        except OSError:
+            pass
+
+    return version, path
+
+
+def ensure_catalogue_snapshot(json_path: str, directory: str) -> Optional[str]:
+    """
+    Path of the newest snapshot in directory. json_path is compiled first if
+    there is no snapshot yet, or if the newest one was compiled from an older
+    copy of the same file (a snapshot compiled from another file is kept).
+    """
+    snapshots = list_catalogue_snapshots(directory)
+    if snapshots:
+        source = read_catalogue_header(snapshots[-1][1]).get('source', {})
+        if source.get('name') != os.path.basename(json_path):
+            return snapshots[-1][1]
+        if not os.path.exists(json_path) or source.get('sha256') == file_sha256(json_path):
+            return snapshots[-1][1]
+    elif not os.path.exists(json_path):
+        return None
+
+    version, path = compile_catalogue_snapshot(json_path, directory)
+    print(f"📦 Compiled {os.path.basename(json_path)} into catalogue snapshot v{version}")
+    return path
+
+
+# The catalogue every request reads; replaced (never mutated) on reload
+FOOD_CATALOGUE = FoodCatalogue([])
+_catalogue_loaded = False
+_catalogue_checked_at = 0.0
+_catalogue_reload_lock = threading.Lock()
 
 # ============================================================================
-# GROUP CONSTRAINT BUILDING
+# FOOD DATABASE LOADING
 # ============================================================================
 
-def build_group_constraints(members_constraints: List[Dict]) -> Dict:
+def load_food_database():
     """
-    Build union of hard constraints across all team members.
-    Returns normalized constraints for database filtering.
+    Load the food catalogue at server startup and build the constraint index and columns.
 
-    Args:
-        members_constraints: List of dicts with 'userId' and 'constraints' keys
+    Maps the newest snapshot in CATALOGUE_SNAPSHOT_DIR (compiling
+    food_dataset.json into one when needed), and falls back to parsing
+    food_dataset.json if snapshots are disabled or unavailable.
+    """
+    global FOOD_CATALOGUE, _catalogue_loaded, _catalogue_checked_at
+    catalogue = None
+
+    if CATALOGUE_SNAPSHOT_DIR:
+        try:
+            path = ensure_catalogue_snapshot(FOOD_DATASET_PATH, CATALOGUE_SNAPSHOT_DIR)
+            if path:
+                catalogue = open_catalogue_snapshot(path)
+                print(f"✅ Mapped {len(catalogue)} food items from catalogue snapshot v{catalogue.version}")
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Catalogue snapshot unavailable ({e}), loading food_dataset.json directly")
+
+    if catalogue is None:
+        foods = []
+        try:
+            foods = read_food_items(FOOD_DATASET_PATH)
+            print(f"✅ Loaded {len(foods)} food items from database")
+        except FileNotFoundError:
+            print(f"⚠️  food_dataset.json not found at {FOOD_DATASET_PATH}")
+        except Exception as e:
+            print(f"❌ Error loading food database: {e}")
+        catalogue = FoodCatalogue(foods)
+
+    FOOD_CATALOGUE = catalogue
+    _catalogue_loaded = True
+    _catalogue_checked_at = time.time()
+
+    index = catalogue.index
+    print(f"✅ Indexed {len(index.allergens)} allergens, "
+          f"{len(index.dietary_violations)} dietary violations, "
+          f"{len(index.ingredients)} ingredients")
+
+
+def reload_food_catalogue() -> bool:
+    """
+    Swap in the newest snapshot if it is newer than the current catalogue.
 
     Returns:
-        Dict with 'hard' (for filtering) and 'soft' (for LLM ranking) constraints
+        True if a new version was swapped in
     """
-    group_dietary_disallows = set()
-    group_allergies = set()
-    group_avoid_ingredients = set()
+    global FOOD_CATALOGUE
+    snapshots = list_catalogue_snapshots(CATALOGUE_SNAPSHOT_DIR) if CATALOGUE_SNAPSHOT_DIR else []
+    if not snapshots or snapshots[-1][0] <= FOOD_CATALOGUE.version:
+        return False
 
-    # Collect soft preferences for LLM
-    all_favorite_cuisines = []
-    all_spice_tolerances = []
+    version, path = snapshots[-1]
+    try:
+        catalogue = open_catalogue_snapshot(path)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Could not load catalogue snapshot v{version}: {e}", flush=True)
+        return False
+
+    FOOD_CATALOGUE = catalogue
+    print(f"🔄 Swapped food catalogue to v{catalogue.version} ({len(catalogue)} items)", flush=True)
+    return True
+
+
+@app.before_request
+def refresh_food_catalogue():
+    """Load the catalogue on first use (e.g. under gunicorn) and pick up new snapshot versions."""
+    global _catalogue_checked_at
+    if not _catalogue_loaded:
+        with _catalogue_reload_lock:
+            if not _catalogue_loaded:
+                load_food_database()
+        return
+
+    if time.time() - _catalogue_checked_at < CATALOGUE_RELOAD_SECONDS:
+        return
+    if not _catalogue_reload_lock.acquire(blocking=False):
+        return  # Another request is already checking
+    try:
+        _catalogue_checked_at = time.time()
+        reload_food_catalogue()
+    finally:
+        _catalogue_reload_lock.release()
 
-    for member in members_constraints:
-        user_constraints = member.get('constraints', {})
 
-        # Hard constraints - normalize to lowercase database format
-        for restriction in user_constraints.get('dietaryRestrictions', []):
-            normalized = DIETARY_RESTRICTION_MAP.get(restriction, restriction.lower())
-            group_dietary_disallows.add(normalized)
+# ============================================================================
+# TOP-K SELECTION
+# ============================================================================
+
+def top_k_indices(keys: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+    """
+    Indexes of the k smallest keys, ascending, ties broken by index.
+    Same result as np.argsort(keys, kind='stable')[:k], but only the keys up
+    to the k-th smallest (found with np.partition) are sorted.
+    """
+    n = len(keys)
+    if k is None or k >= n:
+        return np.argsort(keys, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    kth = np.partition(keys, k - 1)[k - 1]
+    candidates = np.flatnonzero(keys <= kth)
+    return candidates[np.argsort(keys[candidates], kind='stable')][:k]
+
+
+def top_k(items, k: int, key) -> List:
+    """
+    The k smallest items by key, ascending, ties in input order.
+    Same result as sorted(items, key=key)[:k] using a bounded heap.
+    """
+    return heapq.nsmallest(k, items, key=key)
+
 
-        for allergy in user_constraints.get('allergies', []):
-            normalized = ALLERGEN_MAP.get(allergy, allergy.lower())
-            group_allergies.add(normalized)
+# ============================================================================
+# GROUP CONSTRAINT BUILDING
+# ============================================================================
 
-        for ingredient in user_constraints.get('avoidIngredients', []):
-            # Ingredients already lowercase in profiles
-            group_avoid_ingredients.add(ingredient.lower())
+class MemberConstraints(NamedTuple):
+    """One member's constraints, normalized to database values (profile order kept)."""
+    dietary_violations: Tuple[str, ...]
+    allergens: Tuple[str, ...]
+    ingredients: Tuple[str, ...]
+    favorite_cuisines: Tuple[str, ...]
+    spice_tolerance: str
+
+    @property
+    def hard(self) -> Dict[str, Tuple[str, ...]]:
+        return {
+            'dietary_violations': self.dietary_violations,
+            'allergens': self.allergens,
+            'ingredients': self.ingredients
+        }
 
+
+def compile_member_constraints(user_constraints: Dict) -> MemberConstraints:
+    """Normalize one member's profile constraints (see constraints_from_user_data())."""
+    return MemberConstraints(
+        # Hard constraints - normalize to lowercase database format
+        dietary_violations=tuple(
+            DIETARY_RESTRICTION_MAP.get(restriction, restriction.lower())
+            for restriction in user_constraints.get('dietaryRestrictions', [])
+        ),
+        allergens=tuple(
+            ALLERGEN_MAP.get(allergy, allergy.lower())
+            for allergy in user_constraints.get('allergies', [])
+        ),
+        # Ingredients already lowercase in profiles
+        ingredients=tuple(
+            normalize_ingredient(ingredient) for ingredient in user_constraints.get('avoidIngredients', [])
+        ),
         # Soft preferences
-        for cuisine in user_constraints.get('favoriteCuisines', []):
-            all_favorite_cuisines.append(cuisine.lower())
+        favorite_cuisines=tuple(cuisine.lower() for cuisine in user_constraints.get('favoriteCuisines', [])),
+        spice_tolerance=user_constraints.get('spiceTolerance', 'MEDIUM')
+    )
+
+
+def combine_member_constraints(members: List[MemberConstraints]) -> Dict:
+    """Union of the members' hard constraints plus their soft preference lists."""
+    group_dietary_disallows = set()
+    group_allergies = set()
+    group_avoid_ingredients = set()
+
+    # Collect soft preferences for LLM
+    all_favorite_cuisines = []
+    all_spice_tolerances = []
 
-        spice = user_constraints.get('spiceTolerance', 'MEDIUM')
-        all_spice_tolerances.append(spice)
+    for member in members:
+        group_dietary_disallows.update(member.dietary_violations)
+        group_allergies.update(member.allergens)
+        group_avoid_ingredients.update(member.ingredients)
+        all_favorite_cuisines.extend(member.favorite_cuisines)
+        all_spice_tolerances.append(member.spice_tolerance)
 
     return {
         'hard': {
@@ -164,75 +1392,818 @@ def build_group_constraints(members_constraints: List[Dict]) -> Dict:
         }
     }
 
+
+def build_group_constraints(members_constraints: List[Dict]) -> Dict:
+    """
+    Build union of hard constraints across all team members.
+    Returns normalized constraints for database filtering.
+
+    Args:
+        members_constraints: List of dicts with 'userId' and 'constraints' keys
+
+    Returns:
+        Dict with 'hard' (for filtering) and 'soft' (for LLM ranking) constraints
+    """
+    return combine_member_constraints([
+        compile_member_constraints(member.get('constraints', {})) for member in members_constraints
+    ])
+
+# ============================================================================
+# MEMBER PROFILE LOADING
+# ============================================================================
+
+# Maximum number of document references sent in one batched read
+USER_BATCH_SIZE = 100
+
+
+def constraints_from_user_data(user_data: Dict) -> Dict:
+    """
+    Map Firestore user fields (from Android app) to backend constraint format.
+    Android app stores: dietaryRestrictions, allergies, avoidIngredients, favoriteCuisines, spiceTolerance
+    """
+    return {
+        # Hard constraints (MUST avoid)
+        "dietaryRestrictions": user_data.get("dietaryRestrictions", []),  # e.g., ["VEGAN", "VEGETARIAN"]
+        "allergies": user_data.get("allergies", []),  # e.g., ["PEANUTS", "SHELLFISH"]
+        "avoidIngredients": user_data.get("avoidIngredients", []),  # e.g., ["beef", "pork"]
+
+        # Soft preferences (nice to have)
+        "favoriteCuisines": user_data.get("favoriteCuisines", []),  # e.g., ["KOREAN", "ITALIAN"]
+        "spiceTolerance": user_data.get("spiceTolerance", "MEDIUM"),  # e.g., "MILD", "MEDIUM", "SPICY"
+    }
+
+
+def load_members_constraints(member_ids: List[str]) -> List[Dict]:
+    """
+    Fetch all member profiles with batched multi-document reads.
+
+    Args:
+        member_ids: Team member user IDs
+
+    Returns:
+        List of dicts with 'userId', 'constraints' and 'version' (the user
+        document's update time) keys, in member order. Members without a
+        user document are skipped.
+    """
+    users_ref = db.collection("users")
+    user_docs = {}
+
+    with trace_stage("load_profiles", items_in=len(member_ids)) as span:
+        for start in range(0, len(member_ids), USER_BATCH_SIZE):
+            refs = [users_ref.document(user_id) for user_id in member_ids[start:start + USER_BATCH_SIZE]]
+            # get_all streams results in arbitrary order, so key them by ID
+            for user_doc in db.get_all(refs):
+                if user_doc.exists:
+                    user_docs[user_doc.id] = user_doc
+        span.items_out = len(user_docs)
+
+    members_constraints = []
+    for user_id in member_ids:
+        user_doc = user_docs.get(user_id)
+        if user_doc is None:
+            continue
+        members_constraints.append({
+            "userId": user_id,
+            "constraints": constraints_from_user_data(user_doc.to_dict()),
+            "version": user_doc.update_time
+        })
+
+    return members_constraints
+
 # ============================================================================
 # DATABASE FILTERING (HARD CONSTRAINTS)
 # ============================================================================
 
-def filter_foods_by_constraints(group_constraints: Dict, max_candidates: int = 200) -> List[Dict]:
+class ConstraintMatch:
+    """
+    Result of the hard-constraint filter over one catalogue.
+
+    Holds the full compatible set (as catalogue rows) and a truncated FoodRows
+    view for ranking. Facet counts are bincounts over the catalogue's
+    categorical code columns, so no food is visited to compute them.
+    """
+
+    def __init__(self, catalogue: FoodCatalogue, rows: np.ndarray, max_candidates: int):
+        self.catalogue = catalogue
+        self.rows = rows
+        self.total = len(rows)
+        picks = rows[:max_candidates]
+        self.foods = FoodRows([catalogue.foods[pos] for pos in picks.tolist()], catalogue.columns, picks)
+        self._facets = {}
+
+    def facet(self, field: str) -> Dict[str, int]:
+        """Compatible food count per value of a categorical field (values with no foods omitted)."""
+        counts = self._facets.get(field)
+        if counts is None:
+            columns = self.catalogue.columns
+            vocab = columns.vocab[field]
+            bins = np.bincount(columns.codes[field][self.rows], minlength=len(vocab))
+            counts = {vocab[code]: int(bins[code]) for code in np.flatnonzero(bins)}
+            self._facets[field] = counts
+        return counts
+
+    @property
+    def facets(self) -> Dict[str, Dict[str, int]]:
+        """Facet counts for every categorical field (cuisine, meal_type, heaviness)."""
+        return {field: self.facet(field) for field in CATEGORICAL_FIELDS}
+
+
+def match_hard_constraints(
+    group_constraints: Dict,
+    max_candidates: int = 200,
+    catalogue: FoodCatalogue = None
+) -> ConstraintMatch:
     """
     Hard filter: Remove foods that violate ANY member's constraints.
-    Uses set intersection logic: food must have ZERO overlap with group disallows.
+    Food must have ZERO overlap with group disallows; the check runs as
+    bitmask operations over the catalogue's constraint index.
 
     Args:
         group_constraints: Output from build_group_constraints()
-        max_candidates: Maximum number of foods to return
+        max_candidates: Maximum number of foods in the result's foods view
+        catalogue: Catalogue to filter (default: current FOOD_CATALOGUE)
 
     Returns:
-        List of food items that pass all hard constraint filters
+        ConstraintMatch with every compatible food, facet counts and the
+        first max_candidates foods
     """
-    hard = group_constraints['hard']
-    group_dietary_disallows = set(hard['dietary_violations'])
-    group_allergies = set(hard['allergens'])
-    group_avoid_ingredients = set(hard['ingredients'])
+    if catalogue is None:
+        catalogue = FOOD_CATALOGUE
+    compatible = catalogue.index.compatible_mask(group_constraints['hard'])
+    return ConstraintMatch(catalogue, mask_rows(compatible, catalogue.index.size), max_candidates)
 
-    filtered_foods = []
 
-    for food in FOOD_DATABASE:
-        # Check dietary violations (vegan, halal, etc.)
-        food_violations = set(food.get('dietary_violations', []))
-        if food_violations & group_dietary_disallows:  # Intersection - any overlap means exclude
-            continue
+def filter_foods_by_constraints(
+    group_constraints: Dict,
+    max_candidates: int = 200,
+    catalogue: FoodCatalogue = None
+) -> List[FoodItem]:
+    """
+    Foods that pass all hard constraint filters (at most max_candidates).
+    See match_hard_constraints() for the full result with facet counts.
+    """
+    return match_hard_constraints(group_constraints, max_candidates, catalogue).foods
 
-        # Check allergens
-        food_allergens = set(food.get('allergens', []))
-        if food_allergens & group_allergies:
-            continue
 
-        # Check ingredients (more expensive, do last)
-        food_ingredients = set(ing.lower() for ing in food.get('ingredients', []))
-        if food_ingredients & group_avoid_ingredients:
-            continue
+def analyze_cuisine_compatibility(
+    group_constraints: Dict,
+    catalogue: FoodCatalogue = None,
+    match: ConstraintMatch = None
+) -> Dict[str, int]:
+    """
+    Analyze which cuisines have foods compatible with the group's constraints.
+    Pass the ConstraintMatch from match_hard_constraints() to reuse it.
 
-        # Passed all filters
-        filtered_foods.append(food)
+    Returns dict mapping cuisine name -> count of compatible foods
+    """
+    if match is None:
+        match = match_hard_constraints(group_constraints, max_candidates=0, catalogue=catalogue)
+    return match.facet('cuisine')
 
-        if len(filtered_foods) >= max_candidates:
-            break
 
-    return filtered_foods
+# ============================================================================
+# LLM RANKING CACHE
+# ============================================================================
 
+class TTLCache:
+    """Thread-safe in-memory LRU cache whose entries expire after a TTL."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def peek(self, key, default=None):
+        """Like get(), but leaves LRU order and expired entries alone."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def expire(self) -> int:
+        """Drop every expired entry now (get() only drops the one it looks up)."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def set(self, key, value, ttl_seconds: float = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RankingCache:
+    """
+    Cache of LLM rankings (ordered food_id lists) keyed by constraint fingerprint.
 
-def analyze_cuisine_compatibility(group_constraints: Dict) -> Dict[str, int]:
+    Lookups hit the in-memory TTL/LRU tier first. When db_path is set, entries
+    are also written to a SQLite table so they survive restarts and can be
+    shared by several worker processes on the same host.
     """
-    Analyze which cuisines have foods compatible with the group's constraints.
 
-    Returns dict mapping cuisine name -> count of compatible foods
+    def __init__(self, max_entries: int, ttl_seconds: float, db_path: str = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._memory = TTLCache(max_entries, ttl_seconds)
+        self._db_path = db_path
+        self._conn = None
+        self._db_lock = threading.Lock()
+
+        if db_path:
+            try:
+                self._conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS ranking_cache ("
+                    " key TEXT PRIMARY KEY,"
+                    " ranked_ids TEXT NOT NULL,"
+                    " expires_at REAL NOT NULL,"
+                    " last_used REAL NOT NULL)"
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️  Ranking cache store unavailable at {db_path}: {e}")
+                self._conn = None
+
+    def get(self, key: str) -> Optional[List[str]]:
+        if self.ttl_seconds <= 0:
+            return None
+
+        ranked_ids = self._memory.get(key)
+        if ranked_ids is not None or self._conn is None:
+            return ranked_ids
+
+        now = time.time()
+        try:
+            with self._db_lock:
+                row = self._conn.execute(
+                    "SELECT ranked_ids, expires_at FROM ranking_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row[1] <= now:
+                    self._conn.execute("DELETE FROM ranking_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                    return None
+                self._conn.execute("UPDATE ranking_cache SET last_used = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️  Ranking cache read failed: {e}")
+            return None
+
+        ranked_ids = json.loads(row[0])
+        self._memory.set(key, ranked_ids, ttl_seconds=row[1] - now)
+        return ranked_ids
+
+    def set(self, key: str, ranked_ids: List[str]) -> None:
+        if self.ttl_seconds <= 0:
+            return
+
+        self._memory.set(key, ranked_ids)
+        if self._conn is None:
+            return
+
+        now = time.time()
+        try:
+            with self._db_lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO ranking_cache (key, ranked_ids, expires_at, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(ranked_ids), now + self.ttl_seconds, now)
+                )
+                # Drop expired rows, then evict least recently used beyond capacity
+                self._conn.execute("DELETE FROM ranking_cache WHERE expires_at <= ?", (now,))
+                self._conn.execute(
+                    "DELETE FROM ranking_cache WHERE key NOT IN ("
+                    " SELECT key FROM ranking_cache ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️  Ranking cache write failed: {e}")
+
+
+LLM_RANKING_MODEL = "gpt-3.5-turbo"
+
+# Foods shown to the LLM per ranking request (token budget)
+LLM_PROMPT_FOOD_LIMIT = 50
+
+RANKING_CACHE = RankingCache(
+    max_entries=int(os.environ.get("RANKING_CACHE_MAX_ENTRIES", 512)),
+    ttl_seconds=float(os.environ.get("RANKING_CACHE_TTL_SECONDS", 24 * 60 * 60)),
+    db_path=os.environ.get("RANKING_CACHE_DB")
+)
+
+
+def normalize_occasion(occasion: Optional[str]) -> str:
+    """Lowercase and collapse whitespace so equivalent occasions compare equal."""
+    return ' '.join(occasion.lower().split()) if occasion else ''
+
+
+def summarize_soft_preferences(soft: Dict) -> Tuple[Dict[str, int], float]:
     """
-    compatible_foods = filter_foods_by_constraints(group_constraints, max_candidates=1000)
+    Reduce soft preferences to what the ranking step uses.
 
+    Returns:
+        (cuisine_counts, avg_spice_tolerance) where cuisine_counts maps cuisine
+        to number of members who like it and spice tolerance is on a 1-3 scale
+    """
     cuisine_counts = {}
-    for food in compatible_foods:
-        cuisine = food.get('cuisine', 'unknown')
+    for cuisine in soft['favorite_cuisines']:
         cuisine_counts[cuisine] = cuisine_counts.get(cuisine, 0) + 1
 
-    return cuisine_counts
+    avg_spice_map = {'MILD': 1, 'MEDIUM': 2, 'SPICY': 3}
+    spice_scores = [avg_spice_map.get(s.upper(), 2) for s in soft['spice_tolerances']]
+    avg_spice_tolerance = sum(spice_scores) / len(spice_scores) if spice_scores else 2
+
+    return cuisine_counts, avg_spice_tolerance
+
+
+def ranking_cache_key(
+    group_constraints: Dict,
+    occasion: Optional[str],
+    food_ids: List[str],
+    top_k: int,
+    catalogue_version: int = 0,
+    catalogue_name: str = ''
+) -> str:
+    """
+    Canonical fingerprint of one ranking request.
+
+    Two polls share a key when their hard constraints, cuisine counts, average
+    spice tolerance, normalized occasion, candidate food_id set and catalogue
+    name and version all match (another catalogue or a new version may change
+    what an ID means).
+    """
+    cuisine_counts, avg_spice_tolerance = summarize_soft_preferences(group_constraints['soft'])
+    fingerprint = {
+        'model': LLM_RANKING_MODEL,
+        'hard': {k: sorted(set(v)) for k, v in group_constraints['hard'].items()},
+        'cuisines': sorted(cuisine_counts.items()),
+        'spice': round(avg_spice_tolerance, 3),
+        'occasion': normalize_occasion(occasion),
+        'food_ids': sorted(set(food_ids)),
+        'top_k': top_k,
+        'catalogue': catalogue_version,
+        'catalogueName': catalogue_name
+    }
+    canonical = json.dumps(fingerprint, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# ============================================================================
+# COMPILED GROUP CONSTRAINTS (PER TEAM + PROFILE VERSIONS)
+# ============================================================================
+
+# Compiled members/teams are reused while member profiles are unchanged
+CONSTRAINT_CACHE_MAX_ENTRIES = int(os.environ.get("CONSTRAINT_CACHE_MAX_ENTRIES", 4096))
+CONSTRAINT_CACHE_TTL_SECONDS = float(os.environ.get("CONSTRAINT_CACHE_TTL_SECONDS", 60 * 60))
+
+
+def member_version_key(member: Dict) -> Optional[Tuple[str, Any]]:
+    """(userId, profile version) of a load_members_constraints() entry, or None if unversioned."""
+    if not member.get('userId') or member.get('version') is None:
+        return None
+    return member['userId'], member['version']
+
+
+class CompiledGroupConstraints:
+    """
+    A team's constraints for one set of member profile versions: the
+    build_group_constraints() dict, its soft-preference summary, and the
+    compatible-food mask per catalogue.
+
+    The mask is the OR of per-member excluded masks, each cached by member
+    profile version and catalogue, so when one member edits their profile
+    only that member's mask is recomputed. The constraints dict is shared
+    between polls and must not be mutated.
+    """
+
+    def __init__(self, members: List[Tuple[Optional[Tuple[str, Any]], MemberConstraints]], member_masks: TTLCache):
+        self.constraints = combine_member_constraints([member for _, member in members])
+        self.cuisine_counts, self.avg_spice_tolerance = summarize_soft_preferences(self.constraints['soft'])
+        self._members = members
+        self._member_masks = member_masks
+        self._compatible = {}  # catalogue name -> (serial, compatible mask); only the latest load is kept
+
+    def compatible_mask(self, catalogue: FoodCatalogue) -> int:
+        """Mask of the catalogue's foods that satisfy every member's hard constraints."""
+        serial, mask = self._compatible.get(catalogue.name, (None, None))
+        if serial != catalogue.serial:
+            excluded = 0
+            for key, member in self._members:
+                mask_key = key + (catalogue.serial,) if key is not None else None
+                member_mask = self._member_masks.get(mask_key) if mask_key is not None else None
+                if member_mask is None:
+                    member_mask = catalogue.index.excluded_mask(member.hard)
+                    if mask_key is not None:
+                        self._member_masks.set(mask_key, member_mask)
+                excluded |= member_mask
+            mask = catalogue.index.all_mask & ~excluded
+            self._compatible[catalogue.name] = (catalogue.serial, mask)
+        return mask
+
+    def match(self, catalogue: FoodCatalogue, max_candidates: int = 200) -> ConstraintMatch:
+        """Same result as match_hard_constraints(self.constraints, ...), from the cached masks."""
+        return ConstraintMatch(
+            catalogue, mask_rows(self.compatible_mask(catalogue), catalogue.index.size), max_candidates
+        )
+
+
+class GroupConstraintCache:
+    """
+    Compiled constraints per member profile version and per team membership.
+
+    A team entry is keyed by team ID plus every member's (userId, version),
+    so adding/removing a member or editing a profile compiles a new entry
+    from the (still cached) contributions of the unchanged members. Members
+    without a version are compiled fresh every time.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._members = TTLCache(max_entries, ttl_seconds)  # (userId, version) -> MemberConstraints
+        self._member_masks = TTLCache(max_entries, ttl_seconds)  # (userId, version, catalogue) -> excluded mask
+        self._groups = TTLCache(max_entries, ttl_seconds)  # (teamId, member keys) -> CompiledGroupConstraints
+
+    def compile(self, team_id: Optional[str], members_constraints: List[Dict]) -> CompiledGroupConstraints:
+        keys = [member_version_key(member) for member in members_constraints]
+        group_key = (team_id, tuple(keys)) if team_id and all(keys) else None
+        if group_key is not None:
+            group = self._groups.get(group_key)
+            if group is not None:
+                mark_cache(True)
+                return group
+        mark_cache(False)
+
+        members = []
+        for key, member in zip(keys, members_constraints):
+            compiled = self._members.get(key) if key is not None else None
+            if compiled is None:
+                compiled = compile_member_constraints(member.get('constraints', {}))
+                if key is not None:
+                    self._members.set(key, compiled)
+            members.append((key, compiled))
+
+        group = CompiledGroupConstraints(members, self._member_masks)
+        if group_key is not None:
+            self._groups.set(group_key, group)
+        return group
+
+    def clear(self) -> None:
+        self._members.clear()
+        self._member_masks.clear()
+        self._groups.clear()
+
+
+GROUP_CONSTRAINTS = GroupConstraintCache(CONSTRAINT_CACHE_MAX_ENTRIES, CONSTRAINT_CACHE_TTL_SECONDS)
+
+
+# ============================================================================
+# OCCASION PARSING
+# ============================================================================
+
+# Keyword vocabularies, in priority order (first match wins where one value is picked)
+NUTRITION_KEYWORDS = {
+    'high protein': ('protein', 'desc'),
+    'low protein': ('protein', 'asc'),
+    'high calorie': ('calories', 'desc'),
+    'low calorie': ('calories', 'asc'),
+    'low cal': ('calories', 'asc'),
+    'diet': ('calories', 'asc'),
+    'healthy': ('calories', 'asc'),
+    'light': ('calories', 'asc'),
+    'high carb': ('carbs', 'desc'),
+    'low carb': ('carbs', 'asc'),
+    'keto': ('carbs', 'asc'),
+    'high fat': ('fat', 'desc'),
+    'low fat': ('fat', 'asc')
+}
+
+HEAVINESS_KEYWORDS = {
+    'light': ['light', 'not too heavy', 'something light'],
+    'medium': ['medium', 'moderate'],
+    'heavy': ['heavy', 'filling', 'hearty', 'substantial']
+}
+
+# Matching all 10 database meal types
+MEAL_TYPE_KEYWORDS = {
+    'rice-based': ['rice', 'bibimbap', 'rice bowl', 'fried rice', 'risotto', 'pilaf'],
+    'soup-based': ['soup', 'stew', 'jjigae', 'hot pot', 'broth', 'chowder'],
+    'meat-based': ['meat', 'beef', 'pork', 'chicken', 'steak', 'bbq', 'barbecue', 'grilled', 'gui'],
+    'noodle-based': ['noodle', 'pasta', 'ramen', 'udon', 'soba', 'spaghetti', 'linguine'],
+    'seafood-based': ['seafood', 'fish', 'shrimp', 'crab', 'lobster', 'salmon', 'tuna', 'sushi'],
+    'bread-based': ['bread', 'sandwich', 'wrap', 'burger', 'toast', 'baguette'],
+    'salad-based': ['salad', 'greens', 'lettuce', 'fresh'],
+    'snack': ['snack', 'appetizer', 'side dish', 'banchan', 'finger food'],
+    'dessert': ['dessert', 'sweet', 'cake', 'ice cream', 'pastry', 'pudding'],
+    'beverage': ['beverage', 'drink', 'juice', 'smoothie', 'tea', 'coffee']
+}
+
+OCCASION_INGREDIENT_KEYWORDS = [
+    'tofu', 'chicken', 'beef', 'pork', 'fish', 'shrimp', 'salmon',
+    'egg', 'cheese', 'mushroom', 'noodle', 'rice', 'pasta', 'kimchi',
+    'seaweed', 'avocado', 'tomato', 'potato', 'spinach', 'broccoli'
+]
+
+CUISINE_KEYWORDS = {
+    'korean': 'korean',
+    'japanese': 'japanese',
+    'chinese': 'chinese',
+    'italian': 'western',
+    'mexican': 'mexican',
+    'thai': 'southeast asian',
+    'vietnamese': 'southeast asian'
+}
+
+
+class OccasionIntent(NamedTuple):
+    """What an occasion note asks for; fields are None/empty when not mentioned."""
+    nutrient: Optional[str] = None             # 'protein', 'calories', 'carbs', 'fat'
+    direction: Optional[str] = None            # 'asc' or 'desc'
+    nutrition_keyword: Optional[str] = None    # keyword that set nutrient/direction
+    heaviness: Optional[str] = None            # 'light', 'medium', 'heavy'
+    meal_type: Optional[str] = None            # e.g. 'soup-based'
+    ingredients: Tuple[str, ...] = ()          # e.g. ('tofu', 'mushroom')
+    cuisine: Optional[str] = None              # database cuisine, e.g. 'southeast asian'
+
+
+class OccasionMatcher:
+    """
+    Single-pass keyword matcher over all occasion vocabularies.
+
+    Every keyword is compiled into one regex that matches whole words (with an
+    optional plural "s"/"es"), so "tea" no longer fires on "team" and "rice"
+    no longer fires on "price". The regex is a lookahead, so overlapping
+    keywords at different positions ("not too heavy" / "heavy") are all seen;
+    keywords contained in a longer keyword starting at the same position
+    ("rice bowl" / "rice") are credited through a precomputed expansion.
+    """
+
+    def __init__(self):
+        # keyword -> [(slot, priority, value)]
+        self._hits: Dict[str, List[Tuple[str, int, Any]]] = {}
+
+        for priority, (keyword, (nutrient, direction)) in enumerate(NUTRITION_KEYWORDS.items()):
+            self._add(keyword, 'nutrition', priority, (nutrient, direction, keyword))
+        for priority, (heaviness, keywords) in enumerate(HEAVINESS_KEYWORDS.items()):
+            for keyword in keywords:
+                self._add(keyword, 'heaviness', priority, heaviness)
+        for priority, (meal_type, keywords) in enumerate(MEAL_TYPE_KEYWORDS.items()):
+            for keyword in keywords:
+                self._add(keyword, 'meal_type', priority, meal_type)
+        for priority, keyword in enumerate(OCCASION_INGREDIENT_KEYWORDS):
+            self._add(keyword, 'ingredient', priority, keyword)
+        for priority, (keyword, cuisine) in enumerate(CUISINE_KEYWORDS.items()):
+            self._add(keyword, 'cuisine', priority, cuisine)
+
+        keywords = sorted(self._hits, key=len, reverse=True)
+        alternation = '|'.join(re.escape(k) for k in keywords)
+        self._pattern = re.compile(r'\b(?=(' + alternation + r')(?:e?s)?\b)')
+
+        # Credit shorter keywords found inside a longer one ("fried rice" -> "rice")
+        self._expanded = {}
+        for keyword in keywords:
+            hits = list(self._hits[keyword])
+            for other in keywords:
+                if other != keyword and re.search(r'\b' + re.escape(other) + r'(?:e?s)?\b', keyword):
+                    hits.extend(self._hits[other])
+            self._expanded[keyword] = hits
+
+    def _add(self, keyword: str, slot: str, priority: int, value: Any) -> None:
+        self._hits.setdefault(keyword, []).append((slot, priority, value))
+
+    def parse(self, text: str) -> OccasionIntent:
+        """Parse already-normalized occasion text (see normalize_occasion)."""
+        best: Dict[str, Tuple[int, Any]] = {}
+        ingredients: Dict[int, str] = {}
+
+        for match in self._pattern.finditer(text):
+            for slot, priority, value in self._expanded[match.group(1)]:
+                if slot == 'ingredient':
+                    ingredients[priority] = value
+                elif slot not in best or priority < best[slot][0]:
+                    best[slot] = (priority, value)
+
+        nutrient, direction, nutrition_keyword = best['nutrition'][1] if 'nutrition' in best else (None, None, None)
+        return OccasionIntent(
+            nutrient=nutrient,
+            direction=direction,
+            nutrition_keyword=nutrition_keyword,
+            heaviness=best['heaviness'][1] if 'heaviness' in best else None,
+            meal_type=best['meal_type'][1] if 'meal_type' in best else None,
+            ingredients=tuple(ingredients[p] for p in sorted(ingredients)),
+            cuisine=best['cuisine'][1] if 'cuisine' in best else None
+        )
+
+
+OCCASION_MATCHER = OccasionMatcher()
+
+
+@lru_cache(maxsize=1024)
+def _parse_normalized_occasion(occasion: str) -> OccasionIntent:
+    return OCCASION_MATCHER.parse(occasion)
+
+
+def parse_occasion(occasion: Optional[str]) -> OccasionIntent:
+    """
+    Parse an occasion note into a structured intent (memoized per normalized text).
+
+    Args:
+        occasion: Occasion/poll title text (may be None)
+
+    Returns:
+        OccasionIntent shared by the nutrition, meal-characteristic,
+        ingredient and cuisine steps
+    """
+    return _parse_normalized_occasion(normalize_occasion(occasion))
+
+
+# ============================================================================
+# LLM RANKING ENGINE (DEADLINE, HEDGING, LOCAL FALLBACK)
+# ============================================================================
+
+# Longest a poll start waits for the LLM before using the local ranking
+LLM_RANKING_DEADLINE_SECONDS = float(os.environ.get("LLM_RANKING_DEADLINE_SECONDS", 5))
+# Send a second (hedged) request if the first has not answered by then; 0 disables
+LLM_HEDGE_AFTER_SECONDS = float(os.environ.get("LLM_HEDGE_AFTER_SECONDS", 0))
+# HTTP timeout of one request; answers arriving after the deadline still fill the cache
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("LLM_REQUEST_TIMEOUT_SECONDS", 20))
+
+LLM_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("LLM_WORKERS", 8)),
+    thread_name_prefix="llm"
+)
+
+# Local scorer: penalty per spice level away from the group's preferred level,
+# relative to one member favoring the food's cuisine
+LOCAL_SPICE_PENALTY = 0.5
+
+_llm_client = None
+_llm_client_key = None
+_llm_client_lock = threading.Lock()
+
+
+def get_llm_client(api_key: str):
+    """
+    Process-wide OpenAI client, so rankings reuse its HTTP connection pool.
+    Retries are off; the hedged request takes their place within the deadline.
+    """
+    global _llm_client, _llm_client_key
+    key = (openai.OpenAI, api_key)  # Rebuilt if the key (or the client class) changes
+    with _llm_client_lock:
+        if _llm_client is None or _llm_client_key != key:
+            _llm_client = openai.OpenAI(api_key=api_key, timeout=LLM_REQUEST_TIMEOUT_SECONDS, max_retries=0)
+            _llm_client_key = key
+        return _llm_client
+
+
+def request_llm_ranking(prompt: str, api_key: str) -> List[str]:
+    """
+    Send one ranking prompt to the LLM.
+
+    Returns:
+        Ranked food IDs from the model's JSON answer
+
+    Raises:
+        Exception: request failed or the answer is not the expected JSON
+    """
+    response = get_llm_client(api_key).chat.completions.create(
+        model=LLM_RANKING_MODEL,
+        messages=[
+            {"role": "system", "content": "You rank meals by soft preferences. Return only valid JSON."},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=300,
+        temperature=0.7
+    )
+
+    result_text = response.choices[0].message.content.strip()
+    result = json.loads(result_text)
+    ranked_ids = result.get('ranked_food_ids', [])
+    if not isinstance(ranked_ids, list):
+        raise ValueError("ranked_food_ids is not a list")
+    return ranked_ids
+
+
+def rank_with_deadline(
+    prompt: str,
+    api_key: str,
+    cache_key: str,
+    deadline_seconds: float = None,
+    hedge_after_seconds: float = None
+) -> Optional[List[str]]:
+    """
+    Ask the LLM for a ranking but wait at most deadline_seconds.
+
+    If hedging is on, a second identical request is sent when the first has
+    not answered after hedge_after_seconds (or right away if it failed), and
+    the first successful answer wins. Requests still running at the deadline
+    are left to finish and their answer is cached for the next poll with the
+    same cache_key.
+
+    Returns:
+        Ranked food IDs, or None if no request succeeded before the deadline
+    """
+    if deadline_seconds is None:
+        deadline_seconds = LLM_RANKING_DEADLINE_SECONDS
+    if hedge_after_seconds is None:
+        hedge_after_seconds = LLM_HEDGE_AFTER_SECONDS
+
+    started = time.monotonic()
+    deadline = started + deadline_seconds
+    hedge_at = started + hedge_after_seconds if hedge_after_seconds > 0 else None
+
+    def cache_answer(future):
+        # First answer wins; a losing hedge must not replace it
+        if not future.cancelled() and future.exception() is None and RANKING_CACHE.get(cache_key) is None:
+            RANKING_CACHE.set(cache_key, future.result())
+
+    pending = set()
+
+    def launch():
+        future = LLM_EXECUTOR.submit(request_llm_ranking, prompt, api_key)
+        future.add_done_callback(cache_answer)
+        pending.add(future)
+
+    launch()
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+        wake_at = min(deadline, hedge_at) if hedge_at is not None else deadline
+        done, _ = wait(pending, timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            pending.discard(future)
+            if future.exception() is None:
+                return future.result()
+            print(f"⚠️  LLM ranking request failed: {future.exception()}", flush=True)
+
+        if hedge_at is not None and (not pending or time.monotonic() >= hedge_at):
+            print(f"🔁 Sending hedged LLM ranking request", flush=True)
+            launch()
+            hedge_at = None
+        elif not pending:
+            return None
+
+
+def rank_foods_locally(foods: List[FoodItem], soft: Dict, k: int) -> List[str]:
+    """
+    Deterministic soft-preference ranking used whenever the LLM answer is
+    unavailable or late: favorite-cuisine member count minus a penalty for
+    spice distance from the group's average tolerance. Ties keep input order.
+
+    Returns:
+        Food IDs of the k best foods, best first
+    """
+    cuisine_counts, avg_spice_tolerance = summarize_soft_preferences(soft)
+    # Tolerance is on a 1-3 scale, food spice on 0-4
+    preferred_spice = (avg_spice_tolerance - 1) * 2
+    scores = [
+        cuisine_counts.get(food.cuisine, 0) - LOCAL_SPICE_PENALTY * abs(food.spice_level - preferred_spice)
+        for food in foods
+    ]
+    best = top_k(range(len(foods)), k, key=lambda i: (-scores[i], i))
+    return [foods[i].food_id for i in best]
 
 
 # ============================================================================
 # LLM RANKING (SOFT PREFERENCES ONLY)
 # ============================================================================
 
-def filter_by_nutrition(foods: List[Dict], occasion: str) -> List[Dict]:
+def filter_by_nutrition(foods: List[FoodItem], occasion: str, limit: Optional[int] = None) -> List[FoodItem]:
     """
     Filter/rank foods by nutrition keywords mentioned in occasion.
     E.g., "high protein" → rank foods by protein content (highest first)
@@ -241,6 +2212,8 @@ def filter_by_nutrition(foods: List[Dict], occasion: str) -> List[Dict]:
     Args:
         foods: List of food items
         occasion: Occasion/poll title text
+        limit: Only return the best `limit` foods (partial top-k selection
+            instead of sorting every food)
 
     Returns:
         List of foods sorted by nutrition criteria (or original if no nutrition request)
@@ -248,65 +2221,59 @@ def filter_by_nutrition(foods: List[Dict], occasion: str) -> List[Dict]:
     if not occasion:
         return foods
 
-    occasion_lower = occasion.lower()
-
-    # Detect nutrition-based requests
-    nutrition_filters = {
-        'high protein': ('protein', 'desc'),
-        'low protein': ('protein', 'asc'),
-        'high calorie': ('calories', 'desc'),
-        'low calorie': ('calories', 'asc'),
-        'low cal': ('calories', 'asc'),
-        'diet': ('calories', 'asc'),
-        'healthy': ('calories', 'asc'),
-        'light': ('calories', 'asc'),
-        'high carb': ('carbs', 'desc'),
-        'low carb': ('carbs', 'asc'),
-        'keto': ('carbs', 'asc'),
-        'high fat': ('fat', 'desc'),
-        'low fat': ('fat', 'asc')
-    }
-
-    # Find matching nutrition criteria
-    nutrient = None
-    direction = None
-    matched_keyword = None
-
-    for keyword, (nut, dir) in nutrition_filters.items():
-        if keyword in occasion_lower:
-            nutrient = nut
-            direction = dir
-            matched_keyword = keyword
-            break
+    intent = parse_occasion(occasion)
+    nutrient = intent.nutrient
+    direction = intent.direction
+    matched_keyword = intent.nutrition_keyword
 
     # If no nutrition request found, return original list
     if not nutrient:
         return foods
 
-    # Filter out foods without nutrition data
-    foods_with_nutrition = [f for f in foods if f.get('nutrition') and f['nutrition'].get(nutrient) is not None]
+    # Drop foods without a value for the nutrient, then sort the rest by it
+    columns, rows = columns_for(foods)
+    values = columns.nutrition[nutrient][rows]
+    kept = np.flatnonzero(~np.isnan(values))
 
-    if not foods_with_nutrition:
+    if not len(kept):
         print(f"   ⚠️  No foods have {nutrient} data, returning all foods", flush=True)
-        return foods
+        return foods[:limit] if limit is not None else foods
 
-    # Sort by the nutrient
+    # Stable order; negating for 'desc' keeps ties in input order, like sorted(reverse=True)
     reverse = (direction == 'desc')
-    sorted_foods = sorted(foods_with_nutrition, key=lambda f: f['nutrition'].get(nutrient, 0), reverse=reverse)
+    keys = -values[kept] if reverse else values[kept]
+    order = kept[top_k_indices(keys, limit)]
+    sorted_foods = take_rows(foods, columns, rows, order)
 
     print(f"   🥗 Nutrition filter: '{matched_keyword}' detected", flush=True)
-    print(f"   → Sorted {len(sorted_foods)} foods by {nutrient} ({'highest' if reverse else 'lowest'} first)", flush=True)
+    print(f"   → Sorted {len(sorted_foods)} of {len(kept)} foods by {nutrient} ({'highest' if reverse else 'lowest'} first)", flush=True)
 
     # Show top 3 examples
     if len(sorted_foods) >= 3:
         for i, food in enumerate(sorted_foods[:3], 1):
-            value = food['nutrition'].get(nutrient, 'N/A')
-            print(f"      {i}. {food['name']}: {value}g {nutrient}", flush=True)
+            value = food.nutrition.get(nutrient, 'N/A')
+            print(f"      {i}. {food.name}: {value}g {nutrient}", flush=True)
 
     return sorted_foods
 
 
-def filter_by_meal_characteristics(foods: List[Dict], occasion: str) -> List[Dict]:
+def keep_foods_with_nutrient(foods: List[FoodItem], occasion: str) -> List[FoodItem]:
+    """
+    The filtering half of filter_by_nutrition: drop foods without a value for
+    the requested nutrient, keeping input order (all foods if none have one).
+    """
+    nutrient = parse_occasion(occasion).nutrient
+    if not foods or not nutrient:
+        return foods
+
+    columns, rows = columns_for(foods)
+    kept = np.flatnonzero(~np.isnan(columns.nutrition[nutrient][rows]))
+    if not len(kept) or len(kept) == len(foods):
+        return foods
+    return take_rows(foods, columns, rows, kept)
+
+
+def filter_by_meal_characteristics(foods: List[FoodItem], occasion: str) -> List[FoodItem]:
     """
     Filter foods by meal characteristics mentioned in occasion.
     E.g., "something heavy" → only heavy meals
@@ -322,63 +2289,22 @@ def filter_by_meal_characteristics(foods: List[Dict], occasion: str) -> List[Dic
     if not occasion:
         return foods
 
-    occasion_lower = occasion.lower()
-
-    # Detect heaviness preferences
-    heaviness_keywords = {
-        'light': ['light', 'not too heavy', 'something light'],
-        'medium': ['medium', 'moderate'],
-        'heavy': ['heavy', 'filling', 'hearty', 'substantial']
-    }
-
-    # Detect meal-type preferences (matching all 10 database types)
-    meal_type_keywords = {
-        'rice-based': ['rice', 'bibimbap', 'rice bowl', 'fried rice', 'risotto', 'pilaf'],
-        'soup-based': ['soup', 'stew', 'jjigae', 'hot pot', 'broth', 'chowder'],
-        'meat-based': ['meat', 'beef', 'pork', 'chicken', 'steak', 'bbq', 'barbecue', 'grilled', 'gui'],
-        'noodle-based': ['noodle', 'pasta', 'ramen', 'udon', 'soba', 'spaghetti', 'linguine'],
-        'seafood-based': ['seafood', 'fish', 'shrimp', 'crab', 'lobster', 'salmon', 'tuna', 'sushi'],
-        'bread-based': ['bread', 'sandwich', 'wrap', 'burger', 'toast', 'baguette'],
-        'salad-based': ['salad', 'greens', 'lettuce', 'fresh'],
-        'snack': ['snack', 'appetizer', 'side dish', 'banchan', 'finger food'],
-        'dessert': ['dessert', 'sweet', 'cake', 'ice cream', 'pastry', 'pudding'],
-        'beverage': ['beverage', 'drink', 'juice', 'smoothie', 'tea', 'coffee']
-    }
-
-    # Check for heaviness match
-    matched_heaviness = None
-    for heaviness, keywords in heaviness_keywords.items():
-        if any(keyword in occasion_lower for keyword in keywords):
-            matched_heaviness = heaviness
-            break
-
-    # Check for meal-type match
-    matched_meal_type = None
-    for meal_type, keywords in meal_type_keywords.items():
-        if any(keyword in occasion_lower for keyword in keywords):
-            matched_meal_type = meal_type
-            break
+    intent = parse_occasion(occasion)
+    matched_heaviness = intent.heaviness
+    matched_meal_type = intent.meal_type
 
     # If no match found, return original list
     if not matched_heaviness and not matched_meal_type:
         return foods
 
-    # Filter by matched characteristics
-    filtered = []
-    for food in foods:
-        # Check heaviness match
-        if matched_heaviness:
-            food_heaviness = food.get('heaviness', 'medium')
-            if food_heaviness != matched_heaviness:
-                continue
-
-        # Check meal-type match
-        if matched_meal_type:
-            food_meal_type = food.get('meal_type', '')
-            if food_meal_type != matched_meal_type:
-                continue
-
-        filtered.append(food)
+    # Filter by matched characteristics (unknown values match no food)
+    columns, rows = columns_for(foods)
+    keep = np.ones(len(rows), dtype=bool)
+    if matched_heaviness:
+        keep &= columns.codes['heaviness'][rows] == columns.code('heaviness', matched_heaviness)
+    if matched_meal_type:
+        keep &= columns.codes['meal_type'][rows] == columns.code('meal_type', matched_meal_type)
+    filtered = take_rows(foods, columns, rows, np.flatnonzero(keep))
 
     if filtered:
         characteristics = []
@@ -395,7 +2321,7 @@ def filter_by_meal_characteristics(foods: List[Dict], occasion: str) -> List[Dic
         return foods
 
 
-def filter_by_occasion_ingredient(foods: List[Dict], occasion: str) -> List[Dict]:
+def filter_by_occasion_ingredient(foods: List[FoodItem], occasion: str) -> List[FoodItem]:
     """
     Filter foods by ingredient keywords mentioned in occasion.
     E.g., "recommend tofu dishes" → only return foods with tofu in ingredients
@@ -410,111 +2336,45 @@ def filter_by_occasion_ingredient(foods: List[Dict], occasion: str) -> List[Dict
     if not occasion:
         return foods
 
-    occasion_lower = occasion.lower()
-
-    # Common ingredient keywords to detect
-    ingredient_keywords = [
-        'tofu', 'chicken', 'beef', 'pork', 'fish', 'shrimp', 'salmon',
-        'egg', 'cheese', 'mushroom', 'noodle', 'rice', 'pasta', 'kimchi',
-        'seaweed', 'avocado', 'tomato', 'potato', 'spinach', 'broccoli'
-    ]
-
-    # Check if occasion mentions any specific ingredient
-    mentioned_ingredients = []
-    for keyword in ingredient_keywords:
-        if keyword in occasion_lower:
-            mentioned_ingredients.append(keyword)
+    mentioned_ingredients = list(parse_occasion(occasion).ingredients)
 
     # If no specific ingredient mentioned, return all foods
     if not mentioned_ingredients:
         return foods
 
-    # Filter foods to only include those with the mentioned ingredients
-    filtered = []
-    for food in foods:
-        food_ingredients_lower = [ing.lower() for ing in food.get('ingredients', [])]
-
-        # Check if food contains ANY of the mentioned ingredients
-        if any(ingredient in ' '.join(food_ingredients_lower) for ingredient in mentioned_ingredients):
-            filtered.append(food)
-
-    print(f"   🔍 Occasion ingredient filter: Found '{', '.join(mentioned_ingredients)}' in occasion", flush=True)
-    print(f"   → Filtered from {len(foods)} to {len(filtered)} foods containing those ingredients", flush=True)
-
-    # If no foods match, return original list (LLM will do its best)
-    if not filtered:
-        print(f"   ⚠️  No foods contain {mentioned_ingredients}, returning all foods", flush=True)
-        return foods
-
-    return filtered
-
-
-def rank_foods_with_llm(
-    filtered_foods: List[Dict],
-    group_constraints: Dict,
-    occasion: str = None,
-    top_k: int = 15
-) -> List[Dict]:
-    """
-    LLM ranks pre-filtered foods by soft preferences ONLY.
-    Hard constraints have already been applied by filter_foods_by_constraints().
-
-    Args:
-        filtered_foods: List of foods that passed hard constraint filtering
-        group_constraints: Output from build_group_constraints()
-        occasion: Optional occasion/poll title for context
-        top_k: Number of top-ranked foods to return
-
-    Returns:
-        List of food dicts with added 'ranking' field (0-indexed, lower is better)
-    """
-    if not filtered_foods:
-        return []
-
-    # Apply nutrition-based sorting FIRST (if applicable)
-    filtered_foods = filter_by_nutrition(filtered_foods, occasion)
-
-    # Apply meal characteristic filtering (heaviness, meal-type)
-    filtered_foods = filter_by_meal_characteristics(filtered_foods, occasion)
+    # Keep foods containing ANY of the mentioned ingredients
+    columns, rows = columns_for(foods)
+    keep = np.zeros(len(rows), dtype=bool)
+    for ingredient in mentioned_ingredients:
+        keep |= columns.ingredient_mask(ingredient)[rows]
+    filtered = take_rows(foods, columns, rows, np.flatnonzero(keep))
 
-    # Apply occasion-based ingredient filtering (if applicable)
-    filtered_foods = filter_by_occasion_ingredient(filtered_foods, occasion)
+    print(f"   🔍 Occasion ingredient filter: Found '{', '.join(mentioned_ingredients)}' in occasion", flush=True)
+    print(f"   → Filtered from {len(foods)} to {len(filtered)} foods containing those ingredients", flush=True)
 
-    soft = group_constraints['soft']
+    # If no foods match, return original list (LLM will do its best)
+    if not filtered:
+        print(f"   ⚠️  No foods contain {mentioned_ingredients}, returning all foods", flush=True)
+        return foods
 
-    # Build compact food list for LLM (reduce token usage)
-    food_summaries = []
-    for food in filtered_foods[:50]:  # Limit to 50 foods for token budget
-        summary = {
-            'food_id': food['food_id'],
-            'name': food['name'],
-            'cuisine': food['cuisine'],
-            'spice_level': food.get('spice_level', 0),
-            'heaviness': food.get('heaviness', 'medium'),
-            'meal_type': food.get('meal_type', 'unknown'),
-            'description': food.get('description', ''),
-            'ingredients': food.get('ingredients', []),
-            'allergens': food.get('allergens', []),
-            'dietary_violations': food.get('dietary_violations', []),
-            'nutrition': food.get('nutrition', {})
-        }
-        food_summaries.append(summary)
+    return filtered
 
-    # Build soft preference summary
-    cuisine_counts = {}
-    for cuisine in soft['favorite_cuisines']:
-        cuisine_counts[cuisine] = cuisine_counts.get(cuisine, 0) + 1
 
-    # Calculate average spice tolerance
-    avg_spice_map = {'MILD': 1, 'MEDIUM': 2, 'SPICY': 3}
-    spice_scores = [avg_spice_map.get(s.upper(), 2) for s in soft['spice_tolerances']]
-    avg_spice_tolerance = sum(spice_scores) / len(spice_scores) if spice_scores else 2
+def build_ranking_prompt(
+    prompt_foods: List[FoodItem],
+    group_constraints: Dict,
+    occasion: str = None,
+    top_k: int = 15
+) -> str:
+    """LLM prompt asking to rank prompt_foods by the group's soft preferences."""
+    # Build soft preference summary (cuisine counts + average spice tolerance)
+    cuisine_counts, avg_spice_tolerance = summarize_soft_preferences(group_constraints['soft'])
 
     # Get hard constraints for LLM context
     hard = group_constraints['hard']
 
     # Build LLM prompt
-    prompt = f"""You are a meal recommendation assistant. Rank the following {len(food_summaries)} meals based on how well they match the group's preferences.
+    prompt = f"""You are a meal recommendation assistant. Rank the following {len(prompt_foods)} meals based on how well they match the group's preferences.
 
 IMPORTANT: All meals have ALREADY been filtered to satisfy hard constraints. However, the constraint information is provided for your awareness.
 
@@ -532,16 +2392,16 @@ IMPORTANT: All meals have ALREADY been filtered to satisfy hard constraints. How
         prompt += f"- Occasion note: \"{occasion}\"\n"
 
     prompt += f"\n## Candidate Meals (ALREADY HARD-FILTERED - ALL ARE SAFE):\n"
-    for i, food in enumerate(food_summaries, 1):
-        ingredients_str = ', '.join(food['ingredients'][:6]) if food['ingredients'] else 'N/A'
-        allergens_str = ', '.join(food['allergens']) if food['allergens'] else 'none'
-        violations_str = ', '.join(food['dietary_violations']) if food['dietary_violations'] else 'none'
+    for i, food in enumerate(prompt_foods, 1):
+        ingredients_str = ', '.join(food.ingredients[:6]) if food.ingredients else 'N/A'
+        allergens_str = ', '.join(food.allergens) if food.allergens else 'none'
+        violations_str = ', '.join(food.dietary_violations) if food.dietary_violations else 'none'
 
         # Format nutrition info
-        nutrition = food['nutrition']
+        nutrition = food.nutrition
         nutrition_str = f"{nutrition.get('calories', 'N/A')}cal" if nutrition else 'N/A'
 
-        prompt += f"{i}. {food['name']} ({food['food_id']}) - {food['cuisine']}, spice {food['spice_level']}/4, {food['heaviness']}, {nutrition_str}\n"
+        prompt += f"{i}. {food.name} ({food.food_id}) - {food.cuisine}, spice {food.spice_level}/4, {food.heaviness}, {nutrition_str}\n"
         prompt += f"   Ingredients: [{ingredients_str}] | Allergens: [{allergens_str}] | Dietary: [{violations_str}]\n"
 
     prompt += f"""
@@ -558,66 +2418,137 @@ IMPORTANT: All meals have ALREADY been filtered to satisfy hard constraints. How
 Return ONLY valid JSON with this exact format:
 {{"ranked_food_ids": ["F001", "F023", "F117"]}}
 """
+    return prompt
 
-    # Call OpenAI API
-    try:
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            print("⚠️  No OpenAI API key - using fallback ranking")
-            raise Exception("No API key")
-
-        client = openai.OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You rank meals by soft preferences. Return only valid JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=300,
-            temperature=0.7
-        )
 
-        result_text = response.choices[0].message.content.strip()
-        result = json.loads(result_text)
-        ranked_ids = result.get('ranked_food_ids', [])
+def rank_foods_with_llm(
+    filtered_foods: List[FoodItem],
+    group_constraints: Dict,
+    occasion: str = None,
+    top_k: int = 15,
+    catalogue: FoodCatalogue = None
+) -> List[Tuple[str, int]]:
+    """
+    LLM ranks pre-filtered foods by soft preferences ONLY.
+    Hard constraints have already been applied by filter_foods_by_constraints().
+
+    The LLM gets LLM_RANKING_DEADLINE_SECONDS to answer (see
+    rank_with_deadline()); without a timely answer the deterministic
+    rank_foods_locally() ranking is returned instead.
+
+    Args:
+        filtered_foods: List of foods that passed hard constraint filtering
+        group_constraints: Output from build_group_constraints()
+        occasion: Optional occasion/poll title for context
+        top_k: Number of top-ranked foods to return
+        catalogue: Catalogue the foods came from (its version is part of the cache key)
+
+    Returns:
+        List of (food_id, ranking) pairs (ranking is 0-indexed, lower is better)
+    """
+    if not filtered_foods:
+        return []
 
-        print(f"✅ LLM ranked {len(ranked_ids)} foods")
+    # Drop foods missing the nutrient the occasion asks about (if applicable)
+    with trace_stage("nutrient_filter", items_in=len(filtered_foods)) as span:
+        filtered_foods = keep_foods_with_nutrient(filtered_foods, occasion)
+        span.items_out = len(filtered_foods)
 
-        # Map back to full food objects with ranking
-        ranked_foods = []
-        id_to_food = {f['food_id']: f for f in filtered_foods}
+    # Apply meal characteristic filtering (heaviness, meal-type)
+    with trace_stage("meal_filter", items_in=len(filtered_foods)) as span:
+        filtered_foods = filter_by_meal_characteristics(filtered_foods, occasion)
+        span.items_out = len(filtered_foods)
 
-        for rank, food_id in enumerate(ranked_ids[:top_k]):
-            if food_id in id_to_food:
-                food = id_to_food[food_id].copy()
-                food['ranking'] = rank
-                ranked_foods.append(food)
+    # Apply occasion-based ingredient filtering (if applicable)
+    with trace_stage("ingredient_filter", items_in=len(filtered_foods)) as span:
+        filtered_foods = filter_by_occasion_ingredient(filtered_foods, occasion)
+        span.items_out = len(filtered_foods)
+
+    # Apply nutrition-based ordering LAST. Both filters above keep input order,
+    # so this equals sorting first, but only the foods that can reach the
+    # prompt (or the fallback) need to be selected.
+    with trace_stage("nutrition_order", items_in=len(filtered_foods)) as span:
+        filtered_foods = filter_by_nutrition(
+            filtered_foods, occasion, limit=max(LLM_PROMPT_FOOD_LIMIT, top_k)
+        )
+        span.items_out = len(filtered_foods)
 
-        # If LLM didn't return enough, pad with remaining filtered foods
-        if len(ranked_foods) < top_k:
-            existing_ids = {f['food_id'] for f in ranked_foods}
-            for food in filtered_foods:
-                if food['food_id'] not in existing_ids:
-                    ranked_foods.append({**food, 'ranking': len(ranked_foods)})
-                    if len(ranked_foods) >= top_k:
-                        break
+    soft = group_constraints['soft']
 
-        return ranked_foods
+    # Foods shown to the LLM (token budget)
+    prompt_foods = filtered_foods[:LLM_PROMPT_FOOD_LIMIT]
 
-    except Exception as e:
-        print(f"⚠️  LLM ranking failed ({e}), using fallback ranking")
-        # Fallback: return first N filtered foods with sequential ranking
-        return [
-            {**food, 'ranking': i}
-            for i, food in enumerate(filtered_foods[:top_k])
-        ]
+    # Reuse a recent ranking for the same constraints, occasion and candidates
+    if catalogue is None:
+        catalogue = FOOD_CATALOGUE
+    cache_key = ranking_cache_key(
+        group_constraints, occasion, [food.food_id for food in prompt_foods], top_k,
+        catalogue_version=catalogue.version, catalogue_name=catalogue.name
+    )
+
+    # Deterministic ranking: the answer whenever the LLM is unavailable or late
+    with trace_stage("local_rank", items_in=len(filtered_foods)) as span:
+        local_ids = rank_foods_locally(filtered_foods, soft, top_k)
+        span.items_out = len(local_ids)
+
+    with trace_stage("llm_rank", items_in=len(prompt_foods)) as span:
+        ranked_ids = RANKING_CACHE.get(cache_key)
+        mark_cache(ranked_ids is not None)
+        if ranked_ids is not None:
+            print(f"⚡ Ranking cache hit: reusing {len(ranked_ids)} ranked foods")
+        else:
+            api_key = os.environ.get("OPENAI_API_KEY")
+            if not api_key:
+                print("⚠️  No OpenAI API key - using local ranking")
+            else:
+                try:
+                    # Only built on a cache miss; hits never pay for the prompt
+                    prompt = build_ranking_prompt(prompt_foods, group_constraints, occasion, top_k)
+                    ranked_ids = rank_with_deadline(prompt, api_key, cache_key)
+                except Exception as e:
+                    print(f"⚠️  LLM ranking failed ({e}), using local ranking")
+                else:
+                    if ranked_ids is None:
+                        print(f"⏱️  No usable LLM ranking within {LLM_RANKING_DEADLINE_SECONDS:g}s, using local ranking")
+                    else:
+                        print(f"✅ LLM ranked {len(ranked_ids)} foods")
+        span.items_out = len(ranked_ids) if ranked_ids is not None else 0
+
+    if ranked_ids is None:
+        return [(food_id, rank) for rank, food_id in enumerate(local_ids)]
+
+    # Keep only IDs of foods that were actually offered
+    ranked = []
+    known_ids = {food.food_id for food in filtered_foods}
+
+    for rank, food_id in enumerate(ranked_ids[:top_k]):
+        if food_id in known_ids:
+            ranked.append((food_id, rank))
+
+    # If LLM didn't return enough, pad with the locally ranked foods
+    if len(ranked) < top_k:
+        existing_ids = {food_id for food_id, _ in ranked}
+        for food_id in local_ids:
+            if food_id not in existing_ids:
+                ranked.append((food_id, len(ranked)))
+                if len(ranked) >= top_k:
+                    break
+
+    return ranked
 
 # ============================================================================
 # LEGACY FUNCTION (KEPT FOR BACKWARDS COMPATIBILITY - NOW USES NEW FLOW)
 # ============================================================================
 
 # Helper function to generate candidates using DATABASE-FIRST flow
-def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[str, Any]], num_candidates: int = 15, occasion: str = None) -> List[Dict[str, Any]]:
+def generate_candidates_for_team(
+    team_name: str,
+    members_constraints: List[Dict[str, Any]],
+    num_candidates: int = 15,
+    occasion: str = None,
+    catalogue_id: str = None,
+    team_id: str = None
+) -> List[Dict[str, Any]]:
     """
     Generate meal candidates using DATABASE-FIRST filtering + LLM ranking.
 
@@ -632,6 +2563,8 @@ def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[
         members_constraints: List of dicts with 'userId' and 'constraints' keys
         num_candidates: Number of candidates to generate (default 15 for two-phase voting)
         occasion: Optional poll title/occasion (e.g., "Korean food", "Italian restaurant")
+        catalogue_id: Named (per-location) catalogue to pick from; None for the default one
+        team_id: Team ID; with versioned members, reuses the team's compiled constraints
 
     Returns:
         List of dicts with 'name' and 'ranking' keys (ranking is 0-indexed, lower is better)
@@ -643,10 +2576,20 @@ def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[
         print(f"   Occasion: '{occasion}'", flush=True)
     print(f"{'='*60}", flush=True)
 
+    # One catalogue version for the whole run, even if a reload swaps it meanwhile.
+    # A missing or corrupt catalogue must not skip the fallback below.
     try:
-        # STEP 1: Build group constraints (union of all members)
+        catalogue = CATALOGUES.get(catalogue_id)
+    except Exception as e:
+        print(f"⚠️  Catalogue '{catalogue_id}' unavailable ({e}), using the default catalogue", flush=True)
+        catalogue = FOOD_CATALOGUE
+
+    try:
+        # STEP 1: Build group constraints (union of all members), reused while profiles are unchanged
         print(f"📊 Step 1: Building group constraints...", flush=True)
-        group_constraints = build_group_constraints(members_constraints)
+        with trace_stage("group_constraints", items_in=len(members_constraints)):
+            group = GROUP_CONSTRAINTS.compile(team_id, members_constraints)
+        group_constraints = group.constraints
 
         hard = group_constraints['hard']
         soft = group_constraints['soft']
@@ -661,11 +2604,16 @@ def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[
 
         # STEP 2: Filter food database by hard constraints
         print(f"\n🔍 Step 2: Filtering food database by hard constraints...", flush=True)
-        print(f"   Total foods in database: {len(FOOD_DATABASE)}", flush=True)
+        print(f"   Total foods in database: {len(catalogue)} "
+              f"(catalogue {catalogue.name or 'default'} v{catalogue.version})", flush=True)
 
-        filtered_foods = filter_foods_by_constraints(group_constraints, max_candidates=200)
+        with trace_stage("hard_filter", items_in=len(catalogue)) as span:
+            match = group.match(catalogue, max_candidates=200)
+            filtered_foods = match.foods
+            span.items_out = match.total
 
-        print(f"   ✅ Filtered to {len(filtered_foods)} foods that satisfy all hard constraints", flush=True)
+        print(f"   ✅ Filtered to {len(filtered_foods)} foods that satisfy all hard constraints"
+              + (f" (of {match.total} compatible)" if match.total > len(filtered_foods) else ""), flush=True)
 
         # Handle empty filter result
         if not filtered_foods:
@@ -675,26 +2623,12 @@ def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[
             return []
 
         # STEP 2.5: Check if requested cuisine is compatible (if occasion mentions a cuisine)
-        requested_cuisine = None
-        if occasion:
-            occasion_lower = occasion.lower()
-            # Check for common cuisine keywords
-            cuisine_keywords = {
-                'korean': 'korean',
-                'japanese': 'japanese',
-                'chinese': 'chinese',
-                'italian': 'western',
-                'mexican': 'mexican',
-                'thai': 'southeast asian',
-                'vietnamese': 'southeast asian'
-            }
-            for keyword, cuisine in cuisine_keywords.items():
-                if keyword in occasion_lower:
-                    requested_cuisine = cuisine
-                    break
+        requested_cuisine = parse_occasion(occasion).cuisine
 
-        # Analyze cuisine compatibility
-        cuisine_counts = analyze_cuisine_compatibility(group_constraints)
+        # Analyze cuisine compatibility (facet counts of the same match, no second scan)
+        with trace_stage("cuisine_analysis", items_in=match.total) as span:
+            cuisine_counts = analyze_cuisine_compatibility(group_constraints, match=match)
+            span.items_out = len(cuisine_counts)
         print(f"\n📊 Cuisine compatibility analysis:", flush=True)
         for cuisine, count in sorted(cuisine_counts.items(), key=lambda x: x[1], reverse=True):
             print(f"   - {cuisine}: {count} compatible foods", flush=True)
@@ -711,24 +2645,25 @@ def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[
         # STEP 3: LLM ranks filtered foods by soft preferences
         print(f"\n🤖 Step 3: LLM ranking filtered foods by soft preferences...", flush=True)
 
-        ranked_foods = rank_foods_with_llm(
+        ranking = rank_foods_with_llm(
             filtered_foods=filtered_foods,
             group_constraints=group_constraints,
             occasion=occasion,
-            top_k=num_candidates
+            top_k=num_candidates,
+            catalogue=catalogue
         )
 
         # Convert to expected format (name + ranking)
-        candidates = [
-            {
-                "name": food['name'],
-                "ranking": food['ranking'],
-                "food_id": food.get('food_id', ''),  # Include food_id for reference
-                "cuisine": food.get('cuisine', ''),
-                "spice_level": food.get('spice_level', 0)
-            }
-            for food in ranked_foods
-        ]
+        candidates = []
+        for food_id, rank in ranking:
+            food = catalogue.get(food_id)
+            candidates.append({
+                "name": food.name,
+                "ranking": rank,
+                "food_id": food_id,  # Include food_id for reference
+                "cuisine": food.cuisine,
+                "spice_level": food.spice_level
+            })
 
         print(f"\n🎯 Final {len(candidates)} candidates:", flush=True)
         for i, c in enumerate(candidates[:5], 1):
@@ -747,16 +2682,16 @@ def generate_candidates_for_team(team_name: str, members_constraints: List[Dict[
 
         # Fallback: return some foods from database without filtering
         print(f"📦 Using fallback: returning first {num_candidates} foods from database", flush=True)
-        if FOOD_DATABASE:
+        if len(catalogue):
             fallback = [
                 {
-                    "name": food['name'],
+                    "name": food.name,
                     "ranking": i,
-                    "food_id": food.get('food_id', ''),
-                    "cuisine": food.get('cuisine', ''),
-                    "spice_level": food.get('spice_level', 0)
+                    "food_id": food.food_id,
+                    "cuisine": food.cuisine,
+                    "spice_level": food.spice_level
                 }
-                for i, food in enumerate(FOOD_DATABASE[:num_candidates])
+                for i, food in enumerate(catalogue.foods[:num_candidates])
             ]
             return fallback
         else:
@@ -799,29 +2734,961 @@ def test_llm():
         print(f"❌ TEST FAILED: {e}", flush=True)
         print(f"{'='*60}\n", flush=True)
 
-        return jsonify({
-            "success": False,
-            "error": str(e),
-            "message": "OpenAI test failed. Check backend logs for details."
-        }), 500
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "message": "OpenAI test failed. Check backend logs for details."
+        }), 500
+
+
+@app.route("/check-email", methods=["POST"])
+def check_email():
+    data = request.get_json(force=True)
+    email = data.get("email", "").strip().lower()
+    if not email:
+        return jsonify({"error": "Email required"}), 400
+    try:
+        user = auth.get_user_by_email(email)
+        return jsonify({"exists": True, "uid": user.uid}), 200
+    except firebase_admin._auth_utils.UserNotFoundError:
+        return jsonify({"exists": False}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ============================================================================
+# NAMED CATALOGUES (PER LOCATION)
+# ============================================================================
+
+# Per-location catalogues: <catalogueId>.json or .jsonl files in this directory
+LOCATION_CATALOGUE_DIR = os.environ.get(
+    "LOCATION_CATALOGUE_DIR", os.path.join(os.path.dirname(__file__), "locations")
+)
+# Named catalogues loaded per worker at once, and idle time before one is dropped
+CATALOGUE_MAX_LOADED = int(os.environ.get("CATALOGUE_MAX_LOADED", 8))
+CATALOGUE_IDLE_SECONDS = float(os.environ.get("CATALOGUE_IDLE_SECONDS", 900))
+
+CATALOGUE_ID_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+CATALOGUE_SOURCE_EXTENSIONS = ('.json', '.jsonl', '.ndjson')
+
+
+def read_food_items(path: str) -> List[FoodItem]:
+    """Parse, validate and normalize a catalogue file into FoodItems (invalid items skipped)."""
+    return [FoodItem.from_dict(food) for food in map(normalize_food_item, iter_food_items(path)) if food]
+
+
+class CatalogueRegistry:
+    """
+    Named catalogues (one per location/restaurant), each with its own index
+    and columns, loaded on first use.
+
+    Loaded catalogues live in an LRU bounded by CATALOGUE_MAX_LOADED and are
+    dropped after CATALOGUE_IDLE_SECONDS without use, so memory follows the
+    catalogues teams are actually using (each get() sweeps out idle ones).
+    A catalogue is snapshotted under CATALOGUE_SNAPSHOT_DIR/<catalogueId>/
+    like the default one, and reloaded when its source file changes.
+
+    The empty ID (None or "") is the default FOOD_CATALOGUE.
+    """
+
+    def __init__(self, source_dir: str, max_loaded: int, idle_seconds: float):
+        self.source_dir = source_dir
+        self._loaded = TTLCache(max_loaded, idle_seconds)  # catalogueId -> (catalogue, source stat)
+        self._checked_at = {}  # catalogueId -> last time the source file was checked
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def source_path(self, catalogue_id: str) -> Optional[str]:
+        """Source file of a named catalogue, or None if there is none."""
+        if not self.source_dir or not CATALOGUE_ID_PATTERN.match(catalogue_id or ''):
+            return None
+        for extension in CATALOGUE_SOURCE_EXTENSIONS:
+            path = os.path.join(self.source_dir, catalogue_id + extension)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def exists(self, catalogue_id: Optional[str]) -> bool:
+        return not catalogue_id or self.source_path(catalogue_id) is not None
+
+    def names(self) -> List[str]:
+        """IDs of all named catalogues available to load."""
+        try:
+            entries = os.listdir(self.source_dir) if self.source_dir else []
+        except OSError:
+            return []
+        return sorted({
+            stem for stem, extension in map(os.path.splitext, entries)
+            if extension in CATALOGUE_SOURCE_EXTENSIONS and CATALOGUE_ID_PATTERN.match(stem)
+        })
+
+    def loaded(self) -> List[str]:
+        """IDs of the named catalogues currently held in memory."""
+        return [catalogue_id for catalogue_id in self.names() if self._loaded.peek(catalogue_id) is not None]
+
+    def get(self, catalogue_id: Optional[str]) -> FoodCatalogue:
+        """
+        Catalogue for an ID, loading it if needed.
+
+        Raises:
+            KeyError: no catalogue with this ID
+        """
+        # Release idle catalogues even if nothing else would evict them
+        self._loaded.expire()
+        if not catalogue_id:
+            return FOOD_CATALOGUE
+
+        entry = self._loaded.get(catalogue_id)
+        if entry is not None and time.time() - self._checked_at.get(catalogue_id, 0) < CATALOGUE_RELOAD_SECONDS:
+            self._loaded.set(catalogue_id, entry)  # Restart the idle timer
+            return entry[0]
+
+        path = self.source_path(catalogue_id)
+        if path is None:
+            if entry is not None:
+                return entry[0]  # Source removed; keep serving what is loaded
+            raise KeyError(catalogue_id)
+
+        with self._lock:
+            lock = self._locks.setdefault(catalogue_id, threading.Lock())
+        with lock:
+            stat = os.stat(path)
+            source_stat = (stat.st_mtime_ns, stat.st_size)
+            entry = self._loaded.get(catalogue_id)
+            if entry is None or entry[1] != source_stat:
+                entry = (self._load(catalogue_id, path), source_stat)
+            self._checked_at[catalogue_id] = time.time()
+            self._loaded.set(catalogue_id, entry)
+            return entry[0]
+
+    def _load(self, catalogue_id: str, path: str) -> FoodCatalogue:
+        if CATALOGUE_SNAPSHOT_DIR:
+            try:
+                snapshot = ensure_catalogue_snapshot(path, os.path.join(CATALOGUE_SNAPSHOT_DIR, catalogue_id))
+                if snapshot:
+                    catalogue = open_catalogue_snapshot(snapshot, name=catalogue_id)
+                    print(f"✅ Mapped catalogue '{catalogue_id}' v{catalogue.version} ({len(catalogue)} items)", flush=True)
+                    return catalogue
+            except (OSError, ValueError) as e:
+                print(f"⚠️  Snapshot for catalogue '{catalogue_id}' unavailable ({e}), loading {path} directly", flush=True)
+
+        catalogue = FoodCatalogue(read_food_items(path), name=catalogue_id)
+        print(f"✅ Loaded catalogue '{catalogue_id}' ({len(catalogue)} items)", flush=True)
+        return catalogue
+
+
+CATALOGUES = CatalogueRegistry(LOCATION_CATALOGUE_DIR, CATALOGUE_MAX_LOADED, CATALOGUE_IDLE_SECONDS)
+
+
+@app.route("/catalogues", methods=["GET"])
+def list_catalogues():
+    """Named food catalogues a team or poll can select with "catalogueId"."""
+    loaded = set(CATALOGUES.loaded())
+    return jsonify({
+        "catalogues": [
+            {"catalogueId": catalogue_id, "loaded": catalogue_id in loaded}
+            for catalogue_id in CATALOGUES.names()
+        ]
+    }), 200
+
+
+# ============================================================================
+# TEAM + POLL READ CACHE (GET /polls/<poll_id> HOT PATH)
+# ============================================================================
+
+# Clients refresh poll state every second; these short-lived caches absorb the
+# repeated reads. Writes in this process invalidate explicitly, so the TTL only
+# bounds staleness for writes made by other processes.
+TEAM_MEMBERS_CACHE = TTLCache(
+    max_entries=1024,
+    ttl_seconds=float(os.environ.get("TEAM_CACHE_TTL_SECONDS", 30))
+)
+POLL_CACHE = TTLCache(
+    max_entries=1024,
+    ttl_seconds=float(os.environ.get("POLL_CACHE_TTL_SECONDS", 1))
+)
+
+
+def get_team_members(team_id: str) -> List[str]:
+    """Read-through cache of a team's member IDs (empty if the team is missing)."""
+    members = TEAM_MEMBERS_CACHE.get(team_id)
+    if members is None:
+        team_doc = db.collection("teams").document(team_id).get()
+        members = team_doc.to_dict().get("members", []) if team_doc.exists else []
+        TEAM_MEMBERS_CACHE.set(team_id, members)
+    return members
+
+
+def get_poll_snapshot(poll_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Read-through cache of a poll document's data (None if it does not exist).
+    The returned dict is shared between readers and must not be mutated.
+    """
+    poll_data = POLL_CACHE.get(poll_id)
+    if poll_data is None:
+        poll_doc = db.collection("polls").document(poll_id).get()
+        if not poll_doc.exists:
+            return None
+        poll_data = poll_doc.to_dict()
+        if needs_ballot_migration(poll_data):
+            migrate_legacy_votes(poll_id)
+            poll_data = db.collection("polls").document(poll_id).get().to_dict()
+        POLL_CACHE.set(poll_id, poll_data)
+    return poll_data
+
+
+# Closed polls never change, so their serialized result is kept until evicted
+CLOSED_POLL_RESULTS = TTLCache(
+    max_entries=int(os.environ.get("CLOSED_POLL_CACHE_ENTRIES", 4096)),
+    ttl_seconds=float(os.environ.get("CLOSED_POLL_CACHE_TTL_SECONDS", 24 * 3600))
+)
+
+
+class ClosedPollResult(NamedTuple):
+    """Finalized GET /polls/<poll_id> payload of a closed poll."""
+    payload: Dict[str, Any]
+    body: str  # payload serialized once, served as-is
+    etag: str
+
+
+def is_poll_closed(poll_data: Dict[str, Any]) -> bool:
+    return poll_data.get("phase") == "closed" or poll_data.get("status") == "closed"
+
+
+def serialize_result_payload(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def closed_poll_result(poll_id: str, poll_data: Dict[str, Any]) -> ClosedPollResult:
+    """
+    Cached result of a closed poll. Uses the resultPayload stored at close,
+    or builds it for polls closed before results were stored.
+    """
+    result = CLOSED_POLL_RESULTS.get(poll_id)
+    if result is None:
+        body = poll_data.get("resultPayload")
+        if body is None:
+            body = serialize_result_payload(build_closed_poll_payload(poll_id, poll_data))
+        etag = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+        result = ClosedPollResult(json.loads(body), body, etag)
+        CLOSED_POLL_RESULTS.set(poll_id, result)
+    return result
+
+
+def notify_poll_changed(poll_id: str) -> None:
+    """Drop cached state for a poll after this process wrote to it and wake its streams."""
+    POLL_CACHE.delete(poll_id)
+    LOCKED_IN_CACHE.delete(poll_id)
+    POLL_EVENTS.publish(poll_id)
+
+
+# ============================================================================
+# POLL BALLOTS (PER-MEMBER VOTE DOCUMENTS + SHARDED TALLIES)
+# ============================================================================
+
+# Each member's votes live in their own document, polls/<poll_id>/ballots/<user_id>:
+#   {"userId": ..., "phase1": {"approved": [...], "rejected": str|None}, "phase2": str}
+# so members locking in at the same moment write different documents instead
+# of queueing on the poll. A member is locked in for a phase once their ballot
+# has a vote for it.
+#
+# Running tallies are spread over VOTE_COUNTER_SHARDS documents in
+# polls/<poll_id>/voteShards, each holding Increments:
+#   {"phase1LockedIn": n, "phase2LockedIn": n,
+#    "approvals": {name: n}, "rejections": {name: n}, "selections": {name: n}}
+# A vote adds the difference between the member's previous and new ballot,
+# so summing the shards gives the current totals without reading any ballot.
+#
+# Vote transactions read the poll document (a read lock only, so voters do
+# not contend) and refuse the vote unless its phase is still open. Transition
+# and close first set votingClosed to the phase in its own transaction; once
+# that commits, no vote for the phase can commit after it, so the tallies
+# they read next are final.
+VOTE_COUNTER_SHARDS = max(1, int(os.environ.get("VOTE_COUNTER_SHARDS", 8)))
+
+TALLY_FIELDS = ("approvals", "rejections", "selections")
+
+BALLOT_CACHE = TTLCache(max_entries=8192, ttl_seconds=POLL_CACHE.ttl_seconds)
+LOCKED_IN_CACHE = TTLCache(max_entries=1024, ttl_seconds=POLL_CACHE.ttl_seconds)
+
+
+def ballot_ref(poll_id: str, user_id: str):
+    return db.collection("polls").document(poll_id).collection("ballots").document(user_id)
+
+
+def vote_shard_refs(poll_id: str) -> List[Any]:
+    shards = db.collection("polls").document(poll_id).collection("voteShards")
+    return [shards.document(str(shard)) for shard in range(VOTE_COUNTER_SHARDS)]
+
+
+def random_vote_shard_ref(poll_id: str):
+    """Counter shard for one increment; spreading writes is the point of sharding."""
+    return vote_shard_refs(poll_id)[random.randrange(VOTE_COUNTER_SHARDS)]
+
+
+def tally_increments(field: str, previous: List[str], current: List[str]) -> Dict[str, Any]:
+    """
+    Shard update moving one member's contribution to a tally from the
+    candidates in `previous` to those in `current` ({} if nothing changed).
+    """
+    delta = Counter(current)
+    delta.subtract(previous)
+    increments = {candidate: firestore.Increment(count) for candidate, count in delta.items() if count}
+    return {field: increments} if increments else {}
+
+
+def read_vote_tallies(poll_id: str, transaction=None) -> Dict[str, Any]:
+    """
+    Current totals summed over the counter shards (uncached):
+    {"phase1LockedIn": n, "phase2LockedIn": n, "approvals": {name: n}, ...}.
+    Candidates whose tally went back to 0 are dropped. Inside a transaction,
+    pass it so a shard increment committing meanwhile forces a retry.
+    """
+    tallies = {"phase1LockedIn": 0, "phase2LockedIn": 0}
+    tallies.update({field: {} for field in TALLY_FIELDS})
+
+    for shard in db.get_all(vote_shard_refs(poll_id), transaction=transaction):
+        if not shard.exists:
+            continue
+        shard_data = shard.to_dict()
+        for phase_field in ("phase1LockedIn", "phase2LockedIn"):
+            tallies[phase_field] += shard_data.get(phase_field, 0)
+        for field in TALLY_FIELDS:
+            totals = tallies[field]
+            for candidate, count in shard_data.get(field, {}).items():
+                totals[candidate] = totals.get(candidate, 0) + count
+
+    for field in TALLY_FIELDS:
+        tallies[field] = {candidate: count for candidate, count in tallies[field].items() if count}
+    return tallies
+
+
+def read_locked_in_counts(poll_id: str) -> Dict[str, int]:
+    """Locked-in member count per phase (uncached)."""
+    tallies = read_vote_tallies(poll_id)
+    return {"phase1": tallies["phase1LockedIn"], "phase2": tallies["phase2LockedIn"]}
+
+
+def get_locked_in_counts(poll_id: str) -> Dict[str, int]:
+    """Read-through cache of read_locked_in_counts for the poll read path."""
+    counts = LOCKED_IN_CACHE.get(poll_id)
+    if counts is None:
+        counts = read_locked_in_counts(poll_id)
+        LOCKED_IN_CACHE.set(poll_id, counts)
+    return counts
+
+
+def check_phase_voting_open(poll_data: Dict[str, Any], phase: str) -> None:
+    """Raise ValueError unless the poll is active and still taking votes for `phase`."""
+    label = "Phase 1" if phase == "phase1" else "Phase 2"
+    if poll_data.get("status") != "active" or poll_data.get("phase") != phase:
+        raise ValueError(f"Poll is not in {label} (currently in {poll_data.get('phase')})")
+    if poll_data.get("votingClosed") == phase:
+        raise ValueError(f"{label} voting has ended")
+
+
+def stop_phase_voting(poll_id: str, phase: str = None) -> Optional[Dict[str, Any]]:
+    """
+    First step of a transition or close: mark the poll's current phase (or
+    `phase`, if it is the current one) as no longer taking votes.
+
+    Returns:
+        The poll data as of this step, or None if the poll does not exist
+    """
+    poll_ref = db.collection("polls").document(poll_id)
+
+    @transactional
+    def stop_in_transaction(transaction, poll_ref):
+        poll_snapshot = poll_ref.get(transaction=transaction)
+        if not poll_snapshot.exists:
+            return None
+
+        poll_data = poll_snapshot.to_dict()
+        current_phase = poll_data.get("phase")
+        if (poll_data.get("status") != "active" or current_phase not in ("phase1", "phase2")
+                or (phase is not None and current_phase != phase) or needs_ballot_migration(poll_data)):
+            return poll_data
+
+        if poll_data.get("votingClosed") != current_phase:
+            transaction.update(poll_ref, {"votingClosed": current_phase})
+            poll_data["votingClosed"] = current_phase
+        return poll_data
+
+    poll_data = stop_in_transaction(db.transaction(), poll_ref)
+    if poll_data is not None and needs_ballot_migration(poll_data):
+        migrate_legacy_votes(poll_id)
+        poll_data = stop_in_transaction(db.transaction(), poll_ref)
+    return poll_data
+
+
+def needs_ballot_migration(poll_data: Dict[str, Any]) -> bool:
+    """Whether a running two-phase poll still keeps its votes inline (started before ballots)."""
+    return poll_data.get("phase") in ("phase1", "phase2") and poll_data.get("voteStorage") != "ballots"
+
+
+def migrate_legacy_votes(poll_id: str) -> None:
+    """
+    Move the inline phase1Votes/phase2Votes/lockedInUsers of a poll started
+    before ballots existed into ballots and tallies. Guarded by voteStorage
+    in one transaction, so concurrent callers migrate a poll exactly once.
+    """
+    poll_ref = db.collection("polls").document(poll_id)
+
+    @transactional
+    def migrate_in_transaction(transaction, poll_ref):
+        poll_snapshot = poll_ref.get(transaction=transaction)
+        if not poll_snapshot.exists or not needs_ballot_migration(poll_snapshot.to_dict()):
+            return 0
+
+        poll_data = poll_snapshot.to_dict()
+        phase1_votes = poll_data.get("phase1Votes", {})
+        phase2_votes = poll_data.get("phase2Votes", {})
+
+        ballots = {}
+        approvals = []
+        rejections = []
+        for user_id, vote in phase1_votes.items():
+            approved = vote.get("approved", [])
+            rejected = vote.get("rejected")
+            ballots.setdefault(user_id, {"userId": user_id})["phase1"] = {"approved": approved, "rejected": rejected}
+            approvals.extend(approved)
+            if rejected:
+                rejections.append(rejected)
+        for user_id, selected_candidate in phase2_votes.items():
+            ballots.setdefault(user_id, {"userId": user_id})["phase2"] = selected_candidate
+
+        for user_id, ballot in ballots.items():
+            transaction.set(ballot_ref(poll_id, user_id), ballot, merge=True)
+
+        shard_update = {
+            "phase1LockedIn": firestore.Increment(len(phase1_votes)),
+            "phase2LockedIn": firestore.Increment(len(phase2_votes))
+        }
+        shard_update.update(tally_increments("approvals", [], approvals))
+        shard_update.update(tally_increments("rejections", [], rejections))
+        shard_update.update(tally_increments("selections", [], list(phase2_votes.values())))
+        transaction.set(vote_shard_refs(poll_id)[0], shard_update, merge=True)
+
+        transaction.update(poll_ref, {
+            "voteStorage": "ballots",
+            "phase1Votes": firestore.DELETE_FIELD,
+            "phase2Votes": firestore.DELETE_FIELD,
+            "lockedInUsers": firestore.DELETE_FIELD
+        })
+        return len(ballots)
+
+    migrated = migrate_in_transaction(db.transaction(), poll_ref)
+    if migrated:
+        POLL_CACHE.delete(poll_id)
+        LOCKED_IN_CACHE.delete(poll_id)
+        print(f"📦 Moved {migrated} inline votes of poll {poll_id} into ballots", flush=True)
+
+
+def get_ballot(poll_id: str, user_id: str) -> Dict[str, Any]:
+    """
+    Read-through cache of one member's ballot ({} before their first vote).
+    The returned dict is shared between readers and must not be mutated.
+    """
+    ballot = BALLOT_CACHE.get((poll_id, user_id))
+    if ballot is None:
+        ballot_doc = ballot_ref(poll_id, user_id).get()
+        ballot = ballot_doc.to_dict() if ballot_doc.exists else {}
+        BALLOT_CACHE.set((poll_id, user_id), ballot)
+    return ballot
+
+
+# ============================================================================
+# LIVE POLL EVENTS (SERVER-SENT EVENTS FAN-OUT)
+# ============================================================================
+
+# Seconds between SSE keepalive comments on an idle stream
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", 15))
+
+
+class PollEventHub:
+    """
+    Fans poll change notifications out to SSE subscribers.
+
+    Each subscriber owns a one-slot wake-up queue, so a slow client skips
+    intermediate changes and re-reads only the latest state. While a poll has
+    subscribers, Firestore snapshot listeners on the poll document and on its
+    voteShards (which every vote writes, while the poll document only changes
+    on rejections and phase changes) forward changes made by other worker
+    processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # poll_id -> set of queue.Queue
+        self._watches = {}  # poll_id -> list of Firestore watch handles
+
+    def subscribe(self, poll_id: str) -> queue.Queue:
+        subscription = queue.Queue(maxsize=1)
+        with self._lock:
+            subscribers = self._subscribers.setdefault(poll_id, set())
+            subscribers.add(subscription)
+            first_subscriber = len(subscribers) == 1
+        if first_subscriber:
+            self._start_watch(poll_id)
+        return subscription
+
+    def unsubscribe(self, poll_id: str, subscription: queue.Queue) -> None:
+        watch = None
+        with self._lock:
+            subscribers = self._subscribers.get(poll_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[poll_id]
+                watch = self._watches.pop(poll_id, None)
+        for handle in watch or ():
+            handle.unsubscribe()
+
+    def publish(self, poll_id: str) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.get(poll_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(True)
+            except queue.Full:
+                pass  # A wake-up is already pending
+
+    def _start_watch(self, poll_id: str) -> None:
+        poll_ref = db.collection("polls").document(poll_id)
+        if not hasattr(poll_ref, "on_snapshot"):
+            return
+
+        def on_poll_snapshot(doc_snapshots, changes, read_time):
+            for doc in doc_snapshots:
+                if doc.exists:
+                    POLL_CACHE.set(poll_id, doc.to_dict())
+            self.publish(poll_id)
+
+        def on_shards_snapshot(shard_snapshots, changes, read_time):
+            # A vote (possibly in another process) moved the lock-in counts
+            LOCKED_IN_CACHE.delete(poll_id)
+            self.publish(poll_id)
+
+        watch = []
+        try:
+            watch.append(poll_ref.on_snapshot(on_poll_snapshot))
+            watch.append(poll_ref.collection("voteShards").on_snapshot(on_shards_snapshot))
+        except Exception as e:
+            print(f"⚠️  Could not listen to poll {poll_id}: {e}", flush=True)
+
+        with self._lock:
+            if watch and poll_id in self._subscribers and poll_id not in self._watches:
+                self._watches[poll_id] = watch
+                watch = []
+        # Everyone unsubscribed (or another listener won) while we were starting
+        for handle in watch:
+            handle.unsubscribe()
+
+
+POLL_EVENTS = PollEventHub()
+
+
+# ============================================================================
+# POLL DEADLINES (TIMED PHASE TRANSITIONS + AUTO-CLOSE)
+# ============================================================================
+
+# Extra time after the countdown for members to finish Phase 2 voting
+PHASE2_GRACE_SECONDS = 30
+
+# Polls still "generating" after this long are failed (worker or process died)
+GENERATION_TIMEOUT_SECONDS = int(os.environ.get("GENERATION_TIMEOUT_SECONDS", 120))
+
+# Retry delay when a deadline action fails (e.g. Firestore unavailable)
+DEADLINE_RETRY_SECONDS = 5
+
+# Only the process holding the scheduler lease fires deadlines; it renews the
+# lease every third of this, and another process takes over once it lapses
+SCHEDULER_LEASE_SECONDS = int(os.environ.get("SCHEDULER_LEASE_SECONDS", 30))
+SCHEDULER_LEASE_DOCUMENT = ("schedulerLeases", "poll-deadlines")
+
+
+def utc_epoch(value: datetime) -> float:
+    """Epoch seconds of a stored time (Firestore timestamp or naive UTC datetime)."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def poll_timing(poll_data: Dict[str, Any]) -> Tuple[datetime, float]:
+    """Return (started_dt in UTC, seconds left on the poll's countdown)."""
+    started_epoch = utc_epoch(poll_data["startedTime"])
+    started_dt = datetime.utcfromtimestamp(started_epoch)
+    seconds_left = started_epoch + poll_data["duration"] * 60 - time.time()
+    return started_dt, seconds_left
+
+
+def poll_deadline(poll_data: Dict[str, Any]) -> Optional[float]:
+    """
+    Epoch time at which the poll's next timed action is due, or None.
+
+    - phase1: countdown end → transition to Phase 2
+    - phase2: countdown end + PHASE2_GRACE_SECONDS → close
+    - legacy single-phase: countdown end → close
+    - generating: generationStartedAt + GENERATION_TIMEOUT_SECONDS → fail
+    Closed polls have no deadline. Only stored fields go in, so the same
+    poll always gets the same value.
+    """
+    if poll_data.get("status") != "active" or poll_data.get("phase") == "closed":
+        return None
+
+    if poll_data.get("phase") == "generating":
+        generation_started = poll_data.get("generationStartedAt") or poll_data["startedTime"]
+        return utc_epoch(generation_started) + GENERATION_TIMEOUT_SECONDS
+
+    due = utc_epoch(poll_data["startedTime"]) + poll_data["duration"] * 60
+    if poll_data.get("phase") == "phase2":
+        due += PHASE2_GRACE_SECONDS
+    return due
+
+
+def advance_poll_deadline(poll_id: str) -> None:
+    """Run the timed action that is due for a poll, reading its latest state."""
+    poll_doc = db.collection("polls").document(poll_id).get()
+    if not poll_doc.exists:
+        return
+
+    poll_data = poll_doc.to_dict()
+    due = poll_deadline(poll_data)
+    if due is None:
+        return
+    if due > time.time():
+        # Deadline moved (e.g. countdown restarted after candidate generation)
+        POLL_SCHEDULER.schedule(poll_id, due)
+        return
+
+    if poll_data.get("phase") == "generating":
+        print(f"⏰ Poll {poll_id} candidate generation timed out - failing poll", flush=True)
+        fail_poll_generation(poll_id, "Candidate generation timed out")
+    elif poll_data.get("phase") == "phase1":
+        print(f"⏰ Poll {poll_id} Phase 1 time is up - transitioning to Phase 2", flush=True)
+        transition_phase1_to_phase2(poll_id)
+    else:
+        print(f"⏰ Poll {poll_id} time is up - closing", flush=True)
+        close_poll_internal(poll_id)
+
+
+class PollDeadlineScheduler:
+    """
+    Background thread that fires poll deadlines on time.
+
+    Deadlines live in a min-heap keyed by due time. Rescheduling a poll just
+    pushes a new entry; entries that no longer match the latest due time for
+    their poll are skipped when popped.
+
+    Every gunicorn worker runs one, but only the holder of a lease document
+    (SCHEDULER_LEASE_DOCUMENT) fires deadlines; the others drop what they
+    scheduled and keep trying to take the lease over. The holder re-scans
+    the active polls on every lease renewal, which is how polls started or
+    moved on by other workers reach it. The deadline actions are
+    transactions, so a brief overlap at handover is still harmless.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # (due_ts, poll_id)
+        self._due = {}  # poll_id -> latest due_ts
+        self._thread = None
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._leader = False
+        self._tracked = None  # Active poll count last logged
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="poll-deadlines", daemon=True)
+            self._thread.start()
+
+    def schedule(self, poll_id: str, due: float) -> None:
+        self.start()
+        with self._cond:
+            if self._due.get(poll_id) == due:
+                return
+            self._due[poll_id] = due
+            heapq.heappush(self._heap, (due, poll_id))
+            self._cond.notify()
+
+    def schedule_poll(self, poll_id: str, poll_data: Dict[str, Any]) -> None:
+        """Schedule the poll's next timed action, if it has one."""
+        due = poll_deadline(poll_data)
+        if due is not None:
+            self.schedule(poll_id, due)
+
+    def _rebuild(self) -> int:
+        """Schedule every active poll (phases generating, phase1 and phase2); returns how many."""
+        if db is None:
+            return 0
+        active_polls = db.collection("polls").where(filter=FieldFilter("status", "==", "active")).stream()
+        count = 0
+        for poll_doc in active_polls:
+            self.schedule_poll(poll_doc.id, poll_doc.to_dict())
+            count += 1
+        return count
+
+    def _fire_due(self, until: float) -> None:
+        """Run deadlines as they fall due until `until` (epoch seconds)."""
+        while True:
+            poll_id = self._next_due(until - time.time())
+            if poll_id is None:
+                return
+            try:
+                advance_poll_deadline(poll_id)
+            except Exception as e:
+                print(f"❌ Deadline action failed for poll {poll_id}: {e}", flush=True)
+                self.schedule(poll_id, time.time() + DEADLINE_RETRY_SECONDS)
+
+    def _hold_lease(self) -> bool:
+        """Take or renew the scheduler lease; True if this process holds it."""
+        if db is None:
+            return False
+        lease_ref = db.collection(SCHEDULER_LEASE_DOCUMENT[0]).document(SCHEDULER_LEASE_DOCUMENT[1])
+
+        @transactional
+        def lease_in_transaction(transaction, lease_ref):
+            lease_snapshot = lease_ref.get(transaction=transaction)
+            lease = lease_snapshot.to_dict() if lease_snapshot.exists else {}
+            now = time.time()
+            if lease.get("owner") not in (None, self._owner) and lease.get("expiresAt", 0) > now:
+                return False
+            transaction.set(lease_ref, {"owner": self._owner, "expiresAt": now + SCHEDULER_LEASE_SECONDS})
+            return True
+
+        return lease_in_transaction(db.transaction(), lease_ref)
+
+    def _next_due(self, timeout: float) -> Optional[str]:
+        """Wait up to `timeout` seconds for a deadline to fall due and return its poll ID."""
+        give_up_at = time.time() + timeout
+        with self._cond:
+            while True:
+                # Skip entries superseded by a later schedule() call
+                while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    _, poll_id = heapq.heappop(self._heap)
+                    del self._due[poll_id]
+                    return poll_id
+                if now >= give_up_at:
+                    return None
+
+                wait_until = min(self._heap[0][0], give_up_at) if self._heap else give_up_at
+                self._cond.wait(wait_until - now)
+
+    def _run(self) -> None:
+        renew_every = SCHEDULER_LEASE_SECONDS / 3
+        while True:
+            try:
+                holds_lease = self._hold_lease()
+            except Exception as e:
+                print(f"⚠️  Could not renew deadline scheduler lease: {e}", flush=True)
+                holds_lease = False
+
+            if not holds_lease:
+                if self._leader:
+                    print(f"⏰ Deadline scheduler lease lost by {self._owner}", flush=True)
+                self._leader = False
+                # The lease holder finds these polls in its own scan
+                with self._cond:
+                    self._heap.clear()
+                    self._due.clear()
+                time.sleep(renew_every)
+                continue
+
+            if not self._leader:
+                self._leader = True
+                print(f"⏰ Deadline scheduler lease taken by {self._owner}", flush=True)
+
+            # Polls scheduled on other workers only reach the holder this way
+            try:
+                count = self._rebuild()
+                if count != self._tracked:
+                    print(f"⏰ Deadline scheduler tracking {count} active polls", flush=True)
+                    self._tracked = count
+            except Exception as e:
+                print(f"⚠️  Could not load active polls for deadline scheduler: {e}", flush=True)
+
+            self._fire_due(until=time.time() + renew_every)
+
+
+POLL_SCHEDULER = PollDeadlineScheduler()
+
+
+@app.before_request
+def start_poll_scheduler():
+    """Start the deadline scheduler in the process that actually serves requests."""
+    POLL_SCHEDULER.start()
+
+
+# ============================================================================
+# POLL CREATION + BACKGROUND CANDIDATE GENERATION
+# ============================================================================
+
+# Create polls in phase "generating" and rank candidates off the request thread
+ASYNC_POLL_START = str(os.environ.get("ASYNC_POLL_START", "false")).lower() == "true"
+
+CANDIDATE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CANDIDATE_WORKERS", 4)),
+    thread_name_prefix="candidates"
+)
+
+
+def new_poll_document(
+    poll_title: str,
+    started_time: datetime,
+    duration_minutes: int,
+    team_id: str,
+    team_name: str,
+    all_candidates_data: List[Dict[str, Any]],
+    phase: str = "phase1",
+    catalogue_id: str = None
+) -> Dict[str, Any]:
+    """Build the Firestore document for a freshly started two-phase poll."""
+    # Extract just the names for initial display (first 5)
+    visible_candidates = [c["name"] for c in all_candidates_data[:5]]
+
+    return {
+        "pollTitle": poll_title,
+        "startedTime": started_time,
+        "duration": duration_minutes,
+        "teamId": team_id,
+        "teamName": team_name,
+        "catalogueId": catalogue_id,  # Named catalogue candidates come from (None = default)
+        # Two-phase voting fields
+        "phase": phase,
+        "allCandidates": all_candidates_data,  # Full list with rankings
+        "visibleCandidates": visible_candidates,  # First 5 shown
+        "removedCandidates": [],  # Track globally rejected candidates
+        "phase2Candidates": [],  # Top 3 from Phase 1
+        "voteStorage": "ballots",  # Votes and tallies live in the ballots/ and voteShards/ subcollections
+        # Legacy fields for backward compatibility
+        "candidates": visible_candidates,
+        "votes": {},
+        "status": "active",
+        "resultRanking": []
+    }
+
+
+def fail_poll_generation(poll_id: str, error: str) -> bool:
+    """
+    Close a poll whose candidates could not be generated and free its team.
+    Guarded by phase == "generating" in one transaction, so a worker that
+    finishes late and the generation timeout cannot both win.
+
+    Returns True if this call failed the poll.
+    """
+    poll_ref = db.collection("polls").document(poll_id)
+
+    @transactional
+    def fail_in_transaction(transaction, poll_ref):
+        poll_snapshot = poll_ref.get(transaction=transaction)
+        if not poll_snapshot.exists:
+            return False
+
+        poll_data = poll_snapshot.to_dict()
+        if poll_data.get("phase") != "generating":
+            return False
+
+        team_ref = db.collection("teams").document(poll_data["teamId"])
+        team_snapshot = team_ref.get(transaction=transaction)
+
+        transaction.update(poll_ref, {
+            "phase": "closed",
+            "status": "closed",
+            "generationStage": "failed",
+            "generationError": error
+        })
+        if team_snapshot.exists and team_snapshot.to_dict().get("currentlyOpenPoll") == poll_id:
+            transaction.update(team_ref, {"currentlyOpenPoll": None})
+        return True
+
+    failed = fail_in_transaction(db.transaction(), poll_ref)
+    if failed:
+        notify_poll_changed(poll_id)
+    return failed
+
+
+def complete_poll_candidates(
+    poll_id: str,
+    team_name: str,
+    members: List[str],
+    occasion: str,
+    catalogue_id: str = None,
+    team_id: str = None
+) -> None:
+    """
+    Background worker: generate candidates for a poll created in phase "generating"
+    and move it to phase1. The voting countdown restarts once candidates are ready.
+    """
+    poll_ref = db.collection("polls").document(poll_id)
+
+    try:
+        poll_ref.update({"generationStage": "loading_profiles"})
+        notify_poll_changed(poll_id)
+        members_constraints = load_members_constraints(members)
+
+        poll_ref.update({"generationStage": "ranking"})
+        notify_poll_changed(poll_id)
+        with trace_stage("generate_candidates", items_in=len(members_constraints)) as span:
+            all_candidates_data = generate_candidates_for_team(
+                team_name=team_name,
+                members_constraints=members_constraints,
+                num_candidates=15,
+                occasion=occasion,
+                catalogue_id=catalogue_id,
+                team_id=team_id
+            )
+            span.items_out = len(all_candidates_data)
+        print(f"✅ Generated {len(all_candidates_data)} candidates for poll {poll_id}", flush=True)
+
+        visible_candidates = [c["name"] for c in all_candidates_data[:5]]
+        update_data = {
+            "phase": "phase1",
+            "generationStage": "done",
+            "startedTime": datetime.utcnow(),
+            "allCandidates": all_candidates_data,
+            "visibleCandidates": visible_candidates,
+            "candidates": visible_candidates
+        }
+
+        # Poll may have been closed manually or timed out while we were ranking;
+        # check and write in one transaction so neither can slip in between
+        @transactional
+        def publish_in_transaction(transaction, poll_ref):
+            poll_snapshot = poll_ref.get(transaction=transaction)
+            poll_data = poll_snapshot.to_dict() if poll_snapshot.exists else {}
+            if poll_data.get("phase") != "generating":
+                return None
+            transaction.update(poll_ref, update_data)
+            return {**poll_data, **update_data}
 
+        poll_data = publish_in_transaction(db.transaction(), poll_ref)
+        if poll_data is None:
+            print(f"⚠️  Poll {poll_id} left 'generating' before candidates were ready; discarding", flush=True)
+            return
+
+        notify_poll_changed(poll_id)
+        POLL_SCHEDULER.schedule_poll(poll_id, poll_data)
 
-@app.route("/check-email", methods=["POST"])
-def check_email():
-    data = request.get_json(force=True)
-    email = data.get("email", "").strip().lower()
-    if not email:
-        return jsonify({"error": "Email required"}), 400
-    try:
-        user = auth.get_user_by_email(email)
-        return jsonify({"exists": True, "uid": user.uid}), 200
-    except firebase_admin._auth_utils.UserNotFoundError:
-        return jsonify({"exists": False}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        print(f"❌ Candidate generation failed for poll {poll_id}: {e}", flush=True)
+        import traceback
+        traceback.print_exc()
+
+        try:
+            fail_poll_generation(poll_id, str(e))
+        except Exception as cleanup_error:
+            print(f"❌ Could not mark poll {poll_id} as failed: {cleanup_error}", flush=True)
 
 
 @app.route("/polls/start", methods=["POST"])
+@with_server_timing
 def start_poll():
     """
     Create and start a new poll for a team.
@@ -830,7 +3697,8 @@ def start_poll():
     {
         "teamId": "swpp5",
         "pollTitle": "10/25 team dinner",
-        "durationMinutes": 3
+        "durationMinutes": 3,
+        "catalogueId": "gangnam"  (optional; defaults to the team's catalogueId)
     }
     
     Returns:
@@ -842,6 +3710,11 @@ def start_poll():
         "startedTime": "2025-10-26T11:00:00Z",
         "candidates": ["Bibimbap", "Vegan Burger", ...]
     }
+
+    With "async": true in the body (or ASYNC_POLL_START=true), the poll is
+    created in phase "generating" and 202 is returned with no candidates.
+    Candidates are generated on a background worker; GET /polls/<poll_id>
+    reports generationStage until the poll enters phase1.
     """
     data = request.get_json(force=True)
     team_id = data.get("teamId")
@@ -852,6 +3725,9 @@ def start_poll():
     if not team_id or not poll_title or not duration_minutes:
         return jsonify({"error": "Missing required fields"}), 400
 
+    # Generate candidates in the background if requested (or enabled by default)
+    async_generation = bool(data.get("async", ASYNC_POLL_START))
+
     # Use occasionNote if provided, otherwise fall back to pollTitle
     occasion_for_llm = occasion_note if occasion_note else poll_title
     print(f"📝 Poll request - Title: '{poll_title}', Occasion: '{occasion_for_llm}'", flush=True)
@@ -859,7 +3735,8 @@ def start_poll():
     try:
         # Check if there's already an active poll for this team
         team_ref = db.collection("teams").document(team_id)
-        team_doc = team_ref.get()
+        with trace_stage("load_team"):
+            team_doc = team_ref.get()
         
         if not team_doc.exists:
             return jsonify({"error": "Team not found"}), 404
@@ -868,100 +3745,94 @@ def start_poll():
         currently_open_poll = team_data.get("currentlyOpenPoll")
         
         if currently_open_poll:
-            # Check if the poll is still active; if expired, auto-close here too
+            # Check if the poll is still active. The deadline scheduler closes
+            # expired polls; this only catches polls whose deadline passed while
+            # no scheduler was running (e.g. the server was down).
             poll_ref = db.collection("polls").document(currently_open_poll)
             poll_doc = poll_ref.get()
             
             if poll_doc.exists:
                 existing_poll = poll_doc.to_dict()
                 if existing_poll.get("status") == "active":
-                    started_time = existing_poll.get("startedTime")
-                    duration_minutes = existing_poll.get("duration", 0)
-                    if hasattr(started_time, 'timestamp'):
-                        started_dt = datetime.utcfromtimestamp(started_time.timestamp())
-                    else:
-                        started_dt = started_time
-                    elapsed_seconds = (datetime.utcnow() - started_dt).total_seconds()
-                    if elapsed_seconds >= duration_minutes * 60:
-                        # Expired: close now and continue starting a new poll
-                        close_poll_internal(currently_open_poll)
-                        team_ref.update({"currentlyOpenPoll": None})
+                    close_at = poll_deadline(existing_poll)
+                    if close_at is not None and existing_poll.get("phase") == "phase1":
+                        close_at += PHASE2_GRACE_SECONDS
+                    if close_at is not None and time.time() >= close_at:
+                        # Expired: close now (also clears currentlyOpenPoll) and continue
+                        if existing_poll.get("phase") == "generating":
+                            fail_poll_generation(currently_open_poll, "Candidate generation timed out")
+                        else:
+                            close_poll_internal(currently_open_poll)
                     else:
                         return jsonify({"error": "Poll already active for this team"}), 400
         
-        # Get team members and their constraints
         members = team_data.get("members", [])
-        members_constraints = []
-        
-        for user_id in members:
-            user_ref = db.collection("users").document(user_id)
-            user_doc = user_ref.get()
-
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-
-                # Map Firestore fields (from Android app) to backend constraint format
-                # Android app stores: dietaryRestrictions, allergies, avoidIngredients, favoriteCuisines, spiceTolerance
-                constraints = {
-                    # Hard constraints (MUST avoid)
-                    "dietaryRestrictions": user_data.get("dietaryRestrictions", []),  # e.g., ["VEGAN", "VEGETARIAN"]
-                    "allergies": user_data.get("allergies", []),  # e.g., ["PEANUTS", "SHELLFISH"]
-                    "avoidIngredients": user_data.get("avoidIngredients", []),  # e.g., ["beef", "pork"]
-
-                    # Soft preferences (nice to have)
-                    "favoriteCuisines": user_data.get("favoriteCuisines", []),  # e.g., ["KOREAN", "ITALIAN"]
-                    "spiceTolerance": user_data.get("spiceTolerance", "MEDIUM"),  # e.g., "MILD", "MEDIUM", "SPICY"
-                }
-
-                members_constraints.append({
-                    "userId": user_id,
-                    "constraints": constraints
-                })
-        
-        # Generate candidates (10-15 for two-phase voting)
-        print(f"📋 About to generate candidates for poll: '{poll_title}' with occasion: '{occasion_for_llm}'", flush=True)
-        all_candidates_data = generate_candidates_for_team(
-            team_name=team_data.get("teamName", ""),
-            members_constraints=members_constraints,
-            num_candidates=15,
-            occasion=occasion_for_llm  # Use occasionNote if provided, else pollTitle
-        )
-        print(f"✅ Generated {len(all_candidates_data)} candidates", flush=True)
-
-        # Extract just the names for initial display (first 5)
-        visible_candidates = [c["name"] for c in all_candidates_data[:5]]
-
-        # Create poll document with phase support
+        team_name = team_data.get("teamName", "")
         started_time = datetime.utcnow()
-        poll_data = {
-            "pollTitle": poll_title,
-            "startedTime": started_time,
-            "duration": duration_minutes,
-            "teamId": team_id,
-            "teamName": team_data.get("teamName", ""),
-            # Two-phase voting fields
-            "phase": "phase1",
-            "allCandidates": all_candidates_data,  # Full list with rankings
-            "visibleCandidates": visible_candidates,  # First 5 shown
-            "removedCandidates": [],  # Track globally rejected candidates
-            "phase1Votes": {},  # {userId: {"approved": [...], "rejected": str|None}}
-            "phase2Votes": {},  # {userId: selectedCandidate}
-            "phase2Candidates": [],  # Top 3 from Phase 1
-            "lockedInUsers": [],  # Users who locked in votes
-            # Legacy fields for backward compatibility
-            "candidates": visible_candidates,
-            "votes": {},
-            "status": "active",
-            "resultRanking": []
-        }
-        
+
+        # Per-location catalogue: the request may override the team's choice
+        catalogue_id = data.get("catalogueId") or team_data.get("catalogueId") or None
+        if not CATALOGUES.exists(catalogue_id):
+            return jsonify({"error": f"Unknown catalogue '{catalogue_id}'"}), 400
+
+        if async_generation:
+            # Create the poll right away; candidates are filled in by a worker
+            poll_data = new_poll_document(
+                poll_title, started_time, duration_minutes, team_id, team_name, [],
+                phase="generating", catalogue_id=catalogue_id
+            )
+            poll_data["generationStage"] = "queued"
+            poll_data["generationStartedAt"] = started_time  # Failed after GENERATION_TIMEOUT_SECONDS
+        else:
+            # Get team members and their constraints (one batched read)
+            members_constraints = load_members_constraints(members)
+
+            # Generate candidates (10-15 for two-phase voting)
+            print(f"📋 About to generate candidates for poll: '{poll_title}' with occasion: '{occasion_for_llm}'", flush=True)
+            with trace_stage("generate_candidates", items_in=len(members_constraints)) as span:
+                all_candidates_data = generate_candidates_for_team(
+                    team_name=team_name,
+                    members_constraints=members_constraints,
+                    num_candidates=15,
+                    occasion=occasion_for_llm,  # Use occasionNote if provided, else pollTitle
+                    catalogue_id=catalogue_id,
+                    team_id=team_id
+                )
+                span.items_out = len(all_candidates_data)
+            print(f"✅ Generated {len(all_candidates_data)} candidates", flush=True)
+
+            # Create poll document with phase support
+            poll_data = new_poll_document(
+                poll_title, started_time, duration_minutes, team_id, team_name, all_candidates_data,
+                catalogue_id=catalogue_id
+            )
+
+        visible_candidates = poll_data["visibleCandidates"]
+
+        # Write poll and team's currentlyOpenPoll in one batch
         poll_ref = db.collection("polls").document()
         poll_id = poll_ref.id
-        poll_ref.set(poll_data)
-        
-        # Update team's currentlyOpenPoll
-        team_ref.update({"currentlyOpenPoll": poll_id})
-        
+        batch = db.batch()
+        batch.set(poll_ref, poll_data)
+        batch.update(team_ref, {"currentlyOpenPoll": poll_id})
+        with trace_stage("create_poll"):
+            batch.commit()
+        POLL_SCHEDULER.schedule_poll(poll_id, poll_data)
+
+        if async_generation:
+            CANDIDATE_EXECUTOR.submit(
+                complete_poll_candidates, poll_id, team_name, members, occasion_for_llm, catalogue_id, team_id
+            )
+            return jsonify({
+                "pollId": poll_id,
+                "pollTitle": poll_title,
+                "teamName": team_name,
+                "duration": duration_minutes,
+                "startedTime": started_time.isoformat() + "Z",
+                "phase": "generating",
+                "candidates": []
+            }), 202
+
         return jsonify({
             "pollId": poll_id,
             "pollTitle": poll_title,
@@ -975,6 +3846,156 @@ def start_poll():
         return jsonify({"error": str(e)}), 500
 
 
+def build_closed_poll_payload(poll_id: str, poll_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Results shown for a closed poll (the same for every user)."""
+    result_ranking = poll_data.get("resultRanking", [])
+
+    # Build results with vote counts (stored at close; older polls kept the votes inline)
+    vote_counts = poll_data.get("phase2VoteCounts")
+    if vote_counts is None:
+        vote_counts = {}
+        for candidate in poll_data.get("phase2Votes", {}).values():
+            vote_counts[candidate] = vote_counts.get(candidate, 0) + 1
+
+    results = []
+    for candidate_name in result_ranking:
+        results.append({
+            "name": candidate_name,
+            "voteCount": vote_counts.get(candidate_name, 0)
+        })
+
+    return {
+        "pollId": poll_id,
+        "pollTitle": poll_data.get("pollTitle", ""),
+        "teamId": poll_data["teamId"],
+        "teamName": poll_data.get("teamName", ""),
+        "phase": "closed",
+        "status": "closed",
+        "results": results,
+        "winner": result_ranking[0] if result_ranking else None
+    }
+
+
+def closed_poll_response(result: ClosedPollResult) -> Response:
+    """
+    Serve a closed poll's stored result with an ETag; a matching
+    If-None-Match gets 304 Not Modified without a body.
+    """
+    response = Response(result.body, mimetype="application/json")
+    response.set_etag(result.etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
+def build_poll_payload(poll_id: str, poll_data: Dict[str, Any], members: List[str], user_id: str) -> Dict[str, Any]:
+    """
+    Build the phase-specific poll state shown to one user.
+    Shared by GET /polls/<poll_id> and the /polls/<poll_id>/stream SSE endpoint.
+    """
+    team_id = poll_data["teamId"]
+    duration_minutes = poll_data["duration"]
+    started_dt, seconds_left = poll_timing(poll_data)
+    remaining_seconds = max(0, seconds_left)
+
+    # Check if this is a two-phase poll
+    is_two_phase = "phase" in poll_data
+    current_phase = poll_data.get("phase", "active")
+
+    # Prepare response based on phase
+    if current_phase == "closed" or poll_data["status"] == "closed":
+        return closed_poll_result(poll_id, poll_data).payload
+
+    elif current_phase == "generating":
+        # Candidates are still being generated in the background
+        return {
+            "pollId": poll_id,
+            "pollTitle": poll_data["pollTitle"],
+            "teamId": team_id,
+            "teamName": poll_data["teamName"],
+            "phase": "generating",
+            "status": "active",
+            "generationStage": poll_data.get("generationStage", "queued"),
+            "startedTime": started_dt.isoformat() + "Z",
+            "duration": duration_minutes,
+            "remainingSeconds": duration_minutes * 60,
+            "candidates": [],
+            "totalMemberCount": len(members)
+        }
+
+    elif is_two_phase and current_phase == "phase1":
+        # Phase 1: Approval voting
+        visible_candidates = poll_data.get("visibleCandidates", [])
+        ballot = get_ballot(poll_id, user_id)
+
+        user_vote = ballot.get("phase1") or {}
+        approved = user_vote.get("approved", [])
+        rejected = user_vote.get("rejected")
+
+        return {
+            "pollId": poll_id,
+            "pollTitle": poll_data["pollTitle"],
+            "teamId": team_id,
+            "teamName": poll_data["teamName"],
+            "phase": "phase1",
+            "status": "active",
+            "startedTime": started_dt.isoformat() + "Z",
+            "duration": duration_minutes,
+            "remainingSeconds": int(remaining_seconds),
+            "candidates": [{"name": candidate} for candidate in visible_candidates],
+            "yourApprovedCandidates": approved,
+            "yourRejectedCandidate": rejected,
+            "hasCurrentUserLockedIn": "phase1" in ballot,
+            "lockedInUserCount": get_locked_in_counts(poll_id)["phase1"],
+            "totalMemberCount": len(members)
+        }
+
+    elif is_two_phase and current_phase == "phase2":
+        # Phase 2: Single selection from Top 3
+        phase2_candidates = poll_data.get("phase2Candidates", [])
+        ballot = get_ballot(poll_id, user_id)
+
+        user_selection = ballot.get("phase2")
+
+        return {
+            "pollId": poll_id,
+            "pollTitle": poll_data["pollTitle"],
+            "teamId": team_id,
+            "teamName": poll_data["teamName"],
+            "phase": "phase2",
+            "status": "active",
+            "startedTime": started_dt.isoformat() + "Z",
+            "duration": duration_minutes,
+            "remainingSeconds": int(remaining_seconds),
+            "candidates": [{"name": candidate} for candidate in phase2_candidates],
+            "yourSelectedCandidate": user_selection,
+            "hasCurrentUserLockedIn": "phase2" in ballot,
+            "lockedInUserCount": get_locked_in_counts(poll_id)["phase2"],
+            "totalMemberCount": len(members)
+        }
+
+    else:
+        # Legacy single-phase voting
+        votes = poll_data.get("votes", {})
+        current_votes = votes.get(user_id, [])
+
+        return {
+            "pollId": poll_id,
+            "pollTitle": poll_data["pollTitle"],
+            "teamId": poll_data["teamId"],
+            "teamName": poll_data["teamName"],
+            "status": poll_data["status"],
+            "startedTime": started_dt.isoformat() + "Z",
+            "duration": duration_minutes,
+            "remainingSeconds": int(remaining_seconds),
+            "candidates": [
+                {"name": candidate}
+                for candidate in poll_data["candidates"]
+            ],
+            "yourCurrentVotes": current_votes,
+            "totalSelectedCountForYou": len(current_votes)
+        }
+
+
 @app.route("/polls/<poll_id>", methods=["GET"])
 def get_poll(poll_id):
     """
@@ -988,169 +4009,89 @@ def get_poll(poll_id):
     user_id = request.headers.get("X-User-Id") or "demo_user"
 
     try:
-        poll_ref = db.collection("polls").document(poll_id)
-        poll_doc = poll_ref.get()
-
-        if not poll_doc.exists:
-            return jsonify({"error": "Poll not found"}), 404
+        # Closed polls are served from their finalized result, no reads needed
+        closed_result = CLOSED_POLL_RESULTS.get(poll_id)
+        if closed_result is not None:
+            return closed_poll_response(closed_result)
 
-        poll_data = poll_doc.to_dict()
+        poll_data = get_poll_snapshot(poll_id)
 
-        # Get team data for member count
-        team_id = poll_data["teamId"]
-        team_ref = db.collection("teams").document(team_id)
-        team_doc = team_ref.get()
-        team_data = team_doc.to_dict() if team_doc.exists else {}
-        members = team_data.get("members", [])
+        if poll_data is None:
+            return jsonify({"error": "Poll not found"}), 404
 
-        # Calculate remaining time
-        started_time = poll_data["startedTime"]
-        duration_minutes = poll_data["duration"]
+        if is_poll_closed(poll_data):
+            return closed_poll_response(closed_poll_result(poll_id, poll_data))
 
-        # Convert Firestore Timestamp to UTC datetime
-        if hasattr(started_time, 'timestamp'):
-            started_dt = datetime.utcfromtimestamp(started_time.timestamp())
-        else:
-            started_dt = started_time
-
-        elapsed_seconds = (datetime.utcnow() - started_dt).total_seconds()
-        seconds_left = (duration_minutes * 60) - elapsed_seconds
-        remaining_seconds = max(0, seconds_left)
-
-        # Check if this is a two-phase poll
-        is_two_phase = "phase" in poll_data
-        current_phase = poll_data.get("phase", "active")
-
-        # Auto-close if expired (but not during active two-phase voting)
-        # For two-phase polls, only close on timeout if we're past a grace period
-        # to allow members to complete Phase 2 voting after Phase 1 ends
-        should_auto_close = False
-        if seconds_left <= 0 and poll_data["status"] == "active" and current_phase != "closed":
-            if is_two_phase and current_phase == "phase2":
-                # In Phase 2: only close if all members locked in or significant timeout
-                # This prevents premature closure during Phase 1 → Phase 2 transition
-                locked_in_users = poll_data.get("lockedInUsers", [])
-                if len(locked_in_users) >= len(members):
-                    # All members voted in Phase 2, safe to close
-                    should_auto_close = True
-                elif seconds_left < -30:
-                    # 30 second grace period expired, force close
-                    should_auto_close = True
-            else:
-                # Not in Phase 2 or not two-phase: normal auto-close
-                should_auto_close = True
-
-        if should_auto_close:
-            poll_data = close_poll_internal(poll_id)
-            current_phase = "closed"
-
-        # Prepare response based on phase
-        if current_phase == "closed" or poll_data["status"] == "closed":
-            # Closed poll: return results
-            result_ranking = poll_data.get("resultRanking", [])
-
-            # Build results with vote counts
-            phase2_votes = poll_data.get("phase2Votes", {})
-            vote_counts = {}
-            for candidate in phase2_votes.values():
-                vote_counts[candidate] = vote_counts.get(candidate, 0) + 1
-
-            results = []
-            for candidate_name in result_ranking:
-                results.append({
-                    "name": candidate_name,
-                    "voteCount": vote_counts.get(candidate_name, 0)
-                })
+        # Get team members for member count
+        members = get_team_members(poll_data["teamId"])
 
-            return jsonify({
-                "pollId": poll_id,
-                "pollTitle": poll_data.get("pollTitle", ""),
-                "teamId": team_id,
-                "teamName": poll_data.get("teamName", ""),
-                "phase": "closed",
-                "status": "closed",
-                "results": results,
-                "winner": result_ranking[0] if result_ranking else None
-            }), 200
-
-        elif is_two_phase and current_phase == "phase1":
-            # Phase 1: Approval voting
-            visible_candidates = poll_data.get("visibleCandidates", [])
-            phase1_votes = poll_data.get("phase1Votes", {})
-            locked_in_users = poll_data.get("lockedInUsers", [])
+        # Pure read: timed transitions belong to the deadline scheduler. Make
+        # sure it knows about polls started by other worker processes.
+        POLL_SCHEDULER.schedule_poll(poll_id, poll_data)
 
-            user_vote = phase1_votes.get(user_id, {})
-            approved = user_vote.get("approved", [])
-            rejected = user_vote.get("rejected")
+        return jsonify(build_poll_payload(poll_id, poll_data, members, user_id)), 200
 
-            return jsonify({
-                "pollId": poll_id,
-                "pollTitle": poll_data["pollTitle"],
-                "teamId": team_id,
-                "teamName": poll_data["teamName"],
-                "phase": "phase1",
-                "status": "active",
-                "startedTime": started_dt.isoformat() + "Z",
-                "duration": duration_minutes,
-                "remainingSeconds": int(remaining_seconds),
-                "candidates": [{"name": candidate} for candidate in visible_candidates],
-                "yourApprovedCandidates": approved,
-                "yourRejectedCandidate": rejected,
-                "hasCurrentUserLockedIn": user_id in locked_in_users,
-                "lockedInUserCount": len(locked_in_users),
-                "totalMemberCount": len(members)
-            }), 200
-
-        elif is_two_phase and current_phase == "phase2":
-            # Phase 2: Single selection from Top 3
-            phase2_candidates = poll_data.get("phase2Candidates", [])
-            phase2_votes = poll_data.get("phase2Votes", {})
-            locked_in_users = poll_data.get("lockedInUsers", [])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            user_selection = phase2_votes.get(user_id)
 
-            return jsonify({
-                "pollId": poll_id,
-                "pollTitle": poll_data["pollTitle"],
-                "teamId": team_id,
-                "teamName": poll_data["teamName"],
-                "phase": "phase2",
-                "status": "active",
-                "startedTime": started_dt.isoformat() + "Z",
-                "duration": duration_minutes,
-                "remainingSeconds": int(remaining_seconds),
-                "candidates": [{"name": candidate} for candidate in phase2_candidates],
-                "yourSelectedCandidate": user_selection,
-                "hasCurrentUserLockedIn": user_id in locked_in_users,
-                "lockedInUserCount": len(locked_in_users),
-                "totalMemberCount": len(members)
-            }), 200
+@app.route("/polls/<poll_id>/stream", methods=["GET"])
+def stream_poll(poll_id):
+    """
+    Server-Sent Events stream of poll state.
 
-        else:
-            # Legacy single-phase voting
-            votes = poll_data.get("votes", {})
-            current_votes = votes.get(user_id, [])
+    Emits a "poll" event carrying the same payload as GET /polls/<poll_id>
+    whenever the poll changes (vote cast, phase transition, close), plus a
+    comment line every SSE_KEEPALIVE_SECONDS. The stream ends after the
+    closed-poll payload has been sent.
 
-            return jsonify({
-                "pollId": poll_id,
-                "pollTitle": poll_data["pollTitle"],
-                "teamId": poll_data["teamId"],
-                "teamName": poll_data["teamName"],
-                "status": poll_data["status"],
-                "startedTime": started_dt.isoformat() + "Z",
-                "duration": duration_minutes,
-                "remainingSeconds": int(remaining_seconds),
-                "candidates": [
-                    {"name": candidate}
-                    for candidate in poll_data["candidates"]
-                ],
-                "yourCurrentVotes": current_votes,
-                "totalSelectedCountForYou": len(current_votes)
-            }), 200
+    The user is taken from the X-User-Id header, or the userId query
+    parameter for clients (like EventSource) that cannot set headers.
+    """
+    user_id = request.headers.get("X-User-Id") or request.args.get("userId") or "demo_user"
 
+    try:
+        poll_data = get_poll_snapshot(poll_id)
+        if poll_data is None:
+            return jsonify({"error": "Poll not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    subscription = POLL_EVENTS.subscribe(poll_id)
+
+    def generate():
+        last_state = None
+        latest = poll_data
+        try:
+            while True:
+                members = get_team_members(latest["teamId"])
+                POLL_SCHEDULER.schedule_poll(poll_id, latest)
+                payload = build_poll_payload(poll_id, latest, members, user_id)
+
+                # Only emit when something other than the countdown changed
+                state = json.dumps({k: v for k, v in payload.items() if k != "remainingSeconds"}, sort_keys=True)
+                if state != last_state:
+                    last_state = state
+                    yield f"event: poll\ndata: {json.dumps(payload)}\n\n"
+
+                if payload["status"] == "closed":
+                    return
+
+                try:
+                    subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+
+                latest = get_poll_snapshot(poll_id) or latest
+        finally:
+            POLL_EVENTS.unsubscribe(poll_id, subscription)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 @app.route("/polls/<poll_id>/vote", methods=["POST"])
 def cast_vote(poll_id):
@@ -1216,11 +4157,10 @@ def cast_vote(poll_id):
             if choice not in candidates:
                 return jsonify({"error": f"Invalid choice: {choice}"}), 400
         
-        # Update votes
-        votes = poll_data.get("votes", {})
-        votes[user_id] = choices
-        
-        poll_ref.update({"votes": votes})
+        # Update only this member's entry: a field-path write is atomic per
+        # member, so concurrent voters cannot overwrite each other's votes
+        poll_ref.update({FieldPath("votes", user_id).to_api_repr(): choices})  # Quotes IDs with "." or "`"
+        notify_poll_changed(poll_id)
         
         return jsonify({
             "ok": True,
@@ -1236,7 +4176,10 @@ def cast_vote(poll_id):
 def cast_phase1_vote(poll_id):
     """
     Cast Phase 1 vote: approval voting + optional rejection.
-    Uses Firestore transaction for atomic updates and concurrent safety.
+
+    The vote is written to the member's own ballot document in a transaction,
+    so concurrent voters do not contend with each other. Only a rejection,
+    which swaps a visible candidate for everyone, also locks the poll document.
 
     Request body:
     {
@@ -1270,24 +4213,29 @@ def cast_phase1_vote(poll_id):
         if user_id not in members:
             return jsonify({"error": "User is not a member of this team"}), 403
 
+        if needs_ballot_migration(poll_data_check):
+            migrate_legacy_votes(poll_id)
+
         # Use transaction for atomic vote + replacement
-        @firestore.transactional
-        def update_vote_in_transaction(transaction, poll_ref, user_id, approved_candidates, rejected_candidate, members):
-            # Read current poll state
+        @transactional
+        def update_vote_in_transaction(transaction, poll_ref, user_id, approved_candidates, rejected_candidate):
+            # Reading the poll here makes a concurrent transition/close either
+            # wait for this vote or make it retry and see the phase has ended.
+            # Only a rejection writes the poll, so plain votes do not contend.
             poll_snapshot = poll_ref.get(transaction=transaction)
             if not poll_snapshot.exists:
                 raise ValueError("Poll not found")
-
             poll_data = poll_snapshot.to_dict()
 
-            # Verify poll is in Phase 1
-            if poll_data.get("phase") != "phase1":
-                raise ValueError(f"Poll is not in Phase 1 (currently in {poll_data.get('phase')})")
+            user_ballot_ref = ballot_ref(poll_id, user_id)
+            ballot_snapshot = user_ballot_ref.get(transaction=transaction)
+            ballot = ballot_snapshot.to_dict() if ballot_snapshot.exists else {}
+
+            # Verify poll is in Phase 1 and still taking votes
+            check_phase_voting_open(poll_data, "phase1")
 
             visible_candidates = poll_data.get("visibleCandidates", [])
             all_candidates = poll_data.get("allCandidates", [])
-            phase1_votes = poll_data.get("phase1Votes", {})
-            locked_in_users = poll_data.get("lockedInUsers", [])
             removed_candidates = poll_data.get("removedCandidates", [])  # Track globally removed
 
             # Validate approved candidates exist in visible list
@@ -1300,18 +4248,12 @@ def cast_phase1_vote(poll_id):
                 raise ValueError(f"Invalid rejected candidate: {rejected_candidate}")
 
             # Check if user already used their one-time reject
-            previous_vote = phase1_votes.get(user_id, {})
+            previous_vote = ballot.get("phase1") or {}
             previous_rejection = previous_vote.get("rejected")
 
             if previous_rejection and rejected_candidate and rejected_candidate != previous_rejection:
                 raise ValueError("You have already used your one-time reject on a different menu")
 
-            # Store the vote
-            phase1_votes[user_id] = {
-                "approved": approved_candidates,
-                "rejected": rejected_candidate
-            }
-
             # Handle rejection and replacement (Problem 2 fix)
             replacement_candidate = None
             if rejected_candidate and rejected_candidate not in removed_candidates:
@@ -1320,8 +4262,7 @@ def cast_phase1_vote(poll_id):
                     visible_candidates.remove(rejected_candidate)
 
                 # Mark as removed globally
-                if rejected_candidate not in removed_candidates:
-                    removed_candidates.append(rejected_candidate)
+                removed_candidates.append(rejected_candidate)
 
                 # Find replacement from allCandidates pool (keep 5 visible)
                 # Get candidates not already visible or removed, sorted by ranking
@@ -1331,28 +4272,41 @@ def cast_phase1_vote(poll_id):
                 ]
 
                 if available_candidates and len(visible_candidates) < 5:
-                    # Sort by ranking (lowest/best first)
-                    available_candidates.sort(key=lambda x: x.get("ranking", 999))
-                    replacement_candidate = available_candidates[0]["name"]
+                    # Best remaining by ranking (lowest first, earliest on ties)
+                    best = top_k(available_candidates, 1, key=lambda x: x.get("ranking", 999))[0]
+                    replacement_candidate = best["name"]
                     visible_candidates.append(replacement_candidate)
 
-            # Add user to locked-in list (avoid duplicates with set logic)
-            if user_id not in locked_in_users:
-                locked_in_users.append(user_id)
-
-            # Update poll document atomically
-            update_data = {
-                "phase1Votes": phase1_votes,
-                "lockedInUsers": locked_in_users,
-                "visibleCandidates": visible_candidates,
-                "removedCandidates": removed_candidates
-            }
+                # visibleCandidates is at most 5 names and keeps its order, so it
+                # is rewritten; removedCandidates only ever grows
+                transaction.update(poll_ref, {
+                    "visibleCandidates": visible_candidates,
+                    "removedCandidates": firestore.ArrayUnion([rejected_candidate])
+                })
 
-            transaction.update(poll_ref, update_data)
+            # Store the vote
+            transaction.set(user_ballot_ref, {
+                "userId": user_id,
+                "phase1": {
+                    "approved": approved_candidates,
+                    "rejected": rejected_candidate
+                }
+            }, merge=True)
+
+            # Move this member's approvals/rejection in the running tallies;
+            # their first Phase 1 vote also locks them in
+            shard_update = tally_increments("approvals", previous_vote.get("approved", []), approved_candidates)
+            shard_update.update(tally_increments(
+                "rejections",
+                [previous_rejection] if previous_rejection else [],
+                [rejected_candidate] if rejected_candidate else []
+            ))
+            if "phase1" not in ballot:
+                shard_update["phase1LockedIn"] = firestore.Increment(1)
+            if shard_update:
+                transaction.set(random_vote_shard_ref(poll_id), shard_update, merge=True)
 
             return {
-                "locked_in_count": len(locked_in_users),
-                "total_members": len(members),
                 "visible_candidates": visible_candidates,
                 "replacement": replacement_candidate,
                 "approved": approved_candidates
@@ -1361,12 +4315,18 @@ def cast_phase1_vote(poll_id):
         # Execute transaction
         transaction = db.transaction()
         result = update_vote_in_transaction(
-            transaction, poll_ref, user_id, approved_candidates, rejected_candidate, members
+            transaction, poll_ref, user_id, approved_candidates, rejected_candidate
         )
+        BALLOT_CACHE.delete((poll_id, user_id))
+        notify_poll_changed(poll_id)
+
+        # Counted after our own commit, so the last member to lock in always sees everyone
+        locked_in_count = read_locked_in_counts(poll_id)["phase1"]
+        total_members = len(members)
 
         # Check if all members have locked in → transition to Phase 2
-        if result["locked_in_count"] >= result["total_members"]:
-            print(f"All {result['total_members']} members locked in Phase 1 - transitioning to Phase 2", flush=True)
+        if locked_in_count >= total_members:
+            print(f"All {total_members} members locked in Phase 1 - transitioning to Phase 2", flush=True)
             transition_phase1_to_phase2(poll_id)
 
         return jsonify({
@@ -1375,8 +4335,8 @@ def cast_phase1_vote(poll_id):
             "totalSelectedCountForYou": len(result["approved"]),
             "visibleCandidates": result["visible_candidates"],
             "replacementCandidate": result["replacement"],
-            "lockedInUserCount": result["locked_in_count"],
-            "totalMemberCount": result["total_members"]
+            "lockedInUserCount": locked_in_count,
+            "totalMemberCount": total_members
         }), 200
 
     except ValueError as e:
@@ -1392,7 +4352,8 @@ def cast_phase1_vote(poll_id):
 def cast_phase2_vote(poll_id):
     """
     Cast Phase 2 vote: single selection from Top 3.
-    Uses Firestore transaction for atomic updates and concurrent safety.
+    The selection is written to the member's own ballot document in a
+    transaction, so concurrent voters do not contend with each other.
 
     Request body:
     {
@@ -1413,8 +4374,8 @@ def cast_phase2_vote(poll_id):
         if not poll_doc.exists:
             return jsonify({"error": "Poll not found"}), 404
 
-        poll_data_check = poll_doc.to_dict()
-        team_id = poll_data_check["teamId"]
+        poll_data = poll_doc.to_dict()
+        team_id = poll_data["teamId"]
         team_doc = db.collection("teams").document(team_id).get()
 
         if not team_doc.exists:
@@ -1424,66 +4385,67 @@ def cast_phase2_vote(poll_id):
         if user_id not in members:
             return jsonify({"error": "User is not a member of this team"}), 403
 
-        # Use transaction for atomic vote
-        @firestore.transactional
-        def update_vote_in_transaction(transaction, poll_ref, user_id, selected_candidate, members):
-            # Read current poll state
+        if needs_ballot_migration(poll_data):
+            migrate_legacy_votes(poll_id)
+
+        # Use transaction so a member is counted as locked in exactly once
+        @transactional
+        def update_vote_in_transaction(transaction, poll_ref, user_ballot_ref, user_id, selected_candidate):
+            # Read (not written) here so a concurrent close either waits for
+            # this vote or makes it retry and see that voting has ended
             poll_snapshot = poll_ref.get(transaction=transaction)
             if not poll_snapshot.exists:
                 raise ValueError("Poll not found")
-
             poll_data = poll_snapshot.to_dict()
 
-            # Verify poll is in Phase 2
-            if poll_data.get("phase") != "phase2":
-                raise ValueError(f"Poll is not in Phase 2 (currently in {poll_data.get('phase')})")
+            ballot_snapshot = user_ballot_ref.get(transaction=transaction)
+            ballot = ballot_snapshot.to_dict() if ballot_snapshot.exists else {}
+
+            # Verify poll is in Phase 2 and still taking votes
+            check_phase_voting_open(poll_data, "phase2")
 
             # Validate selected candidate is in Top 3
             phase2_candidates = poll_data.get("phase2Candidates", [])
             if selected_candidate not in phase2_candidates:
                 raise ValueError(f"Invalid candidate: {selected_candidate}. Must be one of Top 3")
 
-            phase2_votes = poll_data.get("phase2Votes", {})
-            locked_in_users = poll_data.get("lockedInUsers", [])
-
             # Store Phase 2 vote
-            phase2_votes[user_id] = selected_candidate
-
-            # Add user to locked-in list (avoid duplicates)
-            if user_id not in locked_in_users:
-                locked_in_users.append(user_id)
-
-            # Update poll document atomically
-            update_data = {
-                "phase2Votes": phase2_votes,
-                "lockedInUsers": locked_in_users
-            }
-
-            transaction.update(poll_ref, update_data)
-
-            return {
-                "locked_in_count": len(locked_in_users),
-                "total_members": len(members),
-                "selected": selected_candidate
-            }
+            transaction.set(user_ballot_ref, {"userId": user_id, "phase2": selected_candidate}, merge=True)
+
+            # Move this member's selection in the running tally; their first
+            # Phase 2 vote also locks them in
+            previous_selection = ballot.get("phase2")
+            shard_update = tally_increments(
+                "selections",
+                [previous_selection] if previous_selection else [],
+                [selected_candidate]
+            )
+            if "phase2" not in ballot:
+                shard_update["phase2LockedIn"] = firestore.Increment(1)
+            if shard_update:
+                transaction.set(random_vote_shard_ref(poll_id), shard_update, merge=True)
 
         # Execute transaction
         transaction = db.transaction()
-        result = update_vote_in_transaction(
-            transaction, poll_ref, user_id, selected_candidate, members
-        )
+        update_vote_in_transaction(transaction, poll_ref, ballot_ref(poll_id, user_id), user_id, selected_candidate)
+        BALLOT_CACHE.delete((poll_id, user_id))
+        notify_poll_changed(poll_id)
+
+        # Counted after our own commit, so the last member to lock in always sees everyone
+        locked_in_count = read_locked_in_counts(poll_id)["phase2"]
+        total_members = len(members)
 
         # Check if all members have locked in → close poll
-        if result["locked_in_count"] >= result["total_members"]:
-            print(f"All {result['total_members']} members locked in Phase 2 - closing poll", flush=True)
+        if locked_in_count >= total_members:
+            print(f"All {total_members} members locked in Phase 2 - closing poll", flush=True)
             close_poll_internal(poll_id)
 
         return jsonify({
             "ok": True,
-            "yourCurrentVotes": [result["selected"]],
+            "yourCurrentVotes": [selected_candidate],
             "totalSelectedCountForYou": 1,
-            "lockedInUserCount": result["locked_in_count"],
-            "totalMemberCount": result["total_members"]
+            "lockedInUserCount": locked_in_count,
+            "totalMemberCount": total_members
         }), 200
 
     except ValueError as e:
@@ -1495,17 +4457,12 @@ def cast_phase2_vote(poll_id):
         return jsonify({"error": str(e)}), 500
 
 
-def transition_phase1_to_phase2(poll_id: str) -> None:
+def compute_phase2_candidates(poll_data: Dict[str, Any], tallies: Dict[str, Any]) -> List[str]:
     """
-    Transition poll from Phase 1 to Phase 2.
-    Calculates Top 3 candidates from Phase 1 approval votes.
+    Top 3 candidates by Phase 1 net approval score (approvals - rejections),
+    taken from the running tallies (see read_vote_tallies).
     """
-    poll_ref = db.collection("polls").document(poll_id)
-    poll_doc = poll_ref.get()
-    poll_data = poll_doc.to_dict()
-
     # Calculate approval scores (approvals - rejections)
-    phase1_votes = poll_data.get("phase1Votes", {})
     all_candidates_data = poll_data.get("allCandidates", [])
 
     # Build score map
@@ -1518,61 +4475,86 @@ def transition_phase1_to_phase2(poll_id: str) -> None:
             "ranking": candidate_data["ranking"]
         }
 
-    # Count approvals and rejections
-    for vote_data in phase1_votes.values():
-        approved = vote_data.get("approved", [])
-        rejected = vote_data.get("rejected")
-
-        for candidate in approved:
+    # Fill in approvals and rejections
+    for field in ("approvals", "rejections"):
+        for candidate, count in tallies[field].items():
             if candidate in scores:
-                scores[candidate]["approvals"] += 1
-
-        if rejected and rejected in scores:
-            scores[rejected]["rejections"] += 1
+                scores[candidate][field] = count
 
     # Calculate net scores (approvals - rejections)
     for candidate in scores:
         scores[candidate]["net_score"] = scores[candidate]["approvals"] - scores[candidate]["rejections"]
 
-    # Sort by net_score (desc), then by LLM ranking (asc for tie-breaking)
-    sorted_candidates = sorted(
-        scores.items(),
+    # Top 3 by net_score (desc), then by LLM ranking (asc for tie-breaking)
+    top_3 = top_k(
+        scores.items(), 3,
         key=lambda x: (-x[1]["net_score"], x[1]["ranking"])
     )
-
-    # Get Top 3
-    top_3 = [candidate for candidate, data in sorted_candidates[:3]]
-
-    # Update poll to Phase 2
-    poll_ref.update({
-        "phase": "phase2",
-        "phase2Candidates": top_3,
-        "lockedInUsers": [],  # Reset for Phase 2
-        "candidates": top_3  # Update legacy field
-    })
-
-    print(f"Poll {poll_id} transitioned to Phase 2. Top 3: {top_3}", flush=True)
+    return [candidate for candidate, data in top_3]
 
 
-def close_poll_internal(poll_id: str) -> Dict[str, Any]:
+def transition_phase1_to_phase2(poll_id: str) -> None:
     """
-    Internal helper to close a poll and compute rankings.
-    Handles both two-phase voting and legacy single-phase voting.
+    Transition poll from Phase 1 to Phase 2.
+    Calculates Top 3 candidates from Phase 1 approval votes.
 
-    Returns the updated poll data.
+    Runs as a Firestore transaction guarded by phase == "phase1", so when
+    several callers race (last lock-in, deadline scheduler) only the first
+    one writes; the rest see the poll already in Phase 2 and do nothing.
+    It runs after stop_phase_voting(), so no Phase 1 vote commits after
+    the tallies are read.
     """
+    # Stop Phase 1 votes first, so the tallies read below are final
+    if stop_phase_voting(poll_id, "phase1") is None:
+        return
     poll_ref = db.collection("polls").document(poll_id)
-    poll_doc = poll_ref.get()
-    poll_data = poll_doc.to_dict()
 
+    @transactional
+    def transition_in_transaction(transaction, poll_ref):
+        poll_snapshot = poll_ref.get(transaction=transaction)
+        if not poll_snapshot.exists:
+            return None
+
+        poll_data = poll_snapshot.to_dict()
+        if poll_data.get("status") != "active" or poll_data.get("phase") != "phase1":
+            return None
+
+        top_3 = compute_phase2_candidates(poll_data, read_vote_tallies(poll_id, transaction))
+
+        # Update poll to Phase 2 (lock-ins are counted per phase, nothing to reset)
+        update_data = {
+            "phase": "phase2",
+            "phase2Candidates": top_3,
+            "candidates": top_3  # Update legacy field
+        }
+        transaction.update(poll_ref, update_data)
+        poll_data.update(update_data)
+        return poll_data
+
+    poll_data = transition_in_transaction(db.transaction(), poll_ref)
+    if poll_data is None:
+        return
+
+    notify_poll_changed(poll_id)
+
+    # Phase 2 closes after the grace period unless everyone locks in first
+    POLL_SCHEDULER.schedule_poll(poll_id, poll_data)
+
+    print(f"Poll {poll_id} transitioned to Phase 2. Top 3: {poll_data['phase2Candidates']}", flush=True)
+
+
+def compute_result_ranking(poll_data: Dict[str, Any], vote_counts: Dict[str, int] = None) -> List[str]:
+    """
+    Final ranking of a poll's candidates.
+    Handles both two-phase voting (vote_counts: Phase 2 selections per
+    candidate) and legacy single-phase voting.
+    """
     # Check if this is a two-phase poll
     is_two_phase = "phase" in poll_data and poll_data.get("phase") in ["phase1", "phase2"]
 
     if is_two_phase:
         # Two-phase voting: use Phase 2 votes with LLM tie-breaking
-        print(f"🔒 Closing two-phase poll {poll_id}", flush=True)
-
-        phase2_votes = poll_data.get("phase2Votes", {})
+        vote_counts = vote_counts or {}
         all_candidates_data = poll_data.get("allCandidates", [])
         phase2_candidates = poll_data.get("phase2Candidates", [])
 
@@ -1587,9 +4569,9 @@ def close_poll_internal(poll_id: str) -> Dict[str, Any]:
                 }
 
         # Count Phase 2 votes
-        for selected_candidate in phase2_votes.values():
-            if selected_candidate in scores:
-                scores[selected_candidate]["votes"] += 1
+        for candidate, count in vote_counts.items():
+            if candidate in scores:
+                scores[candidate]["votes"] = count
 
         # Sort by vote count (desc), then by LLM ranking (asc for tie-breaking)
         sorted_candidates = sorted(
@@ -1604,12 +4586,8 @@ def close_poll_internal(poll_id: str) -> Dict[str, Any]:
             if candidate not in result_ranking:
                 result_ranking.append(candidate)
 
-        print(f"✅ Two-phase poll results: {result_ranking}", flush=True)
-
     else:
         # Legacy single-phase voting
-        print(f"🔒 Closing legacy single-phase poll {poll_id}", flush=True)
-
         votes = poll_data.get("votes", {})
         candidate_scores = {}
 
@@ -1632,26 +4610,73 @@ def close_poll_internal(poll_id: str) -> Dict[str, Any]:
 
         result_ranking = [candidate for candidate, score in sorted_candidates]
 
-        print(f"✅ Legacy poll results: {result_ranking}", flush=True)
+    return result_ranking
 
-    # Update poll document
-    poll_ref.update({
-        "status": "closed",
-        "phase": "closed",  # Mark phase as closed for two-phase polls
-        "resultRanking": result_ranking
-    })
 
-    # Update team
-    team_id = poll_data["teamId"]
-    team_ref = db.collection("teams").document(team_id)
-    team_ref.update({
-        "currentlyOpenPoll": None,
-        "lastMealPoll": result_ranking[0] if result_ranking else None  # Use lastMealPoll field
-    })
+def close_poll_internal(poll_id: str) -> Dict[str, Any]:
+    """
+    Internal helper to close a poll and compute rankings.
+    Handles both two-phase voting and legacy single-phase voting.
+
+    The poll and team updates commit in one Firestore transaction guarded by
+    status != "closed". Concurrent callers (deadline scheduler, last vote,
+    manual close) therefore compute and write the result exactly once; the
+    others get the stored result back without writing. Voting is stopped
+    first (stop_phase_voting), so no vote commits after the tallies are read.
 
-    poll_data["status"] = "closed"
-    poll_data["phase"] = "closed"
-    poll_data["resultRanking"] = result_ranking
+    Returns the updated poll data.
+    """
+    stop_phase_voting(poll_id)
+    poll_ref = db.collection("polls").document(poll_id)
+
+    @transactional
+    def close_in_transaction(transaction, poll_ref):
+        poll_snapshot = poll_ref.get(transaction=transaction)
+        poll_data = poll_snapshot.to_dict()
+
+        if poll_data.get("status") == "closed":
+            return poll_data, False
+
+        team_ref = db.collection("teams").document(poll_data["teamId"])
+        team_snapshot = team_ref.get(transaction=transaction)
+
+        vote_counts = None
+        if poll_data.get("phase") in ("phase1", "phase2"):
+            vote_counts = read_vote_tallies(poll_id, transaction)["selections"]
+        result_ranking = compute_result_ranking(poll_data, vote_counts)
+
+        # Update poll document
+        close_data = {
+            "status": "closed",
+            "phase": "closed",  # Mark phase as closed for two-phase polls
+            "resultRanking": result_ranking
+        }
+        if vote_counts is not None:
+            close_data["phase2VoteCounts"] = vote_counts  # Shown with the results
+        # Finalized GET payload, so reads of the closed poll just serve it
+        close_data["resultPayload"] = serialize_result_payload(
+            build_closed_poll_payload(poll_id, {**poll_data, **close_data})
+        )
+        transaction.update(poll_ref, close_data)
+
+        # Update team (leave a newer poll in currentlyOpenPoll alone)
+        if team_snapshot.exists:
+            team_update = {
+                "lastMealPoll": result_ranking[0] if result_ranking else None  # Use lastMealPoll field
+            }
+            if team_snapshot.to_dict().get("currentlyOpenPoll") == poll_id:
+                team_update["currentlyOpenPoll"] = None
+            transaction.update(team_ref, team_update)
+
+        poll_data.update(close_data)
+        return poll_data, True
+
+    poll_data, closed_now = close_in_transaction(db.transaction(), poll_ref)
+
+    if closed_now:
+        closed_poll_result(poll_id, poll_data)  # Warm the result cache before waking streams
+        notify_poll_changed(poll_id)
+        print(f"🔒 Poll {poll_id} closed. Results: {poll_data['resultRanking']}", flush=True)
 
     return poll_data
 
@@ -1663,49 +4688,41 @@ def close_poll_now(poll_id):
     Useful for admin/testing to reset team state when a poll got stuck.
     """
     try:
-        poll_ref = db.collection("polls").document(poll_id)
-        poll_doc = poll_ref.get()
-        if not poll_doc.exists:
-            return jsonify({"error": "Poll not found"}), 404
-        poll_data = poll_doc.to_dict()
-        if poll_data.get("status") == "closed":
-            result_ranking = poll_data.get("resultRanking", [])
-            return jsonify({
-                "pollId": poll_id,
-                "status": "closed",
-                "resultRanking": [
-                    {"rank": i + 1, "name": name} for i, name in enumerate(result_ranking)
-                ],
-                "winner": result_ranking[0] if result_ranking else None
-            }), 200
-        updated = close_poll_internal(poll_id)
+        result = CLOSED_POLL_RESULTS.get(poll_id)
+        if result is None:
+            poll_ref = db.collection("polls").document(poll_id)
+            poll_doc = poll_ref.get()
+            if not poll_doc.exists:
+                return jsonify({"error": "Poll not found"}), 404
+            poll_data = poll_doc.to_dict()
+            if not is_poll_closed(poll_data):
+                poll_data = close_poll_internal(poll_id)
+            result = closed_poll_result(poll_id, poll_data)
+
         return jsonify({
             "pollId": poll_id,
-            "status": updated.get("status"),
+            "status": "closed",
             "resultRanking": [
-                {"rank": i + 1, "name": name} for i, name in enumerate(updated.get("resultRanking", []))
+                {"rank": i + 1, "name": entry["name"]} for i, entry in enumerate(result.payload["results"])
             ],
-            "winner": updated.get("resultRanking", [None])[0] if updated.get("resultRanking") else None
+            "winner": result.payload["winner"]
         }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 def load_mock_candidates_from_file() -> List[str]:
-    dataset_path = os.path.join(os.path.dirname(__file__), "food_dataset.json")
-    try:
-        with open(dataset_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        food_names = [item["name"] for item in data if "name" in item]
-        print(f"✅ Loaded {len(food_names)} meals from {dataset_path}")
+    # Names come from the loaded catalogue instead of re-parsing the JSON file
+    food_names = [food.name for food in FOOD_CATALOGUE.foods if food.name]
+    if food_names:
         return food_names
-    except Exception as e:
-        print(f"⚠️ Error reading {dataset_path}: {e}")
-        return [
-            "Bibimbap", "Vegan Burger", "Tonkotsu Ramen", "Naengmyeon",
-            "Nasi Goreng", "Pizza Margherita", "Vegan Tofu Bowl", "Kimchi Jjigae",
-            "Pad Thai", "Falafel Wrap", "Miso Ramen", "Veggie Burger",
-            "Bulgogi", "Sushi Platter", "Vegetarian Curry", "Huevos Rancheros"
-        ]
+
+    print("⚠️ Food catalogue not loaded; using built-in meal names")
+    return [
+        "Bibimbap", "Vegan Burger", "Tonkotsu Ramen", "Naengmyeon",
+        "Nasi Goreng", "Pizza Margherita", "Vegan Tofu Bowl", "Kimchi Jjigae",
+        "Pad Thai", "Falafel Wrap", "Miso Ramen", "Veggie Burger",
+        "Bulgogi", "Sushi Platter", "Vegetarian Curry", "Huevos Rancheros"
+    ]
 
 
 if __name__ == "__main__":
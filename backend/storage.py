@@ -0,0 +1,585 @@
+"""
+Storage backends for the poll server.
+
+Route handlers in server.py talk to a Firestore-style client: collections,
+document references, get/set/update, get_all, batches and transactions.
+This module picks that client from STORAGE_BACKEND:
+
+- "firestore" (default): the Firebase Admin Firestore client
+- "memory": MemoryFirestore, an in-process stand-in with the same surface
+  and the same optimistic transaction semantics, so the full voting flow can
+  be exercised and load-tested without a Firebase project or any network.
+"""
+
+import copy
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from firebase_admin import firestore
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.field_path import FieldPath
+
+MAX_TRANSACTION_ATTEMPTS = 5
+
+# How long an in-memory transaction waits for another one's document lock
+LOCK_TIMEOUT_SECONDS = 5
+
+
+def create_client(backend: str = None):
+    """Create the storage client selected by STORAGE_BACKEND."""
+    backend = (backend or os.environ.get("STORAGE_BACKEND", "firestore")).lower()
+
+    if backend == "firestore":
+        return firestore.client()
+    if backend == "memory":
+        latency_ms = float(os.environ.get("MEMORY_STORE_LATENCY_MS", 0))
+        return MemoryFirestore(latency_seconds=latency_ms / 1000)
+
+    raise ValueError(f"Unknown STORAGE_BACKEND '{backend}' (expected 'firestore' or 'memory')")
+
+
+def transactional(fn):
+    """
+    Drop-in replacement for firestore.transactional that also accepts
+    MemoryTransaction. Retries the wrapped function on write conflicts and
+    raises ValueError once the transaction's max_attempts are exhausted,
+    like the Firestore client does.
+    """
+    firestore_fn = firestore.transactional(fn)
+
+    def run(transaction, *args, **kwargs):
+        if not isinstance(transaction, MemoryTransaction):
+            return firestore_fn(transaction, *args, **kwargs)
+
+        last_conflict = None
+        for _ in range(transaction.max_attempts):
+            transaction._begin()
+            try:
+                result = fn(transaction, *args, **kwargs)
+                transaction._commit()
+                return result
+            except exceptions.Aborted as conflict:
+                last_conflict = conflict
+            finally:
+                transaction._reset()
+
+        raise ValueError(
+            f"Failed to commit transaction in {transaction.max_attempts} attempts."
+        ) from last_conflict
+
+    return run
+
+
+# ============================================================================
+# IN-MEMORY FIRESTORE STAND-IN
+# ============================================================================
+
+def _split_field_path(field_path: str) -> List[str]:
+    # Dotted paths address nested map fields, e.g. "votes.<uid>"; segments
+    # quoted in backticks (FieldPath.to_api_repr()) may contain dots
+    return list(FieldPath.from_string(field_path).parts)
+
+
+def _resolve_value(current: Any, value: Any, commit_time: datetime) -> Any:
+    """Apply a Firestore transform sentinel to the current field value."""
+    if value is transforms.SERVER_TIMESTAMP:
+        return commit_time
+    if isinstance(value, transforms.Increment):
+        base = current if isinstance(current, (int, float)) else 0
+        return base + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        for item in value.values:
+            if item not in result:
+                result.append(copy.deepcopy(item))
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        if not isinstance(current, list):
+            return []
+        return [item for item in current if item not in value.values]
+    return copy.deepcopy(value)
+
+
+def _apply_update(data: Dict[str, Any], updates: Dict[str, Any], commit_time: datetime) -> None:
+    """Apply a Firestore update() payload (dotted paths + sentinels) in place."""
+    for field_path, value in updates.items():
+        parts = _split_field_path(field_path)
+        target = data
+        for part in parts[:-1]:
+            child = target.get(part)
+            if not isinstance(child, dict):
+                if value is transforms.DELETE_FIELD:
+                    break
+                child = target[part] = {}
+            target = child
+        else:
+            leaf = parts[-1]
+            if value is transforms.DELETE_FIELD:
+                target.pop(leaf, None)
+            else:
+                target[leaf] = _resolve_value(target.get(leaf), value, commit_time)
+
+
+def _merge(data: Dict[str, Any], updates: Dict[str, Any], commit_time: datetime) -> None:
+    """Apply a set(..., merge=True) payload: nested maps merge recursively."""
+    for key, value in updates.items():
+        if isinstance(value, dict):
+            # Nested maps may carry sentinels (e.g. Increment) even when new
+            if not isinstance(data.get(key), dict):
+                data[key] = {}
+            _merge(data[key], value, commit_time)
+        elif value is transforms.DELETE_FIELD:
+            data.pop(key, None)
+        else:
+            data[key] = _resolve_value(data.get(key), value, commit_time)
+
+
+class _StoredDocument:
+    # version comes from a store-wide counter, so a deleted and re-created
+    # document never reuses a version an open transaction may have read
+    __slots__ = ("data", "version", "create_time", "update_time")
+
+    def __init__(self, data: Dict[str, Any], version: int, commit_time: datetime):
+        self.data = data
+        self.version = version
+        self.create_time = commit_time
+        self.update_time = commit_time
+
+
+class MemoryDocumentSnapshot:
+    def __init__(self, reference, stored: Optional[_StoredDocument]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = stored is not None
+        self._data = copy.deepcopy(stored.data) if stored is not None else None
+        self.create_time = stored.create_time if stored is not None else None
+        self.update_time = stored.update_time if stored is not None else None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        value = self._data
+        for part in _split_field_path(field_path):
+            value = value[part]
+        return copy.deepcopy(value)
+
+
+class MemoryDocumentReference:
+    def __init__(self, client: "MemoryFirestore", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "MemoryCollectionReference":
+        return MemoryCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction: "MemoryTransaction" = None) -> MemoryDocumentSnapshot:
+        return self._client._get(self, transaction)
+
+    def set(self, document_data: Dict[str, Any], merge: bool = False) -> datetime:
+        return self._client._write([("set", self, document_data, merge)])
+
+    def update(self, field_updates: Dict[str, Any]) -> datetime:
+        return self._client._write([("update", self, field_updates, False)])
+
+    def delete(self) -> None:
+        self._client._write([("delete", self, None, False)])
+
+    def on_snapshot(self, callback) -> "MemoryWatch":
+        """callback([snapshot], changes, read_time) now and after every write to this document."""
+        return self._client._listen("document", self.path, callback)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MemoryDocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+
+class MemoryQuery:
+    _OPERATORS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a is not None and a < b,
+        "<=": lambda a, b: a is not None and a <= b,
+        ">": lambda a, b: a is not None and a > b,
+        ">=": lambda a, b: a is not None and a >= b,
+        "in": lambda a, b: a in b,
+        "not-in": lambda a, b: a not in b,
+        "array_contains": lambda a, b: isinstance(a, list) and b in a,
+    }
+
+    def __init__(self, collection: "MemoryCollectionReference", filters=None, limit: int = None):
+        self._collection = collection
+        self._filters = filters or []
+        self._limit = limit
+
+    def where(self, field_path: str = None, op_string: str = None, value: Any = None, *, filter=None) -> "MemoryQuery":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in self._OPERATORS:
+            raise ValueError(f"Unsupported operator for in-memory query: {op_string}")
+        return MemoryQuery(self._collection, self._filters + [(field_path, op_string, value)], self._limit)
+
+    def limit(self, count: int) -> "MemoryQuery":
+        return MemoryQuery(self._collection, self._filters, count)
+
+    def stream(self, transaction: "MemoryTransaction" = None):
+        results = []
+        for snapshot in self._collection._client._list(self._collection.path, transaction):
+            data = snapshot._data
+            if all(self._matches(data, f) for f in self._filters):
+                results.append(snapshot)
+                if self._limit is not None and len(results) >= self._limit:
+                    break
+        return iter(results)
+
+    def get(self, transaction: "MemoryTransaction" = None) -> List[MemoryDocumentSnapshot]:
+        return list(self.stream(transaction=transaction))
+
+    def _matches(self, data: Dict[str, Any], query_filter) -> bool:
+        field_path, op_string, value = query_filter
+        current = data
+        for part in _split_field_path(field_path):
+            if not isinstance(current, dict) or part not in current:
+                return False
+            current = current[part]
+        return self._OPERATORS[op_string](current, value)
+
+
+class MemoryCollectionReference(MemoryQuery):
+    def __init__(self, client: "MemoryFirestore", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+        super().__init__(self)
+
+    def document(self, document_id: str = None) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self._client, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data: Dict[str, Any], document_id: str = None):
+        doc_ref = self.document(document_id)
+        return doc_ref.set(document_data), doc_ref
+
+    def on_snapshot(self, callback) -> "MemoryWatch":
+        """callback(snapshots, changes, read_time) now and after every write to one of its documents."""
+        return self._client._listen("collection", self.path, callback)
+
+
+class MemoryWatch:
+    """Handle of an on_snapshot listener. Callbacks run on the writing thread, after the write."""
+
+    def __init__(self, client: "MemoryFirestore", kind: str, path: str, callback):
+        self._client = client
+        self.kind = kind
+        self.path = path
+        self.callback = callback
+
+    def unsubscribe(self) -> None:
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
+
+
+class MemoryWriteBatch:
+    def __init__(self, client: "MemoryFirestore"):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge: bool = False) -> None:
+        self._writes.append(("set", reference, document_data, merge))
+
+    def update(self, reference, field_updates) -> None:
+        self._writes.append(("update", reference, field_updates, False))
+
+    def delete(self, reference) -> None:
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self) -> None:
+        writes, self._writes = self._writes, []
+        self._client._write(writes)
+
+
+class _DocumentLock:
+    """
+    Shared/exclusive lock on one document, held by transactions.
+
+    Reads take it shared, so transactions that only read a document (e.g.
+    every vote reading its poll) do not wait for each other. At commit, a
+    transaction turns its hold exclusive on the documents it read and now
+    writes; that waits for the other readers to finish, and new readers
+    queue behind it. Two transactions upgrading the same document would wait
+    on each other forever, so the second one is refused and aborts.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = set()  # transactions holding the lock shared
+        self._writer = None  # transaction holding it exclusive
+        self._upgrading = None  # transaction waiting to make its hold exclusive
+
+    def acquire_shared(self, owner, timeout: float) -> bool:
+        with self._cond:
+            if owner in self._readers or self._writer is owner:
+                return True
+            if not self._cond.wait_for(lambda: self._writer is None and self._upgrading is None, timeout):
+                return False
+            self._readers.add(owner)
+            return True
+
+    def acquire_exclusive(self, owner, timeout: float) -> bool:
+        with self._cond:
+            if self._writer is owner:
+                return True
+            if self._upgrading is not None:
+                return False
+            self._upgrading = owner
+            acquired = self._cond.wait_for(
+                lambda: self._writer is None and self._readers <= {owner}, timeout
+            )
+            self._upgrading = None
+            if acquired:
+                self._readers.discard(owner)
+                self._writer = owner
+            self._cond.notify_all()
+            return acquired
+
+    def release(self, owner) -> None:
+        with self._cond:
+            self._readers.discard(owner)
+            if self._writer is owner:
+                self._writer = None
+            self._cond.notify_all()
+
+
+class MemoryTransaction(MemoryWriteBatch):
+    """
+    Transaction with Firestore server-SDK semantics: reading a document takes
+    a shared lock on it until commit or rollback, and committing a write to a
+    document that was read waits for its other readers, so concurrent
+    transactions on the same document queue up instead of failing. A lock
+    that cannot be taken in LOCK_TIMEOUT_SECONDS aborts the attempt, and the
+    commit also aborts if any other write changed a document that was read.
+    """
+
+    def __init__(self, client: "MemoryFirestore", max_attempts: int = MAX_TRANSACTION_ATTEMPTS):
+        super().__init__(client)
+        self.max_attempts = max_attempts
+        self._read_versions = {}
+        self._held_locks = {}  # path -> _DocumentLock
+        self.in_progress = False
+
+    def _begin(self) -> None:
+        self._read_versions = {}
+        self._writes = []
+        self.in_progress = True
+
+    def _lock_documents(self, paths: List[str]) -> None:
+        # Sorted acquisition keeps multi-document reads deadlock-free
+        for path in sorted(set(paths)):
+            if path in self._held_locks:
+                continue
+            lock = self._client._document_lock(path)
+            if not lock.acquire_shared(self, timeout=LOCK_TIMEOUT_SECONDS):
+                raise exceptions.Aborted(f"Timed out waiting for lock on {path}")
+            self._held_locks[path] = lock
+
+    def _record_read(self, path: str, version: int) -> None:
+        if self._writes:
+            raise exceptions.InvalidArgument(
+                "Firestore transactions require all reads to be executed before all writes."
+            )
+        self._read_versions.setdefault(path, version)
+
+    def _commit(self) -> None:
+        writes, self._writes = self._writes, []
+        # Blind writes (documents not read here) are not locked; the version
+        # check of any transaction that did read them catches the change
+        for path in sorted({reference.path for _, reference, _, _ in writes} & set(self._held_locks)):
+            if not self._held_locks[path].acquire_exclusive(self, timeout=LOCK_TIMEOUT_SECONDS):
+                raise exceptions.Aborted(f"Could not lock {path} for writing")
+        self._client._write(writes, expected_versions=self._read_versions)
+
+    def _reset(self) -> None:
+        self._read_versions = {}
+        self._writes = []
+        self.in_progress = False
+        for lock in self._held_locks.values():
+            lock.release(self)
+        self._held_locks = {}
+
+
+class MemoryFirestore:
+    """
+    In-process Firestore stand-in.
+
+    Documents are kept as deep copies keyed by path, each with a version
+    counter. latency_seconds adds a fixed delay per round trip to approximate
+    network cost in benchmarks.
+    """
+
+    def __init__(self, latency_seconds: float = 0):
+        self.latency_seconds = latency_seconds
+        self._documents = {}  # path -> _StoredDocument
+        self._write_clock = 0
+        self._last_commit_time = datetime.min
+        self._document_locks = {}  # path -> _DocumentLock held by transactions
+        self._watches = []  # MemoryWatch listeners
+        self._lock = threading.RLock()
+
+    def collection(self, name: str) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self, name)
+
+    def document(self, path: str) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self, path)
+
+    def get_all(self, references, field_paths=None, transaction: MemoryTransaction = None):
+        references = list(references)
+        if transaction is not None:
+            transaction._lock_documents([ref.path for ref in references])
+        self._round_trip()
+        with self._lock:
+            return [self._snapshot(ref, transaction) for ref in references]
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def transaction(self, max_attempts: int = MAX_TRANSACTION_ATTEMPTS) -> MemoryTransaction:
+        return MemoryTransaction(self, max_attempts=max_attempts)
+
+    def reset(self) -> None:
+        """Drop every document, lock and listener, e.g. between benchmark runs or tests."""
+        with self._lock:
+            self._documents.clear()
+            self._document_locks.clear()
+            self._watches.clear()
+
+    # -- internals -----------------------------------------------------------
+
+    def _round_trip(self) -> None:
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+
+    def _snapshot(self, reference: MemoryDocumentReference, transaction: MemoryTransaction = None):
+        stored = self._documents.get(reference.path)
+        if transaction is not None:
+            transaction._record_read(reference.path, stored.version if stored else 0)
+        return MemoryDocumentSnapshot(reference, stored)
+
+    def _document_lock(self, path: str) -> _DocumentLock:
+        with self._lock:
+            lock = self._document_locks.get(path)
+            if lock is None:
+                lock = self._document_locks[path] = _DocumentLock()
+            return lock
+
+    def _get(self, reference: MemoryDocumentReference, transaction: MemoryTransaction = None):
+        if transaction is not None:
+            transaction._lock_documents([reference.path])
+        self._round_trip()
+        with self._lock:
+            return self._snapshot(reference, transaction)
+
+    def _list(self, collection_path: str, transaction: MemoryTransaction = None):
+        self._round_trip()
+        prefix = collection_path + "/"
+        with self._lock:
+            return [
+                self._snapshot(MemoryDocumentReference(self, path), transaction)
+                for path in list(self._documents)
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            ]
+
+    def _commit_time(self) -> datetime:
+        # Strictly increasing, so update_time always tells two commits apart
+        # (it is used as a cache version) even within one clock tick
+        commit_time = max(datetime.utcnow(), self._last_commit_time + timedelta(microseconds=1))
+        self._last_commit_time = commit_time
+        return commit_time
+
+    def _listen(self, kind: str, path: str, callback) -> MemoryWatch:
+        watch = MemoryWatch(self, kind, path, callback)
+        with self._lock:
+            self._watches.append(watch)
+            initial = self._watch_snapshots(watch)
+        callback(initial, [], datetime.utcnow())
+        return watch
+
+    def _watch_snapshots(self, watch: MemoryWatch) -> List[MemoryDocumentSnapshot]:
+        if watch.kind == "document":
+            reference = MemoryDocumentReference(self, watch.path)
+            return [MemoryDocumentSnapshot(reference, self._documents.get(watch.path))]
+        prefix = watch.path + "/"
+        return [
+            MemoryDocumentSnapshot(MemoryDocumentReference(self, path), stored)
+            for path, stored in list(self._documents.items())
+            if path.startswith(prefix) and "/" not in path[len(prefix):]
+        ]
+
+    def _write(self, writes, expected_versions: Dict[str, int] = None) -> datetime:
+        """Apply writes atomically; returns the commit time (every written document's update_time)."""
+        self._round_trip()
+        with self._lock:
+            commit_time = self._apply_writes(writes, expected_versions)
+
+            # Listeners see the committed state; call them without the store lock
+            written = {reference.path for _, reference, _, _ in writes}
+            notifications = [
+                (watch.callback, self._watch_snapshots(watch))
+                for watch in self._watches
+                if (watch.path in written if watch.kind == "document"
+                    else any(path.rsplit("/", 1)[0] == watch.path for path in written))
+            ]
+        for callback, snapshots in notifications:
+            callback(snapshots, [], commit_time)
+        return commit_time
+
+    def _apply_writes(self, writes, expected_versions: Dict[str, int] = None) -> datetime:
+        # Caller holds self._lock
+        for path, version in (expected_versions or {}).items():
+            stored = self._documents.get(path)
+            if (stored.version if stored else 0) != version:
+                raise exceptions.Aborted(f"Transaction conflict on {path}")
+
+        # Validate first so a failing write leaves the batch unapplied
+        for kind, reference, _, _ in writes:
+            if kind == "update" and reference.path not in self._documents:
+                raise exceptions.NotFound(f"No document to update: {reference.path}")
+
+        commit_time = self._commit_time()
+        staged = {}
+        for kind, reference, payload, merge in writes:
+            path = reference.path
+            current = staged[path] if path in staged else self._documents.get(path)
+            data = copy.deepcopy(current.data) if current is not None else None
+
+            if kind == "delete":
+                staged[path] = None
+                continue
+            if kind == "set" and not merge:
+                data = {}
+                _merge(data, payload, commit_time)
+            elif kind == "set":
+                data = data or {}
+                _merge(data, payload, commit_time)
+            else:
+                _apply_update(data, payload, commit_time)
+
+            self._write_clock += 1
+            new_doc = _StoredDocument(data, self._write_clock, commit_time)
+            if current is not None:
+                new_doc.create_time = current.create_time
+            staged[path] = new_doc
+
+        for path, stored in staged.items():
+            if stored is None:
+                self._documents.pop(path, None)
+            else:
+                self._documents[path] = stored
+        return commit_time
@@ -1 +1,192 @@
- 
\ No newline at end of file
+"""
+API tests for the two-phase poll flow, run against the in-memory store.
+"""
+
+from datetime import datetime
+
+import server
+
+
+def start_poll(client, team) -> dict:
+    response = client.post("/polls/start", json={
+        "teamId": team["teamId"], "pollTitle": "Lunch", "durationMinutes": 5, "async": False
+    })
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def vote_phase1(client, poll_id, user_id, approved, rejected=None):
+    return client.post(
+        f"/polls/{poll_id}/phase1-vote",
+        json={"approvedCandidates": approved, "rejectedCandidate": rejected},
+        headers={"X-User-Id": user_id}
+    )
+
+
+def vote_phase2(client, poll_id, user_id, selected):
+    return client.post(
+        f"/polls/{poll_id}/phase2-vote", json={"selectedCandidate": selected}, headers={"X-User-Id": user_id}
+    )
+
+
+def poll_document(poll_id) -> dict:
+    return server.db.collection("polls").document(poll_id).get().to_dict()
+
+
+def test_revote_moves_tallies(client, team):
+    poll = start_poll(client, team)
+    a, b, c = poll["candidates"][:3]
+    voter = team["members"][0]
+
+    assert vote_phase1(client, poll["pollId"], voter, [a, b]).status_code == 200
+    response = vote_phase1(client, poll["pollId"], voter, [b, c])
+
+    assert response.status_code == 200
+    assert response.get_json()["lockedInUserCount"] == 1
+    tallies = server.read_vote_tallies(poll["pollId"])
+    assert tallies["approvals"] == {b: 1, c: 1}
+    assert tallies["phase1LockedIn"] == 1
+
+
+def test_one_rejection_per_member(client, team):
+    poll = start_poll(client, team)
+    a, b, c = poll["candidates"][:3]
+    voter = team["members"][0]
+
+    response = vote_phase1(client, poll["pollId"], voter, [a], rejected=b)
+    assert response.status_code == 200
+    assert response.get_json()["replacementCandidate"] not in (None, a, b, c)
+    assert vote_phase1(client, poll["pollId"], voter, [a], rejected=c).status_code == 400
+
+    assert server.read_vote_tallies(poll["pollId"])["rejections"] == {b: 1}
+    assert b not in poll_document(poll["pollId"])["visibleCandidates"]
+
+
+def test_non_member_cannot_vote(client, team):
+    poll = start_poll(client, team)
+    assert vote_phase1(client, poll["pollId"], "stranger", poll["candidates"][:1]).status_code == 403
+
+
+def test_transition_is_idempotent(client, team):
+    poll = start_poll(client, team)
+    poll_id = poll["pollId"]
+    first = poll["candidates"][0]
+    for user_id in team["members"]:
+        assert vote_phase1(client, poll_id, user_id, [first]).status_code == 200
+
+    # The last lock-in moved the poll on; a late deadline must not redo it
+    moved = poll_document(poll_id)
+    assert moved["phase"] == "phase2"
+    assert moved["phase2Candidates"][0] == first
+    server.transition_phase1_to_phase2(poll_id)
+    assert poll_document(poll_id)["phase2Candidates"] == moved["phase2Candidates"]
+
+    # Phase 1 is over for everyone
+    response = vote_phase1(client, poll_id, team["members"][0], [first])
+    assert response.status_code == 400
+
+
+def test_vote_after_voting_stopped_is_refused(client, team):
+    poll = start_poll(client, team)
+    server.stop_phase_voting(poll["pollId"], "phase1")
+
+    response = vote_phase1(client, poll["pollId"], team["members"][0], poll["candidates"][:1])
+
+    assert response.status_code == 400
+    assert server.read_vote_tallies(poll["pollId"])["phase1LockedIn"] == 0
+
+
+def test_vote_from_another_process_wakes_streams(client, team):
+    poll = start_poll(client, team)
+    poll_id = poll["pollId"]
+    assert server.get_locked_in_counts(poll_id)["phase1"] == 0  # Now cached
+    subscription = server.POLL_EVENTS.subscribe(poll_id)
+    try:
+        while not subscription.empty():
+            subscription.get_nowait()  # Initial snapshots
+
+        # Written straight to the store, as a vote handled by another worker would be
+        batch = server.db.batch()
+        batch.set(server.ballot_ref(poll_id, team["members"][0]), {
+            "userId": team["members"][0], "phase1": {"approved": poll["candidates"][:1], "rejected": None}
+        })
+        batch.set(server.random_vote_shard_ref(poll_id), {
+            "phase1LockedIn": server.firestore.Increment(1),
+            "approvals": {poll["candidates"][0]: server.firestore.Increment(1)}
+        }, merge=True)
+        batch.commit()
+
+        assert subscription.get(timeout=1)
+        assert server.get_locked_in_counts(poll_id)["phase1"] == 1
+    finally:
+        server.POLL_EVENTS.unsubscribe(poll_id, subscription)
+
+
+def test_close_is_idempotent(client, team):
+    poll = start_poll(client, team)
+    poll_id = poll["pollId"]
+    server.transition_phase1_to_phase2(poll_id)
+    top_3 = poll_document(poll_id)["phase2Candidates"]
+    assert vote_phase2(client, poll_id, team["members"][0], top_3[1]).status_code == 200
+
+    closed = server.close_poll_internal(poll_id)
+    again = server.close_poll_internal(poll_id)
+    response = client.post(f"/polls/{poll_id}/close")
+
+    assert closed["resultRanking"][0] == top_3[1]
+    assert again["resultPayload"] == closed["resultPayload"]
+    assert response.status_code == 200 and response.get_json()["winner"] == top_3[1]
+    assert poll_document(poll_id)["phase2VoteCounts"] == {top_3[1]: 1}
+    assert server.db.collection("teams").document(team["teamId"]).get().to_dict()["currentlyOpenPoll"] is None
+
+    # Votes after the close are refused, not silently dropped
+    assert vote_phase2(client, poll_id, team["members"][1], top_3[0]).status_code == 400
+
+
+def test_closed_poll_is_served_with_etag(client, team):
+    poll = start_poll(client, team)
+    server.close_poll_internal(poll["pollId"])
+
+    response = client.get(f"/polls/{poll['pollId']}")
+    etag = response.headers["ETag"]
+    not_modified = client.get(f"/polls/{poll['pollId']}", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200 and response.get_json()["status"] == "closed"
+    assert not_modified.status_code == 304
+    assert not_modified.data == b""
+
+
+def test_legacy_inline_votes_move_to_ballots(client, team):
+    poll = start_poll(client, team)
+    poll_id = poll["pollId"]
+    a, b, c = poll["candidates"][:3]
+    first, second = team["members"][:2]
+    server.db.collection("polls").document(poll_id).update({
+        "voteStorage": server.firestore.DELETE_FIELD,
+        "phase1Votes": {first: {"approved": [a], "rejected": None}, second: {"approved": [a, b], "rejected": c}},
+        "lockedInUsers": [first, second]
+    })
+    server.POLL_CACHE.clear()
+
+    body = client.get(f"/polls/{poll_id}", headers={"X-User-Id": second}).get_json()
+
+    assert body["lockedInUserCount"] == 2
+    assert body["yourApprovedCandidates"] == [a, b]
+    tallies = server.read_vote_tallies(poll_id)
+    assert tallies["approvals"] == {a: 2, b: 1}
+    assert tallies["rejections"] == {c: 1}
+    assert "phase1Votes" not in poll_document(poll_id)
+
+
+def test_stuck_generation_frees_the_team(client, team):
+    poll_data = server.new_poll_document(
+        "Lunch", datetime.utcnow(), 5, team["teamId"], "Team 1", [], phase="generating"
+    )
+    server.db.collection("polls").document("stuck").set(poll_data)
+    server.db.collection("teams").document(team["teamId"]).update({"currentlyOpenPoll": "stuck"})
+
+    assert server.fail_poll_generation("stuck", "Candidate generation timed out")
+    assert not server.fail_poll_generation("stuck", "again")
+
+    assert poll_document("stuck")["generationStage"] == "failed"
+    assert start_poll(client, team)["pollId"] != "stuck"
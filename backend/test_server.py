@@ -1 +1,605 @@
- 
\ No newline at end of file
+"""
+Unit tests for server internals: the in-memory store, the deadline
+scheduler, catalogue snapshots, the streaming JSON parser, vote tallies,
+the hard-constraint filter, occasion parsing, top-k selection, the group
+constraint cache, the LLM ranking cache and its deadline fallback.
+"""
+
+import io
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from google.cloud.firestore_v1.field_path import FieldPath
+
+import server
+import storage
+from server import firestore
+
+
+# ============================================================================
+# IN-MEMORY STORE
+# ============================================================================
+
+def test_transforms_and_field_paths():
+    ref = server.db.collection("polls").document("p1")
+    ref.set({"count": 1, "tags": ["a"], "votes": {"keep": 1, "drop": 2}})
+
+    ref.update({
+        "count": firestore.Increment(2),
+        "tags": firestore.ArrayUnion(["a", "b"]),
+        "votes.drop": firestore.DELETE_FIELD,
+        FieldPath("votes", "user.with`dots").to_api_repr(): 3
+    })
+    ref.set({"tallies": {"x": firestore.Increment(1)}}, merge=True)
+    ref.update({"tags": firestore.ArrayRemove(["a"])})
+
+    assert ref.get().to_dict() == {
+        "count": 3,
+        "tags": ["b"],
+        "votes": {"keep": 1, "user.with`dots": 3},
+        "tallies": {"x": 1}
+    }
+
+
+def test_update_of_missing_document_fails():
+    with pytest.raises(storage.exceptions.NotFound):
+        server.db.collection("polls").document("missing").update({"a": 1})
+
+
+def test_transaction_retries_after_conflicting_write():
+    ref = server.db.collection("counters").document("c")
+    ref.set({"n": 0})
+    attempts = []
+
+    @storage.transactional
+    def add_one(transaction, ref):
+        n = ref.get(transaction=transaction).to_dict()["n"]
+        if not attempts:
+            ref.update({"n": 10})  # Someone else writes between our read and commit
+        attempts.append(n)
+        transaction.update(ref, {"n": n + 1})
+
+    add_one(server.db.transaction(), ref)
+
+    assert attempts == [0, 10]
+    assert ref.get().to_dict() == {"n": 11}
+
+
+def test_concurrent_transactions_do_not_lose_updates():
+    ref = server.db.collection("counters").document("c")
+    ref.set({"n": 0})
+
+    @storage.transactional
+    def add_one(transaction, ref):
+        n = ref.get(transaction=transaction).to_dict()["n"]
+        transaction.update(ref, {"n": n + 1})
+
+    threads = [threading.Thread(target=add_one, args=(server.db.transaction(), ref)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert ref.get().to_dict() == {"n": 8}
+
+
+def test_transaction_reads_must_precede_writes():
+    ref = server.db.collection("counters").document("c")
+    ref.set({"n": 0})
+
+    @storage.transactional
+    def write_then_read(transaction, ref):
+        transaction.update(ref, {"n": 1})
+        ref.get(transaction=transaction)
+
+    with pytest.raises(storage.exceptions.InvalidArgument):
+        write_then_read(server.db.transaction(), ref)
+    assert ref.get().to_dict() == {"n": 0}
+
+
+def test_transaction_gives_up_after_max_attempts():
+    ref = server.db.collection("counters").document("c")
+    ref.set({"n": 0})
+
+    @storage.transactional
+    def always_conflicts(transaction, ref):
+        n = ref.get(transaction=transaction).to_dict()["n"]
+        ref.update({"n": n + 100})
+        transaction.update(ref, {"n": n + 1})
+
+    with pytest.raises(ValueError):
+        always_conflicts(server.db.transaction(), ref)
+
+
+def test_transaction_max_attempts_is_honoured():
+    ref = server.db.collection("counters").document("c")
+    ref.set({"n": 0})
+    attempts = []
+
+    @storage.transactional
+    def always_conflicts(transaction, ref):
+        attempts.append(ref.get(transaction=transaction).to_dict()["n"])
+        ref.update({"n": firestore.Increment(1)})
+        transaction.update(ref, {"n": -1})
+
+    with pytest.raises(ValueError):
+        always_conflicts(server.db.transaction(max_attempts=2), ref)
+    assert len(attempts) == 2
+
+
+def test_update_time_strictly_increases():
+    ref = server.db.collection("users").document("u")
+    times = []
+    for i in range(200):
+        ref.set({"n": i})
+        times.append(ref.get().update_time)
+
+    assert all(earlier < later for earlier, later in zip(times, times[1:]))
+    assert ref.get().create_time == times[0]
+
+
+def test_reset_drops_documents_and_locks():
+    ref = server.db.collection("counters").document("c")
+    ref.set({"n": 0})
+
+    @storage.transactional
+    def read(transaction, ref):
+        return ref.get(transaction=transaction).to_dict()
+
+    read(server.db.transaction(), ref)
+    server.db.reset()
+
+    assert not ref.get().exists
+    assert server.db._document_locks == {}
+
+
+# ============================================================================
+# DEADLINE SCHEDULER
+# ============================================================================
+
+def active_poll(phase: str, minutes_ago: float, duration: int = 5) -> dict:
+    return {
+        "status": "active",
+        "phase": phase,
+        "startedTime": datetime.utcnow() - timedelta(minutes=minutes_ago),
+        "duration": duration
+    }
+
+
+def test_poll_deadline_is_stable():
+    poll = active_poll("phase1", minutes_ago=1)
+    due = server.poll_deadline(poll)
+
+    time.sleep(0.01)
+    assert server.poll_deadline(poll) == due
+    assert due == pytest.approx(time.time() + 4 * 60, abs=2)
+    assert server.poll_deadline({**poll, "phase": "phase2"}) == due + server.PHASE2_GRACE_SECONDS
+    assert server.poll_deadline({**poll, "status": "closed"}) is None
+
+
+def test_generating_poll_deadline_is_the_generation_timeout():
+    started = datetime.utcnow()
+    poll = {**active_poll("generating", minutes_ago=0), "generationStartedAt": started}
+    assert server.poll_deadline(poll) == pytest.approx(
+        server.utc_epoch(started) + server.GENERATION_TIMEOUT_SECONDS
+    )
+
+
+def test_schedule_poll_dedupes_repeated_calls(monkeypatch):
+    scheduler = server.PollDeadlineScheduler()
+    monkeypatch.setattr(scheduler, "start", lambda: None)
+    poll = active_poll("phase1", minutes_ago=1)
+
+    for _ in range(100):
+        scheduler.schedule_poll("p1", poll)
+    scheduler.schedule_poll("p1", {**poll, "phase": "phase2"})
+
+    assert len(scheduler._heap) == 2
+    assert scheduler._due == {"p1": server.poll_deadline({**poll, "phase": "phase2"})}
+
+
+def test_next_due_skips_superseded_entries(monkeypatch):
+    scheduler = server.PollDeadlineScheduler()
+    monkeypatch.setattr(scheduler, "start", lambda: None)
+    now = time.time()
+
+    scheduler.schedule("p1", now - 2)
+    scheduler.schedule("p2", now - 1)
+    scheduler.schedule("p1", now + 60)  # Rescheduled: the old entry must not fire
+
+    assert scheduler._next_due(0) == "p2"
+    assert scheduler._next_due(0) is None
+
+
+def test_scheduler_lease_has_one_holder(monkeypatch):
+    monkeypatch.setattr(server, "SCHEDULER_LEASE_DOCUMENT", ("schedulerLeases", "test"))
+    first, second = server.PollDeadlineScheduler(), server.PollDeadlineScheduler()
+
+    assert first._hold_lease()
+    assert not second._hold_lease()
+    assert first._hold_lease()  # Renewal
+
+    server.db.collection("schedulerLeases").document("test").update({"expiresAt": time.time() - 1})
+    assert second._hold_lease()
+    assert not first._hold_lease()
+
+
+def test_due_deadline_transitions_poll(team):
+    poll = {**server.new_poll_document("Lunch", datetime.utcnow(), 1, team["teamId"], "Team 1", [
+        {"name": f"Food {i}", "ranking": i} for i in range(6)
+    ]), "startedTime": datetime.utcnow() - timedelta(seconds=70)}  # Phase 2 grace still running
+    server.db.collection("polls").document("p1").set(poll)
+
+    server.POLL_SCHEDULER.schedule_poll("p1", poll)
+
+    give_up_at = time.time() + server.SCHEDULER_LEASE_SECONDS
+    while time.time() < give_up_at:
+        if server.db.collection("polls").document("p1").get().to_dict()["phase"] == "phase2":
+            break
+        time.sleep(0.05)
+    assert server.db.collection("polls").document("p1").get().to_dict()["phase"] == "phase2"
+    assert "p1" in server.POLL_SCHEDULER._due  # Close is scheduled next
+
+
+def test_lease_holder_fires_polls_scheduled_elsewhere(monkeypatch, team):
+    monkeypatch.setattr(server, "SCHEDULER_LEASE_DOCUMENT", ("schedulerLeases", "test"))
+    leader, follower = server.PollDeadlineScheduler(), server.PollDeadlineScheduler()
+    for scheduler in (leader, follower):
+        monkeypatch.setattr(scheduler, "start", lambda: None)
+
+    assert leader._hold_lease() and not follower._hold_lease()
+
+    # Started on the follower: a phase-1 poll past its countdown and a stuck generation
+    due_poll = {**server.new_poll_document("Lunch", datetime.utcnow(), 1, team["teamId"], "Team 1", [
+        {"name": f"Food {i}", "ranking": i} for i in range(6)
+    ]), "startedTime": datetime.utcnow() - timedelta(seconds=70)}
+    stuck_poll = {**server.new_poll_document(
+        "Dinner", datetime.utcnow(), 5, team["teamId"], "Team 1", [], phase="generating"
+    ), "generationStartedAt": datetime.utcnow() - timedelta(seconds=server.GENERATION_TIMEOUT_SECONDS + 1)}
+    for poll_id, poll in (("due", due_poll), ("stuck", stuck_poll)):
+        server.db.collection("polls").document(poll_id).set(poll)
+        follower.schedule_poll(poll_id, poll)
+
+    assert leader._rebuild() == 2
+    leader._fire_due(until=time.time())
+
+    assert server.db.collection("polls").document("due").get().to_dict()["phase"] == "phase2"
+    assert server.db.collection("polls").document("stuck").get().to_dict()["generationStage"] == "failed"
+
+
+# ============================================================================
+# CATALOGUE SNAPSHOTS + STREAMING JSON
+# ============================================================================
+
+def food_fields(food) -> tuple:
+    return tuple(
+        dict(value) if field == "nutrition" else value
+        for field, value in ((field, getattr(food, field)) for field in server.FoodItem.__slots__)
+    )
+
+
+def test_snapshot_round_trip(tmp_path, food_catalogue):
+    source = tmp_path / "foods.json"
+    with open(server.FOOD_DATASET_PATH) as f:
+        source.write_text(json.dumps(json.load(f)[:40]))
+
+    snapshot = server.ensure_catalogue_snapshot(str(source), str(tmp_path / "snapshots"))
+    mapped = server.open_catalogue_snapshot(snapshot, name="test")
+    parsed = server.FoodCatalogue(server.read_food_items(str(source)))
+
+    assert len(mapped) == len(parsed) == 40
+    assert [food_fields(food) for food in mapped.foods] == [food_fields(food) for food in parsed.foods]
+    hard = {"allergens": ["peanut"], "dietary_violations": ["pork"], "ingredients": ["tofu"]}
+    assert mapped.index.excluded_mask(hard) == parsed.index.excluded_mask(hard)
+
+    # Unchanged source reuses the snapshot; a changed one compiles the next version
+    assert server.ensure_catalogue_snapshot(str(source), str(tmp_path / "snapshots")) == snapshot
+    with open(server.FOOD_DATASET_PATH) as f:
+        source.write_text(json.dumps(json.load(f)[:10]))
+    updated = server.open_catalogue_snapshot(server.ensure_catalogue_snapshot(str(source), str(tmp_path / "snapshots")))
+    assert (len(updated), updated.version) == (10, mapped.version + 1)
+
+
+ARRAY_TEXT = ' [ {"name": "Tteok [bokki]", "note": "say \\"hi\\" , ok"}, 1, -2.5e3, "x\\\\", [], {}, [[1, 2], {"a": null}], true ] \n'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16, 1 << 16])
+def test_iter_json_array_across_chunk_boundaries(chunk_size):
+    items = list(server.iter_json_array(io.StringIO(ARRAY_TEXT), chunk_size=chunk_size))
+    assert items == json.loads(ARRAY_TEXT)
+
+
+@pytest.mark.parametrize("text", ["", "{}", "[1, 2", "[1 2]", "[1,]"])
+def test_iter_json_array_rejects_malformed_input(text):
+    with pytest.raises(ValueError):
+        list(server.iter_json_array(io.StringIO(text), chunk_size=2))
+
+
+def test_iter_json_array_empty():
+    assert list(server.iter_json_array(io.StringIO(" [ ] "), chunk_size=1)) == []
+
+
+# ============================================================================
+# VOTE TALLIES
+# ============================================================================
+
+def test_tally_increments_moves_only_the_difference():
+    update = server.tally_increments("approvals", ["A", "B"], ["B", "C"])
+    assert {name: inc.value for name, inc in update["approvals"].items()} == {"A": -1, "C": 1}
+    assert server.tally_increments("approvals", ["A"], ["A"]) == {}
+
+
+def test_read_vote_tallies_sums_shards():
+    refs = server.vote_shard_refs("p1")
+    refs[0].set({"phase1LockedIn": 1, "approvals": {"A": 1, "B": 1}})
+    refs[3].set({"phase1LockedIn": 2, "approvals": {"A": 2, "B": -1}, "rejections": {"C": 1}})
+
+    tallies = server.read_vote_tallies("p1")
+
+    assert tallies["phase1LockedIn"] == 3
+    assert tallies["approvals"] == {"A": 3}  # B went back to 0
+    assert tallies["rejections"] == {"C": 1}
+    assert tallies["selections"] == {}
+
+
+def test_ttl_cache_peek_and_expire():
+    cache = server.TTLCache(max_entries=2, ttl_seconds=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.peek("a") == 1
+    cache.set("c", 3)  # peek did not refresh "a", so it is the LRU entry evicted
+    assert cache.get("a") is None
+
+    time.sleep(0.06)
+    assert cache.peek("b") is None and len(cache) == 2
+    assert cache.expire() == 2 and len(cache) == 0
+
+
+# ============================================================================
+# HARD CONSTRAINT FILTER
+# ============================================================================
+
+def filter_foods_by_lists(foods, hard, max_candidates):
+    """The per-food set-overlap filter the bitmask index replaced."""
+    disallowed_ingredients = {server.normalize_ingredient(i) for i in hard['ingredients']}
+    compatible = []
+    for food in foods:
+        if set(food.dietary_violations) & set(hard['dietary_violations']):
+            continue
+        if set(food.allergens) & set(hard['allergens']):
+            continue
+        if {server.normalize_ingredient(i) for i in food.ingredients} & disallowed_ingredients:
+            continue
+        compatible.append(food)
+        if len(compatible) >= max_candidates:
+            break
+    return compatible
+
+
+@pytest.mark.parametrize("hard", [
+    {"dietary_violations": [], "allergens": [], "ingredients": []},
+    {"dietary_violations": ["vegan"], "allergens": [], "ingredients": []},
+    {"dietary_violations": [], "allergens": ["soy", "wheat"], "ingredients": []},
+    {"dietary_violations": [], "allergens": [], "ingredients": [" Rice ", "soy sauce", "not-an-ingredient"]},
+    {"dietary_violations": ["vegetarian", "gluten-free"], "allergens": ["fish"], "ingredients": ["pork"]},
+])
+@pytest.mark.parametrize("max_candidates", [5, 200, 1000])
+def test_bitmask_filter_matches_list_filter(food_catalogue, hard, max_candidates):
+    expected = [food.food_id for food in filter_foods_by_lists(food_catalogue.foods, hard, max_candidates)]
+    group_constraints = {"hard": hard}
+
+    # Catalogue index (possibly mapped from a snapshot) and one built from the foods
+    rebuilt = server.FoodCatalogue(food_catalogue.foods)
+    for catalogue in (food_catalogue, rebuilt):
+        matched = server.filter_foods_by_constraints(group_constraints, max_candidates, catalogue)
+        assert [food.food_id for food in matched] == expected
+
+    excluded = food_catalogue.index.excluded_mask(hard)
+    assert food_catalogue.index.compatible_mask(hard) == food_catalogue.index.all_mask & ~excluded
+
+
+# ============================================================================
+# OCCASION PARSING
+# ============================================================================
+
+@pytest.mark.parametrize("occasion", ["Team lunch", "Good price please", "Tofurky day", "Eggplant parm", "Dieting"])
+def test_occasion_keywords_do_not_match_inside_words(occasion):
+    assert server.parse_occasion(occasion) == server.OccasionIntent()
+
+
+def test_occasion_keywords_match_whole_words_and_plurals():
+    intent = server.parse_occasion("Hearty noodles with tofu and TOMATOES, Thai style")
+
+    assert intent.heaviness == "heavy"
+    assert intent.meal_type == "noodle-based"
+    assert intent.ingredients == ("tofu", "noodle", "tomato")
+    assert intent.cuisine == "southeast asian"
+
+
+def test_overlapping_occasion_keywords_are_all_seen():
+    intent = server.parse_occasion("something light, not too heavy: fried rice")
+
+    assert intent.heaviness == "light"  # "light" outranks the "heavy" inside "not too heavy"
+    assert (intent.nutrient, intent.direction, intent.nutrition_keyword) == ("calories", "asc", "light")
+    assert intent.meal_type == "rice-based"
+    assert intent.ingredients == ("rice",)  # Credited from "fried rice"
+
+
+# ============================================================================
+# TOP-K SELECTION
+# ============================================================================
+
+@pytest.mark.parametrize("k", [0, 1, 7, 50, 200, 500])
+def test_top_k_indices_matches_stable_argsort(k):
+    keys = np.random.default_rng(k).integers(0, 20, size=200)  # Many ties
+
+    assert server.top_k_indices(keys, k).tolist() == np.argsort(keys, kind="stable")[:k].tolist()
+
+
+def test_top_k_indices_without_k_sorts_everything():
+    keys = np.array([3.0, 1.0, 2.0, 1.0])
+    assert server.top_k_indices(keys).tolist() == [1, 3, 2, 0]
+
+
+@pytest.mark.parametrize("k", [0, 1, 3, 10, 50])
+def test_top_k_matches_sorted(k):
+    items = [("a", 2), ("b", 1), ("c", 2), ("d", 0), ("e", 1), ("f", 2)]
+
+    assert server.top_k(items, k, key=lambda item: item[1]) == sorted(items, key=lambda item: item[1])[:k]
+
+
+# ============================================================================
+# GROUP CONSTRAINT CACHE
+# ============================================================================
+
+def test_group_constraints_recompile_on_profile_update(team, food_catalogue):
+    cache = server.GroupConstraintCache(max_entries=16, ttl_seconds=60)
+    members = server.load_members_constraints(team["members"])
+    first = cache.compile(team["teamId"], members)
+
+    assert cache.compile(team["teamId"], server.load_members_constraints(team["members"])) is first
+    assert "soy" not in first.constraints["hard"]["allergens"]
+
+    server.db.collection("users").document(team["members"][0]).update({"allergies": ["SOY"]})
+    members = server.load_members_constraints(team["members"])
+    second = cache.compile(team["teamId"], members)
+
+    assert second is not first
+    assert second.constraints["hard"]["allergens"] == ["soy"]
+    expected = server.match_hard_constraints(server.build_group_constraints(members), catalogue=food_catalogue)
+    assert second.match(food_catalogue).foods == expected.foods
+    assert all("soy" not in food.allergens for food in second.match(food_catalogue).foods)
+
+
+# ============================================================================
+# LLM RANKING CACHE
+# ============================================================================
+
+def test_ranking_cache_memory_hit_and_expiry():
+    cache = server.RankingCache(max_entries=4, ttl_seconds=0.05)
+    cache.set("k", ["f1", "f2"])
+
+    assert cache.get("k") == ["f1", "f2"]
+    time.sleep(0.06)
+    assert cache.get("k") is None
+
+
+def test_ranking_cache_persists_across_instances(tmp_path):
+    db_path = str(tmp_path / "ranking.sqlite")
+    writer = server.RankingCache(max_entries=2, ttl_seconds=60, db_path=db_path)
+    for key in ("a", "b", "c"):
+        writer.set(key, [key + "1", key + "2"])
+
+    # A fresh process only has the SQLite tier; "a" was evicted beyond max_entries
+    reader = server.RankingCache(max_entries=2, ttl_seconds=60, db_path=db_path)
+    assert reader.get("c") == ["c1", "c2"]
+    assert reader.get("b") == ["b1", "b2"]
+    assert reader.get("a") is None
+
+
+def test_ranking_cache_drops_expired_rows(tmp_path):
+    db_path = str(tmp_path / "ranking.sqlite")
+    server.RankingCache(max_entries=4, ttl_seconds=0.05, db_path=db_path).set("k", ["f1"])
+    time.sleep(0.06)
+
+    assert server.RankingCache(max_entries=4, ttl_seconds=60, db_path=db_path).get("k") is None
+
+
+def test_ranking_cache_key_fingerprint():
+    group_constraints = server.build_group_constraints([
+        {"userId": "u1", "constraints": {"allergies": ["SOY", "SESAME"], "favoriteCuisines": ["KOREAN"]}},
+        {"userId": "u2", "constraints": {"spiceTolerance": "SPICY"}}
+    ])
+    key = server.ranking_cache_key(group_constraints, "Team  Lunch", ["f2", "f1"], 10, catalogue_version=3)
+
+    # Equivalent requests share a key
+    assert server.ranking_cache_key(group_constraints, "team lunch", ["f1", "f2", "f1"], 10, 3) == key
+    # Anything that can change the answer gives a new one
+    assert server.ranking_cache_key(group_constraints, "team dinner", ["f1", "f2"], 10, 3) != key
+    assert server.ranking_cache_key(group_constraints, "team lunch", ["f1", "f3"], 10, 3) != key
+    assert server.ranking_cache_key(group_constraints, "team lunch", ["f1", "f2"], 5, 3) != key
+    assert server.ranking_cache_key(group_constraints, "team lunch", ["f1", "f2"], 10, 4) != key
+    assert server.ranking_cache_key(group_constraints, "team lunch", ["f1", "f2"], 10, 3, "campus") != key
+
+
+# ============================================================================
+# LLM RANKING DEADLINE + LOCAL FALLBACK
+# ============================================================================
+
+@pytest.fixture
+def ranking_cache(monkeypatch):
+    cache = server.RankingCache(max_entries=16, ttl_seconds=60)
+    monkeypatch.setattr(server, "RANKING_CACHE", cache)
+    return cache
+
+
+def test_late_llm_answer_is_cached_for_the_next_poll(monkeypatch, ranking_cache):
+    release = threading.Event()
+
+    def slow_ranking(prompt, api_key):
+        release.wait(timeout=5)
+        return ["f2", "f1"]
+
+    monkeypatch.setattr(server, "request_llm_ranking", slow_ranking)
+
+    assert server.rank_with_deadline("prompt", "key", "k1", deadline_seconds=0.05) is None
+
+    release.set()
+    deadline = time.time() + 5
+    while ranking_cache.get("k1") is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert ranking_cache.get("k1") == ["f2", "f1"]
+
+
+def test_hedged_request_replaces_a_failed_one(monkeypatch, ranking_cache):
+    calls = []
+
+    def flaky_ranking(prompt, api_key):
+        calls.append(prompt)
+        if len(calls) <= 2:
+            raise ValueError("bad JSON")
+        return ["f1"]
+
+    monkeypatch.setattr(server, "request_llm_ranking", flaky_ranking)
+
+    assert server.rank_with_deadline("prompt", "key", "k1", deadline_seconds=1) is None
+    assert len(calls) == 1  # No hedging: one failed request is the end
+
+    started = time.monotonic()
+    assert server.rank_with_deadline(
+        "prompt", "key", "k2", deadline_seconds=1, hedge_after_seconds=0.5
+    ) == ["f1"]
+    assert len(calls) == 3
+    assert time.monotonic() - started < 0.5  # Hedged right after the failure, not at hedge_after
+
+
+@pytest.mark.parametrize("outcome", ["late", "error"])
+def test_ranking_falls_back_to_local_order(monkeypatch, ranking_cache, food_catalogue, outcome):
+    release = threading.Event()
+
+    def unusable_ranking(prompt, api_key):
+        if outcome == "error":
+            raise RuntimeError("service unavailable")
+        release.wait(timeout=5)
+        return []
+
+    monkeypatch.setattr(server, "request_llm_ranking", unusable_ranking)
+    monkeypatch.setattr(server, "LLM_RANKING_DEADLINE_SECONDS", 0.05)
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    group_constraints = server.build_group_constraints([
+        {"userId": "u1", "constraints": {"favoriteCuisines": ["KOREAN"], "spiceTolerance": "SPICY"}}
+    ])
+    foods = server.filter_foods_by_constraints(group_constraints, catalogue=food_catalogue)
+
+    try:
+        ranked = server.rank_foods_with_llm(foods, group_constraints, top_k=10, catalogue=food_catalogue)
+    finally:
+        release.set()
+
+    local_ids = server.rank_foods_locally(foods, group_constraints["soft"], 10)
+    assert ranked == [(food_id, rank) for rank, food_id in enumerate(local_ids)]